@@ -65,6 +65,8 @@ CHANNEL_LAYERS = {
         'BACKEND': 'channels_redis.core.RedisChannelLayer',
         'CONFIG': {
             "hosts": [f"redis://:{REDIS_PASSWORD}@{REDIS_HOST}:{REDIS_PORT}/{REDIS_DB}"],  # 添加密码认证
+            # 任务分片的结果汇总到协调者的channel，结果较多时默认容量（100条）不够
+            "channel_capacity": {"execute_shard.*": 5000},
         },
     },
 }
@@ -208,6 +210,136 @@ DIR_INFO = {
     'REPORT_DIR': BASE_DIR / 'devices/var/reports' #存放巡检、配置下发报告文件即CSV解析汇总文件
 }
 
+# 巡检、配置下发执行引擎设置
+EXECUTE_CONFIG = {
+    # SSH会话池，按(ip, port, username, os_type)复用已登录的连接
+    'SESSION_POOL': {
+        'ENABLED': os.environ.get('EXECUTE_SESSION_POOL', 'True') == 'True',
+        'MAX_PER_HOST': 2, # 单台设备最多保持的会话数
+        'MAX_TOTAL': 500, # 会话池总容量，超出后按LRU淘汰空闲会话
+        'IDLE_TTL': 300, # 空闲会话存活时间（秒）
+        'ACQUIRE_TIMEOUT': 60, # 等待可用会话的超时时间（秒）
+    },
+    # 进程级任务调度器，所有巡检、配置下发连接共用
+    'SCHEDULER': {
+        'MAX_WORKERS': int(os.environ.get('EXECUTE_MAX_WORKERS', 50)), # 全局SSH并发上限
+        'BULK_DEVICES': 200, # 设备数达到该值的任务按bulk优先级调度，再次执行的任务为interactive优先级
+    },
+    # 巡检默认执行引擎：thread（线程池+netmiko/paramiko）或async（asyncssh协程）
+    'DEFAULT_ENGINE': os.environ.get('EXECUTE_DEFAULT_ENGINE', 'thread'),
+    # asyncssh协程引擎
+    'ASYNC_ENGINE': {
+        'MAX_CONCURRENCY': 1000, # 单进程同时打开的设备会话数
+        'CONNECT_TIMEOUT': 20, # 连接超时时间（秒）
+        'COMMAND_TIMEOUT': 60, # 单条命令超时时间（秒）
+    },
+    # 任务队列：inline模式在websocket连接所在进程内执行任务；queue模式投递到任务队列，由execute_worker进程执行
+    'JOB_QUEUE': {
+        'MODE': os.environ.get('EXECUTE_JOB_MODE', 'inline'),
+        'BACKEND': os.environ.get('EXECUTE_JOB_BACKEND', 'redis'), # redis或memory（进程内队列，仅用于测试/开发）
+        'LEASE_TTL': 60, # 任务租约时间（秒），worker退出后超过该时间任务重新入队
+        'MAX_ATTEMPTS': 3, # 任务最大尝试次数
+        'WORKER_CONCURRENCY': int(os.environ.get('EXECUTE_WORKER_CONCURRENCY', 2)), # 单个worker同时执行的任务数
+    },
+    # 自适应并发（AIMD）：建连健康时逐步增加单个任务的并发数，认证失败、超时、连接重置增多或建连变慢时减半
+    # 默认不启用，单个任务的并发数只受全局上限限制
+    'ADAPTIVE_CONCURRENCY': {
+        'ENABLED': os.environ.get('EXECUTE_ADAPTIVE_CONCURRENCY', 'False') == 'True',
+        'INITIAL': 20, # 初始并发数，与原先每个任务固定的工作线程数一致
+        'MIN': 2, # 最小并发数
+        'MAX': int(os.environ.get('EXECUTE_MAX_WORKERS', 50)), # 最大并发数
+        'WINDOW': 10, # 每收集多少台设备的建连结果评估一次
+        'DECREASE_FACTOR': 0.5, # 减小时的乘数
+        'FAILURE_THRESHOLD': 0.2, # 认证失败、超时、连接重置的比例上限
+        'LATENCY_FACTOR': 3.0, # 建连耗时中位数超过基线的倍数时减小并发
+    },
+    # 建连限速：按子网、os_type、站点限制建连速率（令牌桶）及同时登录数，'*'为该维度的默认规则
+    'RATE_LIMIT': {
+        'ENABLED': os.environ.get('EXECUTE_RATE_LIMIT', 'False') == 'True',
+        'SUBNET_PREFIX': 24, # 由设备IP得出子网时使用的前缀长度
+        'SUBNET': {'*': {'RATE': 5, 'BURST': 10}}, # 每个子网每秒5次建连，突发10次
+        'OS_TYPE': {
+            'huawei': {'RATE': 3, 'BURST': 6, 'MAX_CONCURRENT': 10},
+            'huawei_vrp': {'RATE': 3, 'BURST': 6, 'MAX_CONCURRENT': 10},
+            'hp_comware': {'RATE': 3, 'BURST': 6, 'MAX_CONCURRENT': 10},
+        },
+        'SITE': {'*': {'RATE': 20, 'BURST': 40}}, # 每个站点（通常对应一组AAA服务器）
+        'SITES': {}, # 站点与网段的对应关系，如{'机房A': ['10.1.0.0/16']}
+    },
+    # SSH登录前的TCP端口探测，端口不可达的设备直接记为失败，不再等待SSH连接超时
+    'PREFLIGHT': {
+        'ENABLED': os.environ.get('EXECUTE_PREFLIGHT', 'False') == 'True', # 默认值，巡检时可单独指定
+        'TIMEOUT': 3, # 探测超时时间（秒）
+        'CONCURRENCY': 2000, # 同时探测的设备数
+    },
+    # netmiko会话参数：按os_type配置建连参数及提示符正则，命令按正则等待结束，不再每条命令获取提示符
+    # 默认不启用：提示符正则不匹配的命令要等到读取超时才失败，需确认设备的提示符格式后再启用
+    'SESSION_PROFILE': {
+        'ENABLED': os.environ.get('EXECUTE_SESSION_PROFILE', 'False') == 'True',
+        'FALLBACK_FAILURES': 3, # 提示符正则连续读取超时次数，达到后该os_type回退为每条命令获取提示符
+        'LEARN_TTL': 60*60*24*7, # 回退标记及最长命令耗时在缓存中的保存时间（秒）
+        # 未配置READ_TIMEOUT的os_type，命令数达到MIN_SAMPLES后读取超时为最长命令耗时的READ_TIMEOUT_FACTOR倍，不小于MIN_READ_TIMEOUT（秒）
+        'READ_TIMEOUT_FACTOR': 3,
+        'MIN_READ_TIMEOUT': 10,
+        'MIN_SAMPLES': 20,
+        # 覆盖内置参数，如 'hp_comware': {'GLOBAL_DELAY_FACTOR': 2, 'READ_TIMEOUT': 120}
+        'PROFILES': {},
+    },
+    # 服务器命令执行方式：serial（每条命令一个exec通道）、batch（设备的所有命令在一个通道中执行，按分隔符拆分输出）
+    # 或parallel（只读命令在同一连接的多个通道中并发执行，其余命令逐条执行）；默认serial，batch及parallel需显式启用
+    'SERVER_EXEC': {
+        'MODE': os.environ.get('EXECUTE_SERVER_MODE', 'serial'),
+        'PARALLEL_CHANNELS': 4, # parallel模式下每台设备同时打开的通道数，需小于sshd的MaxSessions（默认10）
+    },
+    # 巡检耗时预估：按最近报告中的命令耗时预估任务耗时及下发顺序
+    'PLANNER': {
+        'MAX_REPORTS': 50, # 参与统计的最近报告数
+        'HISTORY_TTL': 600, # 历史耗时汇总的缓存时间（秒）
+        'DEFAULT_COMMAND_SECONDS': 2, # 没有历史数据时单条命令的预计耗时（秒）
+        'CONNECT_SECONDS': 3, # 建连及登录的预计耗时（秒）
+        'SLOW_FACTOR': 3, # 预计耗时超过所有设备中位数该倍数的设备标记为慢设备
+        'LPT_ORDER': True, # 执行时按预计耗时从长到短下发设备，耗时长的设备先开始
+    },
+    # 任务分片：设备数较多的任务拆分为多个分片，一个分片在发起任务的进程内执行，其余投递到任务队列由各节点的execute_worker执行，
+    # 结果及进度经channel layer汇总到原任务；需要JOB_QUEUE的BACKEND为redis，且worker的WORKER_CONCURRENCY不小于2
+    'SHARDING': {
+        'ENABLED': os.environ.get('EXECUTE_SHARDING', 'False') == 'True',
+        'MIN_DEVICES': 500, # 设备数达到该值才拆分
+        'SHARD_SIZE': 250, # 每个分片的设备数
+        'MAX_SHARDS': 8, # 最多拆分的分片数（含本地执行的分片）
+        'RESULT_BATCH': 100, # 分片结果累计该条数时立即推送
+        'FLUSH_INTERVAL': 0.5, # 分片结果推送间隔（秒）
+    },
+    # 执行时限：巡检任务超过时限后取消未开始的设备、关闭执行中的连接，未完成的设备记为超时
+    # 配置下发不关闭执行中的连接，不限制设备及命令时限，只在CONFIG_JOB_DEADLINE到达后停止开始新的设备
+    'TIME_BUDGET': {
+        'JOB_DEADLINE': int(os.environ.get('EXECUTE_JOB_DEADLINE', 3600)), # 整个巡检任务的时限（秒），0表示不限制
+        'DEVICE_BUDGET': int(os.environ.get('EXECUTE_DEVICE_BUDGET', 600)), # 单台设备从开始执行起的时限（秒）
+        'COMMAND_TIMEOUT': int(os.environ.get('EXECUTE_COMMAND_TIMEOUT', 60)), # 单条命令的读取超时（秒），不超过设备剩余时间
+        'CONFIG_JOB_DEADLINE': int(os.environ.get('EXECUTE_CONFIG_JOB_DEADLINE', 0)), # 配置下发任务的时限（秒），0表示不限制
+        'GRACE': 10, # 任务超时后等待工作线程写入已获得结果的时间（秒）
+    },
+    # 进度推送：合并计数和设备状态变化，按间隔推送一帧
+    'PROGRESS': {
+        'FLUSH_INTERVAL': 0.25, # 推送间隔（秒）
+        'FLUSH_EVENTS': 200, # 累计事件数达到该值时立即推送
+    },
+    # 报告生成：模板环境进程内共用，编译结果缓存在内存及BYTECODE_CACHE_DIR中
+    'REPORT': {
+        'BYTECODE_CACHE_DIR': BASE_DIR / 'devices/var/cache/jinja', # 为空时不缓存编译结果
+        'AUTO_RELOAD': True, # 模板文件修改后自动重新编译
+        'GZIP': os.environ.get('EXECUTE_REPORT_GZIP', 'False') == 'True', # 报告边渲染边压缩，保存为index.html.gz
+        'WRITE_BUFFER': 256*1024, # 渲染输出累计该字符数后写入文件
+    },
+    # 报告生成后的TextFSM解析：结果按模板分组交给解析进程并行解析
+    'TEXTFSM': {
+        'WORKERS': int(os.environ.get('EXECUTE_TEXTFSM_WORKERS', min(4, (os.cpu_count() or 1) - 1))), # 解析进程数，0表示串行解析；默认留一个CPU写入结果
+        'MIN_RESULTS': 200, # 结果数少于该值时串行解析
+        'CHUNK_SIZE': 100, # 每个解析任务包含的输出数
+        'TEMPLATE_CACHE_SIZE': 300, # 每个进程缓存的已编译模板数，模板文件修改后自动重新编译
+    },
+}
+
 # 日志配置
 LOGGING = {
     'version': 1,
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from devices.tools.job_queue import get_job_queue, job_queue_config, JobWorker, InMemoryJobQueue
+
+
+class Command(BaseCommand):
+    help = '从任务队列中取出巡检、配置下发任务并执行'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=job_queue_config().get('WORKER_CONCURRENCY', 2),
+            help='同时执行的任务数'
+        )
+
+    def handle(self, *args, **options):
+        queue = get_job_queue()
+        if isinstance(queue, InMemoryJobQueue):
+            raise CommandError('进程内任务队列无法被其它进程消费，请将EXECUTE_JOB_BACKEND设置为redis')
+        worker = JobWorker(queue, concurrency=options['concurrency'])
+        self.stdout.write(self.style.SUCCESS(f"任务执行器{worker.worker_id}已启动"))
+        try:
+            worker.run_forever()
+        except KeyboardInterrupt:
+            worker.stop()
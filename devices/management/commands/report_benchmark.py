@@ -0,0 +1,98 @@
+import shutil
+import tempfile
+import time
+from datetime import datetime
+from statistics import median
+
+from django.core.management.base import BaseCommand
+
+from devices.tools.report import (
+    REPORT_TEMPLATE, build_report_environment, get_report_environment, get_report_generator
+)
+
+
+class Command(BaseCommand):
+    help = '报告模板渲染微基准：对比每份报告新建模板环境与共用模板环境的耗时'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reports', type=int, default=50, help='每种方式生成的报告数')
+        parser.add_argument('--devices', type=int, default=20, help='每份报告的设备数')
+        parser.add_argument('--commands', type=int, default=5, help='每台设备的命令数')
+
+    def handle(self, *args, **options):
+        context = self._build_context(options['devices'], options['commands'])
+        reports = max(1, options['reports'])
+        bytecode_dir = tempfile.mkdtemp(prefix='report_benchmark_')
+        try:
+            cases = [
+                # 改造前：每份报告新建环境并重新编译模板
+                ('new_env', lambda: build_report_environment().get_template(REPORT_TEMPLATE)),
+                # 每份报告新建环境，编译结果从字节码缓存读取（如进程重启后）
+                ('bytecode_cache', lambda: build_report_environment(bytecode_dir).get_template(REPORT_TEMPLATE)),
+                # 共用环境及编译后的模板，只检查模板文件修改时间
+                ('shared_env', lambda: get_report_environment().get_template(REPORT_TEMPLATE)),
+            ]
+            get_report_generator()
+            results = {name: self._measure(load, context, reports) for name, load in cases}
+        finally:
+            shutil.rmtree(bytecode_dir, ignore_errors=True)
+        baseline = results['new_env']['total']
+        self.stdout.write(f"{'方式':<16}{'获取模板(ms)':>14}{'渲染(ms)':>12}{'合计(ms)':>12}{'加速比':>10}")
+        for name, result in results.items():
+            self.stdout.write(
+                f"{name:<16}{result['load']:>14.3f}{result['render']:>12.3f}{result['total']:>12.3f}"
+                f"{baseline / result['total'] if result['total'] else 0:>10.1f}"
+            )
+
+    def _measure(self, load, context, reports):
+        """每份报告的耗时中位数（毫秒），第一份报告包含编译或读取缓存的耗时，不计入"""
+        load_times, render_times = [], []
+        load()
+        for _ in range(reports):
+            started = time.perf_counter()
+            template = load()
+            loaded = time.perf_counter()
+            template.render(context)
+            load_times.append((loaded - started) * 1000)
+            render_times.append((time.perf_counter() - loaded) * 1000)
+        return {
+            'load': median(load_times),
+            'render': median(render_times),
+            'total': median(load_times) + median(render_times),
+        }
+
+    def _build_context(self, devices, commands):
+        """与ReportGenerator._build_report_context结构一致的模拟数据，不访问数据库"""
+        now = datetime.now().isoformat()
+        command_texts = [f"display command {index}" for index in range(commands)]
+        names = [f"SW{index}" for index in range(devices)]
+        return {
+            'now': now[:10],
+            'meta': {
+                'report_id': 'benchmark',
+                'generated_time': now,
+                'system_metadata': {'platform': {'os': 'posix', 'python_version': ''}},
+            },
+            'timing': {'start': now, 'end': now, 'duration': '1s'},
+            'statistics': {'device_count': devices, 'success_count': devices * commands, 'command_types': commands},
+            'content': {
+                'devices': [],
+                'commands': [],
+                'os_commands': [{'os_type': 'hp_comware', 'commands': command_texts}],
+                'os_devices': [{'os_type': 'hp_comware', 'devices': names}],
+            },
+            'concurrency': [],
+            'unreachable': [],
+            'results': [
+                {
+                    'device': name,
+                    'device_ip': '10.0.0.1',
+                    'os_type': 'hp_comware',
+                    'command': command,
+                    'result': 'output',
+                    'timestamp': now,
+                    'status': 'success',
+                }
+                for name in names for command in command_texts
+            ],
+        }
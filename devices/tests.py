@@ -1,11 +1,45 @@
-from django.test import TestCase
+from django.test import TestCase, SimpleTestCase, RequestFactory, override_settings
 from django.urls import reverse
+from django.core.cache import cache
 from rest_framework.test import APITestCase
 from rest_framework import status
 from django.contrib.auth.models import User
 from rest_framework.authtoken.models import Token
 from .models import Device, OSType, Command
+from devices.tools.session_pool import SessionPool
+from devices.tools.scheduler import JobScheduler, resolve_priority, PRIORITY_INTERACTIVE, PRIORITY_NORMAL, PRIORITY_BULK
+from devices.tools.async_engine import NetworkShellSession
+from devices.tools.result_spool import ResultSpool
+from devices.tools.rate_limit import ConnectionRateLimiter
+from devices.tools.preflight import tcp_sweep
+from devices.tools.concurrency import AdaptiveConcurrency, classify_error, ERROR_OTHER, ERROR_RESET, ERROR_TIMEOUT
+from netmiko.exceptions import NetmikoAuthenticationException, ReadTimeout
+from devices.tools.progress import ProgressAggregator, device_key, DEVICE_RUNNING, DEVICE_COMPLETED, DEVICE_FAILED, DEVICE_TIMEOUT
+from devices.tools.session_profile import SessionProfileRegistry
+from devices.tools.server_exec import build_batch_script, MarkerStream, is_read_only
+from devices.tools.planner import plan_job, simulate_makespan, load_history
+from devices.tools.deadline import DeviceBudget, DeviceTimeout, is_timeout_error
+from devices.tools.job_queue import InMemoryJobQueue, JobWorker, build_job_spec, JOB_COMPLETED, JOB_QUEUED, JOB_CANCELLED
+from devices.tools.execute_job import ExecuteJob, ConfigJob
+from devices.tools.sharding import ShardCoordinator, split_shards
+from devices.tools.report import build_report_environment, get_report_generator, write_stream, REPORT_TEMPLATE
+from devices.views import report_file_response
+from jinja2 import Template
+import gzip
+from devices.tools.textfsm_parse import TextFSMPipeline, TemplateCache
+from devices.tools.checkpoint import JobCheckpoint, retain_finished_results
+from devices.tools.timing import TimingCollector, load_timings, percentile, PHASE_CONNECT, PHASE_TCP_CONNECT, PHASE_SSH_HANDSHAKE, PHASE_EXEC, PHASE_TRANSFER
+import asyncio
+import io
+import textfsm
+import socket
+import threading
+import time
 import json
+import os
+import tempfile
+import subprocess
+from unittest import mock
 
 class DeviceAPITest(APITestCase):
     def setUp(self):
@@ -287,3 +321,1047 @@ class CommandAPITest(APITestCase):
 
         self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
         self.assertEqual(Command.objects.count(), 0)
+
+class FakeSession:
+    """模拟netmiko连接"""
+    def __init__(self, alive=True):
+        self.alive = alive
+        self.closed = False
+
+    def find_prompt(self):
+        if not self.alive:
+            raise OSError('Socket is closed')
+        return '<switch>'
+
+    def disconnect(self):
+        self.closed = True
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class SessionPoolTest(SimpleTestCase):
+    def setUp(self):
+        self.pool = SessionPool(max_per_host=1, max_total=2, idle_ttl=300, acquire_timeout=0.1)
+        self.key = ('10.0.0.1', 22, 'admin', 'hp_comware')
+
+    def test_reuse_idle_session(self):
+        """测试归还后的会话被复用"""
+        with self.pool.session(self.key, FakeSession) as first:
+            pass
+        with self.pool.session(self.key, FakeSession) as second:
+            pass
+        self.assertIs(first, second)
+        stats = self.pool.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+
+    def test_unhealthy_session_is_replaced(self):
+        """测试健康检查失败的会话被关闭并重建"""
+        with self.pool.session(self.key, FakeSession) as first:
+            first.alive = False
+        with self.pool.session(self.key, FakeSession) as second:
+            pass
+        self.assertIsNot(first, second)
+        self.assertTrue(first.closed)
+        self.assertEqual(self.pool.stats()['health_check_failed'], 1)
+
+    def test_max_per_host(self):
+        """测试单设备会话数上限"""
+        conn = self.pool.acquire(self.key, FakeSession)
+        with self.assertRaises(RuntimeError):
+            self.pool.acquire(self.key, FakeSession)
+        self.pool.release(conn)
+
+    def test_lru_eviction(self):
+        """测试超出总容量时淘汰最久未用的空闲会话"""
+        keys = [('10.0.0.%d' % i, 22, 'admin', 'hp_comware') for i in range(1, 4)]
+        sessions = []
+        for key in keys:
+            with self.pool.session(key, FakeSession) as conn:
+                sessions.append(conn)
+        self.assertEqual(self.pool.stats()['evicted'], 1)
+        self.assertEqual(self.pool.stats()['idle'], 2)
+
+class JobSchedulerTest(SimpleTestCase):
+    def test_global_concurrency_cap(self):
+        """测试全局并发上限"""
+        scheduler = JobScheduler(max_workers=2)
+        lock = threading.Lock()
+        state = {'current': 0, 'peak': 0}
+
+        def task():
+            with lock:
+                state['current'] += 1
+                state['peak'] = max(state['peak'], state['current'])
+            time.sleep(0.02)
+            with lock:
+                state['current'] -= 1
+
+        futures = [scheduler.submit(job_id, task) for job_id in ('job-a', 'job-b') for _ in range(4)]
+        for future in futures:
+            future.result(timeout=5)
+        self.assertLessEqual(state['peak'], 2)
+
+    def test_fair_share_between_jobs(self):
+        """测试多个任务之间轮转分配线程"""
+        scheduler = JobScheduler(max_workers=1)
+        gate = threading.Event()
+        order = []
+        blocker = scheduler.submit('blocker', gate.wait)
+        futures = []
+        for _ in range(3):
+            futures.append(scheduler.submit('job-a', order.append, 'a'))
+        for _ in range(3):
+            futures.append(scheduler.submit('job-b', order.append, 'b'))
+        self.assertEqual(scheduler.job_stats('job-a')['queued'], 3)
+        gate.set()
+        blocker.result(timeout=5)
+        for future in futures:
+            future.result(timeout=5)
+        self.assertEqual(order, ['a', 'b', 'a', 'b', 'a', 'b'])
+
+    def test_job_limit(self):
+        """测试任务自身的并发上限"""
+        scheduler = JobScheduler(max_workers=4)
+        scheduler.set_job_limit('job-a', 1)
+        lock = threading.Lock()
+        state = {'current': 0, 'peak': 0}
+
+        def task():
+            with lock:
+                state['current'] += 1
+                state['peak'] = max(state['peak'], state['current'])
+            time.sleep(0.01)
+            with lock:
+                state['current'] -= 1
+
+        futures = [scheduler.submit('job-a', task) for _ in range(4)]
+        for future in futures:
+            future.result(timeout=5)
+        self.assertEqual(state['peak'], 1)
+
+    def test_priority_lanes(self):
+        """测试交互任务优先于排队中的大批量任务"""
+        scheduler = JobScheduler(max_workers=1)
+        scheduler.set_job_priority('sweep', PRIORITY_BULK)
+        scheduler.set_job_priority('again', PRIORITY_INTERACTIVE)
+        gate = threading.Event()
+        started = threading.Event()
+        order = []
+        blocker = scheduler.submit('blocker', lambda: started.set() or gate.wait())
+        started.wait(5)
+        futures = [scheduler.submit('sweep', order.append, 'sweep') for _ in range(3)]
+        futures += [scheduler.submit('again', order.append, 'again') for _ in range(2)]
+        self.assertEqual(scheduler.job_stats('sweep')['ahead'], 2)
+        self.assertEqual(scheduler.job_stats('again')['ahead'], 0)
+        gate.set()
+        blocker.result(timeout=5)
+        for future in futures:
+            future.result(timeout=5)
+        self.assertEqual(order, ['again', 'again', 'sweep', 'sweep', 'sweep'])
+        self.assertEqual(resolve_priority(None, 5), PRIORITY_NORMAL)
+        self.assertEqual(resolve_priority(None, 3000), PRIORITY_BULK)
+
+class AdaptiveConcurrencyTest(SimpleTestCase):
+    def test_additive_increase_multiplicative_decrease(self):
+        limits = []
+        controller = AdaptiveConcurrency(initial=4, minimum=1, maximum=6, window=4, on_change=limits.append)
+        for _ in range(8):
+            controller.record_success(0.5)
+        self.assertEqual(controller.limit, 6)
+        # 认证超时增多，并发减半
+        for _ in range(2):
+            controller.record_success(0.5)
+        for _ in range(2):
+            controller.record_failure(NetmikoAuthenticationException('Authentication to device failed.'))
+        self.assertEqual(controller.limit, 3)
+        self.assertEqual(limits, [5, 6, 3])
+        self.assertEqual([item['reason'] for item in controller.history], ['initial', 'increase', 'increase', 'decrease'])
+
+    def test_latency_backoff_and_ignored_errors(self):
+        controller = AdaptiveConcurrency(initial=4, minimum=1, maximum=10, window=2)
+        controller.record_success(1)
+        controller.record_success(1)
+        self.assertEqual(controller.limit, 5)
+        # 建连耗时超过基线3倍
+        controller.record_success(5)
+        controller.record_success(5)
+        self.assertEqual(controller.limit, 2)
+        # 非拥塞类错误不参与评估
+        self.assertEqual(controller.record_failure(ValueError('设备不存在')), ERROR_OTHER)
+        self.assertEqual(controller.record_failure(ConnectionResetError()), ERROR_RESET)
+        self.assertEqual(classify_error(socket.timeout()), ERROR_TIMEOUT)
+
+class FakeShellProcess:
+    """模拟交互式shell，按写入的命令返回预设输出"""
+    def __init__(self, responses):
+        self.responses = responses
+        self.chunks = asyncio.Queue()
+        self.written = []
+        self.stdin = self
+        self.stdout = self
+
+    def write(self, data):
+        self.written.append(data)
+        for chunk in self.responses.get(data.rstrip('\n'), ['\r\n<H3C>']):
+            self.chunks.put_nowait(chunk)
+
+    async def read(self, size):
+        return await self.chunks.get()
+
+class FakeShellConnection:
+    def __init__(self, process):
+        self.process = process
+
+    async def create_process(self, **kwargs):
+        return self.process
+
+class NetworkShellSessionTest(SimpleTestCase):
+    def test_prompt_and_paging(self):
+        """测试提示符识别、命令回显去除和分页处理"""
+        process = FakeShellProcess({
+            '': ['\r\n<H3C>'],
+            'screen-length disable': ['screen-length disable\r\n<H3C>'],
+            'display clock': ['display clock\r\n10:00:00 UTC\r\n', '  ---- More ----'],
+            ' ': ['\x1b[16D                \x1b[16DSat 01/01/2000\r\n<H3C>'],
+        })
+
+        async def run():
+            session = NetworkShellSession(FakeShellConnection(process), 'hp_comware', io.StringIO(), 5)
+            await session.open()
+            return session, await session.run('display clock')
+
+        session, output = asyncio.run(run())
+        self.assertEqual(session.prompt, '<H3C>')
+        self.assertIn('screen-length disable\n', process.written)
+        self.assertIn('10:00:00 UTC', output)
+        self.assertIn('Sat 01/01/2000', output)
+        self.assertNotIn('display clock', output)
+        self.assertNotIn('<H3C>', output)
+
+class InMemoryJobQueueTest(SimpleTestCase):
+    def test_fifo_and_position(self):
+        queue = InMemoryJobQueue()
+        for job_id in ['a', 'b', 'c']:
+            queue.enqueue(build_job_spec(job_id, 'inspect', ['1'], [], [], []))
+        self.assertEqual(queue.position('a'), 1)
+        self.assertEqual(queue.position('c'), 3)
+        self.assertEqual(queue.dequeue('w1', timeout=0)['job_id'], 'a')
+        self.assertEqual(queue.position('b'), 1)
+        queue.ack('a')
+        self.assertEqual(queue.status('a')['status'], JOB_COMPLETED)
+
+    def test_requeue_expired_lease(self):
+        queue = InMemoryJobQueue(lease_ttl=0.05, max_attempts=2)
+        queue.enqueue(build_job_spec('a', 'inspect', [], [], [], []))
+        queue.enqueue(build_job_spec('b', 'inspect', [], [], [], []))
+        queue.dequeue('w1', timeout=0)
+        time.sleep(0.1)
+        self.assertEqual(queue.requeue_stale(), ['a'])
+        self.assertEqual(queue.status('a')['status'], JOB_QUEUED)
+        # 重新入队的任务优先执行
+        self.assertEqual(queue.dequeue('w2', timeout=0)['job_id'], 'a')
+
+    def test_worker_runs_jobs(self):
+        done = []
+
+        class RecordingWorker(JobWorker):
+            async def run_spec(self, spec):
+                done.append(spec['job_id'])
+
+        queue = InMemoryJobQueue()
+        worker = RecordingWorker(queue, concurrency=2, poll_timeout=0.05)
+        worker.start()
+        try:
+            queue.enqueue(build_job_spec('a', 'inspect', [], [], [], []))
+            queue.enqueue(build_job_spec('b', 'config', [], [], [], []))
+            deadline = time.monotonic() + 5
+            while len(done) < 2 and time.monotonic() < deadline:
+                time.sleep(0.02)
+        finally:
+            worker.stop()
+        self.assertEqual(sorted(done), ['a', 'b'])
+        deadline = time.monotonic() + 1
+        while queue.status('b')['status'] != JOB_COMPLETED and time.monotonic() < deadline:
+            time.sleep(0.02)
+        self.assertEqual(queue.status('b')['status'], JOB_COMPLETED)
+
+class ResultSpoolTest(SimpleTestCase):
+    def test_append_and_reiterate(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            spool = ResultSpool.for_report(tmp)
+            spool.reset()
+            for i in range(3):
+                spool.append({'device': f'SW{i}', 'command': 'display version', 'result': '输出', 'status': 'success'})
+            self.assertEqual(len(spool), 3)
+            spool.close()
+            # 模板中会多次遍历结果，每次都从文件重新读取
+            self.assertEqual([item['device'] for item in spool], ['SW0', 'SW1', 'SW2'])
+            self.assertEqual(len(list(spool)), 3)
+            self.assertEqual(len(ResultSpool(os.path.join(tmp, 'results.jsonl'))), 3)
+
+    def test_skip_truncated_line(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            spool = ResultSpool.for_report(tmp)
+            spool.append({'device': 'SW0'})
+            spool.close()
+            with open(spool.path, 'a', encoding='utf-8') as f:
+                f.write('{"device": "SW1"')
+            self.assertEqual([item['device'] for item in spool], ['SW0'])
+
+class ProgressAggregatorTest(SimpleTestCase):
+    def test_coalesce_events(self):
+        frames = []
+
+        async def emit(frame):
+            frames.append(frame)
+
+        async def run():
+            progress = ProgressAggregator(emit, {'total': 10, 'completed': 0, 'completed_commands': 0}, interval=0.05, max_events=10000)
+            progress.start()
+
+            def worker(index):
+                device = f'SW{index}'
+                progress.device_status(device, DEVICE_RUNNING)
+                for _ in range(100):
+                    progress.incr('completed_commands')
+                if index == 0:
+                    progress.device_status(device, DEVICE_FAILED)
+                progress.device_status(device, DEVICE_COMPLETED)
+
+            threads = [threading.Thread(target=worker, args=(i,)) for i in range(10)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            await progress.stop()
+            return progress
+
+        progress = asyncio.run(run())
+        # 1021个事件合并为少量帧
+        self.assertEqual(progress.events, 1021)
+        self.assertLess(len(frames), 10)
+        last = frames[-1]
+        self.assertEqual(last['completed'], 10)
+        self.assertEqual(last['completed_commands'], 1000)
+        self.assertEqual(last['failed_devices'], 1)
+        statuses = {}
+        for frame in frames:
+            statuses.update(frame.get('devices', {}))
+        self.assertEqual(statuses['SW0'], DEVICE_FAILED)
+        self.assertEqual(statuses['SW1'], DEVICE_COMPLETED)
+
+class ConnectionRateLimiterTest(SimpleTestCase):
+    def test_keys(self):
+        limiter = ConnectionRateLimiter({'SUBNET_PREFIX': 24, 'SITES': {'机房A': ['10.1.0.0/16']}})
+        keys = limiter.keys_for({'ip': '10.1.2.3', 'os_type': 'hp_comware'})
+        self.assertEqual(keys, [('subnet', '10.1.2.0/24'), ('site', '机房A'), ('os_type', 'hp_comware')])
+        self.assertEqual(limiter.keys_for({'ip': 'switch.local', 'os_type': None}), [])
+
+    def test_token_bucket_per_subnet(self):
+        limiter = ConnectionRateLimiter({'SUBNET': {'*': {'RATE': 20, 'BURST': 2}}})
+        started = time.monotonic()
+        for _ in range(4):
+            with limiter.connecting({'ip': '10.1.1.1', 'os_type': 'huawei'}):
+                pass
+        # 突发2次后按每秒20次补充令牌，至少等待约0.1秒
+        self.assertGreaterEqual(time.monotonic() - started, 0.09)
+        # 其它子网不受影响
+        started = time.monotonic()
+        with limiter.connecting({'ip': '10.2.1.1', 'os_type': 'huawei'}):
+            pass
+        self.assertLess(time.monotonic() - started, 0.05)
+
+    def test_max_concurrent(self):
+        limiter = ConnectionRateLimiter({'OS_TYPE': {'hp_comware': {'MAX_CONCURRENT': 1}}})
+        device = {'ip': '10.1.1.1', 'os_type': 'hp_comware'}
+        state = {'current': 0, 'peak': 0}
+        lock = threading.Lock()
+
+        def login():
+            with limiter.connecting(device):
+                with lock:
+                    state['current'] += 1
+                    state['peak'] = max(state['peak'], state['current'])
+                time.sleep(0.02)
+                with lock:
+                    state['current'] -= 1
+
+        threads = [threading.Thread(target=login) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(state['peak'], 1)
+        self.assertEqual(limiter.stats()['acquired'], 3)
+
+class PreflightTest(SimpleTestCase):
+    def test_tcp_sweep(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(5)
+        open_port = listener.getsockname()[1]
+        closed = socket.socket()
+        closed.bind(('127.0.0.1', 0))
+        closed_port = closed.getsockname()[1]
+        closed.close()
+        try:
+            results = asyncio.run(tcp_sweep({
+                'up': ('127.0.0.1', open_port),
+                'down': ('127.0.0.1', closed_port),
+            }, timeout=1))
+        finally:
+            listener.close()
+        self.assertTrue(results['up'][0])
+        self.assertFalse(results['down'][0])
+        self.assertTrue(results['down'][1])
+
+class DeviceBudgetTest(SimpleTestCase):
+    device_info = {'name': 'SW1', 'ip': '10.0.0.1'}
+
+    def test_check_after_expiry(self):
+        budget = DeviceBudget(self.device_info, 0.05, 60)
+        budget.check('display version')
+        self.assertLessEqual(budget.command_timeout_for(), 1)
+        time.sleep(0.06)
+        with self.assertRaises(DeviceTimeout) as ctx:
+            budget.check('display interface')
+        self.assertTrue(is_timeout_error(ctx.exception))
+        self.assertFalse(is_timeout_error(ValueError('bad input')))
+
+    def test_expire_closes_connection(self):
+        class FakeConn:
+            closed = False
+
+            def disconnect(self):
+                self.closed = True
+
+        budget = DeviceBudget(self.device_info, 600, 60)
+        budget.conn = FakeConn()
+        budget.current_command = 'display logbuffer'
+        self.assertEqual(budget.expire(), 'display logbuffer')
+        self.assertTrue(budget.conn.closed)
+        self.assertTrue(budget.expired())
+
+    def test_finished_device_not_timed_out(self):
+        class FakeConn:
+            def disconnect(self):
+                pass
+
+        async def emit(frame):
+            pass
+
+        async def run():
+            job = ExecuteJob('budget', emit)
+            job.time_budget = dict(job.time_budget, DEVICE_BUDGET=0.05, GRACE=1)
+            job.progress = ProgressAggregator(emit, {'total': 2, 'completed': 0})
+            job.result_spool = mock.Mock()
+            finished = {'id': 1, 'name': 'SW1', 'ip': '10.0.0.1', 'port': 22, 'os_type': 'hp_comware', 'device_type': 'switch'}
+            running = dict(finished, id=2, name='SW2', ip='10.0.0.2')
+            job.devices = {1: finished, 2: running}
+            with mock.patch('devices.tools.execute_job.session_pool_enabled', return_value=False):
+                with job._device_session(finished, FakeConn):
+                    pass
+            job._device_budget(running)
+            await asyncio.sleep(0.1)
+            watchdog = asyncio.create_task(job._watchdog())
+            await asyncio.sleep(1.2)
+            watchdog.cancel()
+            # 任务超时时设备会话已结束的任务同样不记为超时
+            task = asyncio.create_task(asyncio.sleep(10))
+            await job._expire_job({task}, {task: '1'})
+            return job
+
+        job = asyncio.run(run())
+        records = [call.args[0] for call in job.result_spool.append.call_args_list]
+        self.assertEqual([(record['device'], record['status']) for record in records], [('SW2', 'timeout')])
+
+    def test_config_job_not_force_expired(self):
+        async def emit(frame):
+            pass
+
+        pushed = []
+
+        def push(device_id, *args):
+            # 模拟执行中的配置下发，超过任务时限后仍应执行完
+            time.sleep(0.3)
+            pushed.append(device_id)
+
+        async def run():
+            job = ConfigJob('config', emit)
+            job.scheduler = JobScheduler(max_workers=1)
+            job.current_report_id = 'config'
+            job.progress = ProgressAggregator(emit, {'total': 2, 'completed': 0})
+            job.result_spool = mock.Mock()
+            job._checkpoint_device = mock.Mock()
+            job._process_device_sync = push
+            first = {'id': 1, 'name': 'SW1', 'ip': '10.0.0.1', 'port': 22, 'os_type': 'hp_comware', 'device_type': 'switch'}
+            job.devices = {1: first, 2: dict(first, id=2, name='SW2', ip='10.0.0.2')}
+            job.job_deadline = time.monotonic() + 0.1
+            await job._run_devices(['1', '2'], [], [], [])
+            return job
+
+        job = asyncio.run(run())
+        self.assertEqual(pushed, ['1'])
+        self.assertTrue(job.timed_out)
+        records = [call.args[0] for call in job.result_spool.append.call_args_list]
+        self.assertEqual([(record['device'], record['status']) for record in records], [('SW2', 'timeout')])
+
+    def test_result_after_loop_closed(self):
+        job = ExecuteJob('closed', None)
+        job.result_spool = mock.Mock()
+        job.main_loop = asyncio.new_event_loop()
+        job.main_loop.close()
+        job.send_instant_result('SW1', '10.0.0.1', 'switch', 'hp_comware', 'display clock', 'ok', '', '')
+        job._send_error_sync('SW1命令 display clock 执行失败')
+        self.assertEqual(job.result_spool.append.call_count, 1)
+
+    def test_timeout_progress(self):
+        async def emit(frame):
+            pass
+
+        progress = ProgressAggregator(emit, {'total': 2, 'completed': 0})
+        progress.device_status('SW1', DEVICE_TIMEOUT)
+        progress.device_status('SW1', DEVICE_COMPLETED)
+        progress.device_status('SW2', DEVICE_COMPLETED)
+        counters = progress.snapshot()
+        self.assertEqual(counters['completed'], 2)
+        self.assertEqual(counters['timeout_devices'], 1)
+
+    def test_duplicate_device_names(self):
+        async def emit(frame):
+            pass
+
+        async def run():
+            job = ExecuteJob('names', emit)
+            job.progress = ProgressAggregator(emit, {'total': 2, 'completed': 0})
+            job.result_spool = mock.Mock()
+            first = {'id': 1, 'name': 'SW1', 'ip': '10.0.0.1', 'port': 22, 'os_type': 'hp_comware', 'device_type': 'switch'}
+            second = dict(first, id=2, ip='10.0.0.2')
+            job.devices = {1: first, 2: second}
+            # 两台同名设备，一台超时一台完成，都应计入completed
+            job._record_device_timeout(first)
+            job.progress.device_status(device_key(first), DEVICE_COMPLETED)
+            job.progress.device_status(device_key(second), DEVICE_COMPLETED)
+            return job
+
+        job = asyncio.run(run())
+        counters = job.progress.snapshot()
+        self.assertEqual(counters['completed'], 2)
+        self.assertEqual(counters['timeout_devices'], 1)
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class SessionProfileRegistryTest(SimpleTestCase):
+    def test_prompt_pattern(self):
+        registry = SessionProfileRegistry({'ENABLED': True, 'PROFILES': {'hp_comware': {'GLOBAL_DELAY_FACTOR': 2}}})
+        conn = type('Conn', (), {'base_prompt': 'SW-01'})()
+        kwargs = registry.command_kwargs(conn, 'hp_comware')
+        self.assertFalse(kwargs['auto_find_prompt'])
+        self.assertRegex('display clock\n10:00:00\n<SW-01>', kwargs['expect_string'])
+        self.assertRegex('[SW-01-GigabitEthernet1/0/1]', kwargs['expect_string'])
+        self.assertNotRegex('H3C Comware Software <SW-01> uptime\n', kwargs['expect_string'])
+        connect = registry.connect_kwargs({'os_type': 'huawei_yunshan', 'ip': '10.0.0.1', 'username': 'u', 'password': 'p', 'port': 22})
+        self.assertEqual(connect['device_type'], 'huawei')
+        self.assertEqual(registry.profile('hp_comware')['GLOBAL_DELAY_FACTOR'], 2)
+        self.assertEqual(registry.command_kwargs(conn, 'linux'), {})
+        # 默认不启用，保持netmiko每条命令获取提示符的行为
+        self.assertEqual(SessionProfileRegistry().command_kwargs(conn, 'hp_comware'), {})
+
+    def test_fallback_after_read_timeouts(self):
+        registry = SessionProfileRegistry({'ENABLED': True, 'FALLBACK_FAILURES': 2})
+        conn = type('Conn', (), {'base_prompt': 'R1'})()
+        registry.record_failure('cisco_ios', ReadTimeout('pattern not found'), True)
+        registry.record_success('cisco_ios', 0.2, True)
+        registry.record_failure('cisco_ios', ReadTimeout('pattern not found'), True)
+        self.assertTrue(registry.command_kwargs(conn, 'cisco_ios'))
+        registry.record_failure('cisco_ios', ReadTimeout('pattern not found'), True)
+        self.assertEqual(registry.command_kwargs(conn, 'cisco_ios'), {})
+        self.assertTrue(registry.stats()['cisco_ios']['fallback'])
+
+    def test_learned_read_timeout(self):
+        cache.clear()
+        conf = {'ENABLED': True, 'MIN_SAMPLES': 3, 'MIN_READ_TIMEOUT': 5, 'SYNC_INTERVAL': 0}
+        registry = SessionProfileRegistry(conf)
+        for latency in (1.0, 4.0):
+            registry.record_success('hp_comware', latency, True)
+        # 样本不足时使用传入的超时
+        self.assertEqual(registry.read_timeout('hp_comware', 60), 60)
+        registry.record_success('hp_comware', 2.0, True)
+        self.assertEqual(registry.read_timeout('hp_comware', 60), 12)
+        self.assertEqual(registry.read_timeout('hp_comware', 8), 8)
+        # 学习结果经缓存共享给其它进程
+        self.assertEqual(SessionProfileRegistry(conf).read_timeout('hp_comware', 60), 12)
+        configured = SessionProfileRegistry(dict(conf, PROFILES={'hp_comware': {'READ_TIMEOUT': 30}}))
+        self.assertEqual(configured.read_timeout('hp_comware', 60), 30)
+
+class BatchScriptTest(SimpleTestCase):
+    def test_demultiplex_output(self):
+        commands = ['echo hello', 'ls /nonexistent_dir', 'printf "no newline"', "echo 'unbalanced", 'cat']
+        marker = '__DM_BATCH_TEST__'
+        proc = subprocess.run(['sh', '-s'], input=build_batch_script(commands, marker).encode(), capture_output=True, env={'SHELL': '/bin/sh', 'PATH': os.environ['PATH']})
+        outputs = {}
+        for stream, data in (('stdout', proc.stdout), ('stderr', proc.stderr)):
+            parser = MarkerStream(marker)
+            events = []
+            # 按小块输入，分隔符会被拆在两次读取之间
+            for i in range(0, len(data), 5):
+                events.extend(parser.feed(data[i:i + 5]))
+            self.assertEqual([index for kind, index, _ in events if kind == 'S'], list(range(len(commands))))
+            outputs[stream] = [output.decode() for kind, _, output in events if kind == 'E']
+        self.assertEqual(outputs['stdout'][0], 'hello\n')
+        self.assertEqual(outputs['stdout'][1], '')
+        self.assertIn('nonexistent_dir', outputs['stderr'][1])
+        self.assertEqual(outputs['stdout'][2], 'no newline')
+        self.assertTrue(outputs['stderr'][3])
+        # 命令的标准输入已重定向，不会读取脚本的剩余内容
+        self.assertEqual(outputs['stdout'][4], '')
+
+    def test_read_only_commands(self):
+        self.assertTrue(is_read_only('df -h'))
+        self.assertTrue(is_read_only('ps aux | grep  nginx | wc -l'))
+        self.assertTrue(is_read_only('systemctl status sshd'))
+        self.assertFalse(is_read_only('systemctl restart sshd'))
+        self.assertFalse(is_read_only('cat /etc/hosts > /tmp/hosts'))
+        self.assertFalse(is_read_only('df -h; reboot'))
+        self.assertFalse(is_read_only('ls || rm -rf /tmp/x'))
+        self.assertFalse(is_read_only('echo $(reboot)'))
+        self.assertFalse(is_read_only('lsblkx'))
+        # 只读命令的子命令、参数或选项可能修改状态
+        for cmd in ['ip addr add 10.0.0.2/24 dev eth0', 'ip link set eth0 down', 'ip route del default', 'hostname newname',
+                    'date -s 10:00', 'mount /dev/sdb1 /mnt', 'dmesg -c', 'journalctl --vacuum-size=100M',
+                    'sort -o /tmp/out /etc/hosts', 'chronyc makestep']:
+            self.assertFalse(is_read_only(cmd), cmd)
+        # 持续输出不会结束的命令
+        for cmd in ['tail -f /var/log/messages', 'journalctl --follow', 'vmstat 1', 'top -b']:
+            self.assertFalse(is_read_only(cmd), cmd)
+        for cmd in ['ip addr', 'date "+%F %T"', 'tail -n 100 /var/log/messages', 'journalctl -u sshd -n 50 --no-pager',
+                    'sort -k2,2n -t: /etc/passwd', 'iptables -L -n --line-numbers']:
+            self.assertTrue(is_read_only(cmd), cmd)
+
+    def test_parallel_keeps_command_order(self):
+        job = ExecuteJob('parallel', None)
+        started = []
+
+        def run_command(device_info, ssh, cmd, logfile_handler, log_lock=None):
+            started.append(cmd)
+            time.sleep(0.01)
+
+        commands = ['uptime', 'df -h', 'systemctl restart sshd', 'free -m', 'uptime', 'df -h']
+        with mock.patch.object(job, '_run_generic_command', side_effect=run_command):
+            job._run_generic_parallel({'name': 'SRV1', 'ip': '10.0.0.1'}, None, commands, None)
+        # 只读命令只在连续的范围内并发，不越过修改状态的命令，重复的命令同样执行
+        self.assertEqual(sorted(started[:2]), ['df -h', 'uptime'])
+        self.assertEqual(started[2], 'systemctl restart sshd')
+        self.assertEqual(sorted(started[3:]), ['df -h', 'free -m', 'uptime'])
+
+class PlannerTest(SimpleTestCase):
+    def test_plan_from_history(self):
+        report_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(report_dir, 'inspect', 'r1'))
+        spool = ResultSpool.for_report(os.path.join(report_dir, 'inspect', 'r1'))
+        records = [
+            ('CORE1', '10.0.0.1', 'display interface', '2026-01-01 00:00:00', '2026-01-01 00:01:00', 'success'),
+            ('ACC1', '10.0.0.2', 'display interface', '2026-01-01 00:00:00', '2026-01-01 00:00:04', 'success'),
+            ('ACC2', '10.0.0.3', '-', '2026-01-01T00:00:00', '2026-01-01T00:00:00', 'timeout'),
+        ]
+        for device, ip, command, start, end, result_status in records:
+            spool.append({'device': device, 'device_ip': ip, 'os_type': 'hp_comware', 'command': command,
+                          'result': '', 'start_time': start, 'end_time': end, 'status': result_status})
+        spool.close()
+        devices = [
+            {'id': index, 'name': name, 'ip': ip, 'os_type': 'hp_comware', 'device_type': 'switch'}
+            for index, (name, ip) in enumerate([('ACC1', '10.0.0.2'), ('ACC2', '10.0.0.3'), ('ACC3', '10.0.0.4'), ('CORE1', '10.0.0.1')])
+        ]
+        with self.settings(DIR_INFO={'REPORT_DIR': report_dir}, CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+            plan = plan_job(devices, [], [], ['display interface'], concurrency=2)
+        # CORE1按自身历史，ACC3按同os_type同命令的历史
+        self.assertEqual(plan['dispatch_order'][0], 3)
+        self.assertEqual(plan['devices'][0]['source'], 'history')
+        self.assertEqual([item['name'] for item in plan['slow_devices']], ['ACC2'])
+        self.assertLessEqual(plan['estimated_seconds'], plan['unordered_seconds'])
+        self.assertEqual(simulate_makespan([5, 3, 3, 2], 2), 7)
+
+    def test_sub_second_durations_from_timings(self):
+        report_dir = tempfile.mkdtemp()
+        execute_dir = os.path.join(report_dir, 'inspect', 'r1')
+        os.makedirs(execute_dir)
+        spool = ResultSpool.for_report(execute_dir)
+        for command in ['display clock', 'display version']:
+            # 结果中的时间只精确到秒
+            spool.append({'device': 'SW1', 'device_ip': '10.0.0.1', 'os_type': 'hp_comware', 'command': command, 'result': '',
+                          'start_time': '2026-01-01 00:00:00', 'end_time': '2026-01-01 00:00:00', 'status': 'success'})
+        spool.close()
+        collector = TimingCollector()
+        timer = collector.device({'name': 'SW1', 'ip': '10.0.0.1', 'os_type': 'hp_comware'})
+        timer.command('display clock', 0.1, 0.05)
+        timer.command('display version', 0.3, 0.1)
+        collector.save(execute_dir, 'r1')
+        with self.settings(DIR_INFO={'REPORT_DIR': report_dir}, CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+            cache.clear()
+            history = load_history('inspect')
+        self.assertAlmostEqual(history['device_command'][('SW1@10.0.0.1', 'display clock')], 0.15)
+        self.assertAlmostEqual(history['os_type']['hp_comware'], 0.275)
+
+    def test_dispatch_longest_first(self):
+        job = ExecuteJob('lpt', None)
+        job.devices = {
+            1: {'id': 1, 'name': 'ACC1', 'ip': '10.0.0.2', 'os_type': 'hp_comware', 'device_type': 'switch'},
+            2: {'id': 2, 'name': 'SRV1', 'ip': '10.0.1.1', 'os_type': 'linux', 'device_type': 'server'},
+            3: {'id': 3, 'name': 'CORE1', 'ip': '10.0.0.1', 'os_type': 'hp_comware', 'device_type': 'switch'},
+        }
+        history = {'device_command': {('CORE1@10.0.0.1', 'display interface'): 60}, 'os_type_command': {},
+                   'os_type': {}, 'timeouts': {}, 'reports': 1}
+        with mock.patch('devices.tools.execute_job.load_history', return_value=history):
+            order = job._dispatch_order_sync(['1', '2', '3'], [], ['uptime'], ['display interface', 'display version'])
+        # CORE1按历史耗时最长；ACC1两条命令按默认耗时，长于只有一条命令的SRV1
+        self.assertEqual(order, ['3', '1', '2'])
+
+
+class TimingCollectorTest(SimpleTestCase):
+    def test_phase_percentiles_by_os_type(self):
+        collector = TimingCollector()
+        for index in range(10):
+            timer = collector.device({'name': f"SW{index}", 'ip': f"10.0.0.{index}", 'os_type': 'hp_comware'})
+            timer.add(PHASE_TCP_CONNECT, 0.01 * (index + 1))
+            timer.command('display version', 1.0 + index, 0.5)
+        collector.device({'name': 'SRV1', 'ip': '10.0.1.1', 'os_type': 'linux'}).command('uptime', 0.2, 0.1)
+        # 同一设备多次获取为同一计时器，阶段耗时累加
+        collector.device({'name': 'SW0', 'ip': '10.0.0.0', 'os_type': 'hp_comware'}).command('display clock', 1.0)
+
+        report_dir = tempfile.mkdtemp()
+        collector.save(report_dir, 'r1')
+        timings = load_timings(report_dir)
+        comware = timings['os_types']['hp_comware']
+        self.assertEqual(comware['devices'], 10)
+        self.assertEqual(comware['phases'][PHASE_TCP_CONNECT]['p50'], 0.05)
+        self.assertEqual(comware['phases'][PHASE_EXEC]['max'], 10.0)
+        self.assertEqual(comware['phases'][PHASE_TRANSFER]['count'], 10)
+        self.assertEqual(comware['command']['count'], 11)
+        self.assertEqual(sum(count for _, count in comware['phases'][PHASE_EXEC]['histogram']), 10)
+        self.assertEqual(timings['os_types']['linux']['phases'][PHASE_EXEC]['p99'], 0.2)
+        self.assertEqual(percentile([1, 2, 3, 4], 50), 2)
+        self.assertIsNone(load_timings(tempfile.mkdtemp()))
+
+    def test_network_connect_phase(self):
+        job = ExecuteJob('timing', None)
+        device_info = {'id': 1, 'name': 'SW1', 'ip': '10.0.0.1', 'port': 22, 'username': 'u', 'password': 'p',
+                       'os_type': 'hp_comware', 'device_type': 'switch'}
+        conn = mock.Mock(spec=['disconnect', 'disable_paging', 'find_prompt'])
+        with mock.patch('devices.tools.execute_job.ConnectHandler', return_value=conn) as connect:
+            self.assertIs(job._open_network_connection(device_info), conn)
+        # 只使用netmiko的公开接口，建连整体计时
+        self.assertNotIn('sock', connect.call_args.kwargs)
+        self.assertIn(PHASE_CONNECT, job.timings.device(device_info).phases)
+
+    def test_generic_connect_phases(self):
+        job = ExecuteJob('timing', None)
+        device_info = {'id': 1, 'name': 'SRV1', 'ip': '127.0.0.1', 'port': 22, 'username': 'u', 'password': 'p',
+                       'os_type': 'linux', 'device_type': 'server'}
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        device_info['port'] = listener.getsockname()[1]
+        client = mock.Mock(spec=['set_missing_host_key_policy', 'connect', 'close'])
+        try:
+            with mock.patch('devices.tools.execute_job.paramiko.SSHClient', return_value=client):
+                self.assertIs(job._open_generic_connection(device_info), client)
+        finally:
+            client.connect.call_args.kwargs['sock'].close()
+            listener.close()
+        # 只通过公开的sock参数拆分TCP建连，不替换paramiko的内部方法
+        self.assertEqual(set(job.timings.device(device_info).phases), {PHASE_TCP_CONNECT, PHASE_SSH_HANDSHAKE})
+
+
+class ShardingTest(SimpleTestCase):
+    def test_split_round_robin(self):
+        self.assertEqual(split_shards(['1', '2', '3', '4', '5'], 2), [['1', '3', '5'], ['2', '4']])
+        self.assertEqual(split_shards(['1'], 4), [['1']])
+
+    def test_cancel_queued_shard(self):
+        queue = InMemoryJobQueue()
+        queue.enqueue(build_job_spec('job-1', 'inspect', ['1'], [], [], []))
+        queue.enqueue(build_job_spec('job-2', 'inspect', ['2'], [], [], []))
+        self.assertEqual(queue.dequeue('w', timeout=0)['job_id'], 'job-1')
+        self.assertFalse(queue.cancel('job-1'))
+        self.assertTrue(queue.cancel('job-2'))
+        self.assertEqual(queue.status('job-2')['status'], JOB_CANCELLED)
+        self.assertIsNone(queue.dequeue('w', timeout=0))
+
+    def test_merge_shard_events(self):
+        async def emit(event):
+            emitted.append(event)
+
+        async def run():
+            job = ExecuteJob('job', emit)
+            job.devices = {1: {'id': 1, 'name': 'SRV1', 'ip': '10.0.0.1', 'os_type': 'linux', 'device_type': 'server'}}
+            job.reports['job'] = {'items': {}}
+            job.result_spool = mock.Mock()
+            job.progress = ProgressAggregator(emit, {'total': 1, 'completed': 0, 'completed_commands': 0})
+            coordinator = ShardCoordinator(job, 2, None, {})
+            coordinator.shards[1] = {'job_id': 'job-1', 'device_ids': ['1'], 'worker': '', 'status': 'queued', 'done': False}
+            record = {'device': 'SRV1', 'device_ip': '10.0.0.1', 'os_type': 'linux', 'command': 'uptime', 'result': 'up',
+                      'start_time': '', 'end_time': '', 'status': 'success'}
+            await coordinator.handle({'type': 'shard.started', 'shard': 1, 'worker': 'node2'})
+            await coordinator.handle({'type': 'progress.update', 'shard': 1, 'completed_commands': 1, 'devices': {'SRV1(10.0.0.1)': 'running'}})
+            await coordinator.handle({'type': 'progress.update', 'shard': 1, 'completed': 1, 'completed_commands': 1, 'devices': {'SRV1(10.0.0.1)': 'completed'}})
+            # 分片重新投递后重复的结果只写入一次
+            await coordinator.handle({'type': 'shard.records', 'shard': 1, 'records': [record]})
+            await coordinator.handle({'type': 'shard.records', 'shard': 1, 'records': [record]})
+            await coordinator.handle({'type': 'shard.done', 'shard': 1, 'status': 'completed',
+                                      'items': {'linux': {'commands': ['uptime'], 'devices': ['SRV1']}}, 'timings': []})
+            await job.progress.flush()
+            return job, coordinator
+
+        emitted = []
+        job, coordinator = asyncio.run(run())
+        self.assertEqual(job.result_spool.append.call_count, 1)
+        self.assertEqual(job.progress.snapshot(), {'total': 1, 'completed': 1, 'completed_commands': 1})
+        self.assertEqual(job.reports['job']['items']['linux']['devices'], ['SRV1'])
+        self.assertTrue(coordinator._all_done.is_set())
+        results = [event for event in emitted if event['type'] == 'command.result']
+        self.assertEqual(results[0]['device_type'], 'server')
+        self.assertEqual([event for event in emitted if event['type'] == 'progress.update'][-1]['devices'], {'SRV1(10.0.0.1)': 'completed'})
+
+    def _coordinator(self, emit, device_count):
+        job = ExecuteJob('job', emit)
+        job.devices = {
+            index: {'id': index, 'name': f"SRV{index}", 'ip': f"10.0.0.{index}", 'os_type': 'linux', 'device_type': 'server'}
+            for index in range(1, device_count + 1)
+        }
+        job.reports['job'] = {'items': {}}
+        job.result_spool = mock.Mock()
+        job.progress = ProgressAggregator(emit, {'total': device_count, 'completed': 0, 'completed_commands': 0})
+        coordinator = ShardCoordinator(job, 2, None, {})
+        coordinator.shards[1] = {'job_id': 'job-1', 'device_ids': [str(index) for index in job.devices],
+                                 'worker': '', 'status': 'queued', 'done': False}
+        return job, coordinator
+
+    def test_expire_only_unreported_devices(self):
+        async def emit(event):
+            pass
+
+        async def run():
+            job, coordinator = self._coordinator(emit, 3)
+            record = {'device': 'SRV1', 'device_ip': '10.0.0.1', 'os_type': 'linux', 'command': 'uptime', 'result': 'up',
+                      'start_time': '', 'end_time': '', 'status': 'success'}
+            await coordinator.handle({'type': 'shard.started', 'shard': 1, 'worker': 'node2'})
+            await coordinator.handle({'type': 'shard.records', 'shard': 1, 'records': [record]})
+            # SRV2连接失败，没有结果
+            await coordinator.handle({'type': 'progress.update', 'shard': 1, 'completed': 1, 'failed_devices': 1,
+                                      'devices': {'SRV2(10.0.0.2)': 'failed'}})
+            coordinator._expire_unfinished()
+            return job
+
+        job = asyncio.run(run())
+        records = [call.args[0] for call in job.result_spool.append.call_args_list]
+        self.assertEqual([(record['device'], record['status']) for record in records], [('SRV1', 'success'), ('SRV3', 'timeout')])
+        self.assertEqual(job.progress.snapshot()['timeout_devices'], 1)
+
+
+    def test_redelivered_shard_progress(self):
+        async def emit(event):
+            pass
+
+        async def run():
+            job, coordinator = self._coordinator(emit, 2)
+            for worker in ['node2', 'node3']:
+                # node2异常退出后分片重新投递给node3，计数从0开始
+                await coordinator.handle({'type': 'shard.started', 'shard': 1, 'worker': worker})
+                await coordinator.handle({'type': 'progress.update', 'shard': 1, 'completed': 1, 'completed_commands': 2})
+            await coordinator.handle({'type': 'progress.update', 'shard': 1, 'completed': 2, 'completed_commands': 4})
+            return job
+
+        job = asyncio.run(run())
+        self.assertEqual(job.progress.snapshot(), {'total': 2, 'completed': 2, 'completed_commands': 4})
+
+
+class JobCheckpointTest(SimpleTestCase):
+    def test_record_and_load(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            checkpoint = JobCheckpoint(tmp)
+            device = {'name': 'SW1', 'ip': '10.0.0.1', 'os_type': 'comware'}
+            checkpoint.record(1, DEVICE_FAILED)
+            checkpoint.record(1, DEVICE_COMPLETED, device, ['display version'])
+            checkpoint.close()
+            # 进程中断时写了一半的行忽略
+            with open(checkpoint.path, 'a', encoding='utf-8') as f:
+                f.write('{"device_id": "2", "sta')
+            finished = JobCheckpoint(tmp).load()
+            self.assertEqual(list(finished), ['1'])
+            self.assertEqual(finished['1']['status'], DEVICE_COMPLETED)
+            self.assertEqual(finished['1']['commands'], ['display version'])
+            checkpoint.reset()
+            self.assertEqual(JobCheckpoint(tmp).load(), {})
+
+    def test_retain_finished_results(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            spool = ResultSpool.for_report(tmp)
+            spool.append({'device': 'SW1', 'device_ip': '10.0.0.1', 'command': 'a'})
+            spool.append({'device': 'SW2', 'device_ip': '10.0.0.2', 'command': 'a'})
+            spool.append({'device': 'SW1', 'device_ip': '10.0.0.1', 'command': 'b'})
+            self.assertEqual(retain_finished_results(spool, {('SW1', '10.0.0.1')}), 2)
+            self.assertEqual([record['command'] for record in ResultSpool.for_report(tmp)], ['a', 'b'])
+
+
+class ReportEnvironmentTest(SimpleTestCase):
+    def test_template_reused_until_modified(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            template_dir = os.path.join(tmp, 'devices/conf/template')
+            os.makedirs(template_dir)
+            path = os.path.join(template_dir, REPORT_TEMPLATE)
+            with open(path, 'w') as f:
+                f.write('v1 {{ meta }}')
+            with override_settings(BASE_DIR=tmp):
+                env = build_report_environment(os.path.join(tmp, 'cache'))
+                template = env.get_template(REPORT_TEMPLATE)
+                self.assertIs(env.get_template(REPORT_TEMPLATE), template)
+                with open(path, 'w') as f:
+                    f.write('v2 {{ meta }}')
+                os.utime(path, (time.time() + 10, time.time() + 10))
+                self.assertEqual(env.get_template(REPORT_TEMPLATE).render(meta='x'), 'v2 x')
+                # 字节码缓存供新建的环境使用
+                self.assertTrue(os.listdir(os.path.join(tmp, 'cache')))
+
+    def test_generator_singleton(self):
+        generator = get_report_generator()
+        self.assertIs(get_report_generator(), generator)
+        self.assertFalse(generator.logger.handlers)
+
+    def test_stream_gzip_report(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            spool = ResultSpool.for_report(tmp)
+            for index in range(1000):
+                spool.append({'device': f"SW{index}", 'result': 'x' * 100})
+            spool.close()
+            template = Template('{% for res in results %}{{ res.device }}:{{ res.result }}\n{% endfor %}')
+            report_dir = os.path.join(tmp, 'inspect')
+            os.makedirs(report_dir)
+            with override_settings(EXECUTE_CONFIG={'REPORT': {'GZIP': True, 'WRITE_BUFFER': 4096}}, DIR_INFO={'REPORT_DIR': tmp}):
+                path = get_report_generator()._write_output_file(report_dir, 'r1', template, {'results': spool})
+                self.assertEqual(path.name, 'index.html.gz')
+                with gzip.open(path, 'rt', encoding='utf-8') as f:
+                    lines = f.read().splitlines()
+                self.assertEqual(len(lines), 1000)
+                self.assertEqual(lines[-1], f"SW999:{'x' * 100}")
+                # 不支持gzip的客户端收到解压后的内容
+                response = report_file_response(RequestFactory().get('/'), ['inspect'], 'r1')
+                self.assertFalse(response.has_header('Content-Encoding'))
+                self.assertEqual(b''.join(response.streaming_content).decode().splitlines()[0], f"SW0:{'x' * 100}")
+                response = report_file_response(RequestFactory().get('/', HTTP_ACCEPT_ENCODING='gzip'), ['inspect'], 'r1')
+                self.assertEqual(response['Content-Encoding'], 'gzip')
+
+    def test_write_stream_buffers_chunks(self):
+        out = mock.Mock()
+        self.assertEqual(write_stream(out, ['ab', 'cd', 'e'], 3), 5)
+        self.assertEqual([call.args[0] for call in out.write.call_args_list], ['abcd', 'e'])
+
+
+class ReportDeviceResolutionTest(TestCase):
+    def test_resolve_devices_in_one_query(self):
+        devices = [
+            Device.objects.create(name=f"SW{index}", ip_address='10.0.0.1', username='u', password='p', device_type='switch')
+            for index in range(3)
+        ]
+        device_ids = [str(device.id) for device in devices]
+        deleted_id = devices[-1].id
+        devices[-1].delete()
+        with self.assertNumQueries(1):
+            resolved = get_report_generator()._resolve_devices(device_ids + [''])
+        self.assertEqual([device['name'] for device in resolved[:2]], ['SW0', 'SW1'])
+        self.assertEqual(resolved[2], {'name': f"设备{deleted_id}（已删除）", 'type': '', 'status': 'deleted'})
+
+
+class ExecuteJobPrefetchTest(TestCase):
+    def test_mixed_id_types(self):
+        comware = OSType.objects.create(name='hp_comware')
+        linux = OSType.objects.create(name='linux')
+        switch = Device.objects.create(name='SW1', ip_address='10.0.0.1', username='u', password='p', device_type='switch', os_type='hp_comware')
+        server = Device.objects.create(name='SRV1', ip_address='10.0.1.1', username='u', password='p', device_type='server', os_type='linux')
+        display = Command.objects.create(command_text='display version', os_type=comware)
+        uptime = Command.objects.create(command_text='uptime', os_type=linux)
+        # 前端提交的ID为字符串，任务队列中的ID可能为整数，含已删除的设备及命令
+        device_ids = [str(switch.id), server.id, '99999']
+        command_ids = [display.id, str(uptime.id), '99998']
+        job = ExecuteJob('prefetch', None)
+        with self.assertNumQueries(2):
+            job._prefetch_sync(device_ids, command_ids)
+        with self.assertNumQueries(0):
+            switch_info = job._get_device_credentials_sync(device_ids[0])
+            server_info = job._get_device_credentials_sync(str(server.id))
+            self.assertEqual(sorted(job._resolve_commands_sync(switch_info, command_ids, [], ['display clock'])),
+                             ['display clock', 'display version'])
+            self.assertEqual(sorted(job._resolve_commands_sync(server_info, command_ids, ['df -h'], [])), ['df -h', 'uptime'])
+        self.assertEqual((switch_info['name'], server_info['name']), ('SW1', 'SRV1'))
+        self.assertEqual(sorted(job.devices), [switch.id, server.id])
+        with self.assertRaises(RuntimeError):
+            job._get_device_credentials_sync('99999')
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class TextFSMPipelineTest(SimpleTestCase):
+    template = 'Value NAME (\\S+)\nValue STATE (up|down)\n\nStart\n  ^${NAME}\\s+${STATE} -> Record\n'
+
+    def _run(self, workers):
+        with tempfile.TemporaryDirectory() as tmp:
+            os.makedirs(os.path.join(tmp, 'textfsm'))
+            with open(os.path.join(tmp, 'textfsm', 'hp_comware_display_interface.textfsm'), 'w') as f:
+                f.write(self.template)
+            results = [
+                {'device': f"SW{index}", 'device_ip': '10.0.0.1', 'os_type': 'hp_comware', 'command': 'display interface',
+                 'result': f"GE1/0/{index} up\nGE1/0/{index + 100} down\n", 'status': 'success'}
+                for index in range(5)
+            ]
+            results.append({'device': 'SW9', 'os_type': 'hp_comware', 'command': 'display interface', 'result': '', 'status': 'timeout'})
+            results.append({'device': 'SW9', 'os_type': 'hp_comware', 'command': 'display clock', 'result': 'x', 'status': 'success'})
+            written = []
+            with override_settings(DIR_INFO={'CONF_DIR': tmp, 'REPORT_DIR': tmp}):
+                stats = TextFSMPipeline(lambda *args: written.append(args), workers=workers, chunk_size=2, min_results=0).run(results)
+            return written, stats
+
+    def test_serial_and_process_pool_agree(self):
+        serial, stats = self._run(0)
+        self.assertEqual(stats['mode'], 'serial')
+        self.assertEqual((stats['results'], stats['parsed'], stats['rows'], stats['chunks']), (6, 5, 10, 3))
+        self.assertEqual(serial[0][2:], ([['GE1/0/0', 'up'], ['GE1/0/100', 'down']], ['NAME', 'STATE'],
+                                         {'device_name': 'SW0', 'device_ip': '10.0.0.1', 'update_time': serial[0][4]['update_time']}))
+        parallel, stats = self._run(2)
+        self.assertEqual(stats['mode'], 'process')
+        self.assertEqual([args[:4] for args in parallel], [args[:4] for args in serial])
+
+
+class TemplateCacheTest(SimpleTestCase):
+    template = 'Value Filldown VLAN (\\d+)\nValue List PORTS (\\S+)\n\nStart\n  ^vlan ${VLAN}\n  ^ port ${PORTS}\n  ^end -> Record\n'
+    output = 'vlan 10\n port GE1/0/1\n port GE1/0/2\nend\n port GE1/0/3\nend\n'
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'hp_comware_display_vlan.textfsm')
+        with open(self.path, 'w') as f:
+            f.write(self.template)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_clone_matches_fresh_template(self):
+        cache = TemplateCache()
+        expected = textfsm.TextFSM(io.StringIO(self.template)).ParseText(self.output)
+        first, hit = cache.fetch(self.path)
+        self.assertFalse(hit)
+        # 副本的Filldown、List状态互不影响
+        self.assertEqual(first.ParseText(self.output), expected)
+        second, hit = cache.fetch(self.path)
+        self.assertTrue(hit)
+        self.assertEqual(second.ParseText(self.output), expected)
+        self.assertEqual(first.ParseText(self.output), expected + expected)
+        self.assertEqual(cache.get_text(self.template).ParseText(self.output), expected)
+
+    def test_invalidate_on_change_and_eviction(self):
+        cache = TemplateCache(max_size=1)
+        cache.get(self.path)
+        with open(self.path, 'w') as f:
+            f.write(self.template.replace('PORTS', 'PORT'))
+        os.utime(self.path, ns=(0, 0))
+        self.assertEqual(cache.get(self.path).header, ['VLAN', 'PORT'])
+        cache.invalidate(self.path)
+        cache.get(self.path)
+        cache.get_text(self.template)
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['invalidations'], stats['evictions'], stats['size']), (0, 4, 2, 1, 1))
@@ -0,0 +1,212 @@
+import re
+import time
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+
+from django.conf import settings
+
+from devices.tools.rate_limit import get_rate_limiter
+
+# asyncssh为可选依赖，未安装时巡检回退到线程引擎
+try:
+    import asyncssh
+except ImportError:
+    asyncssh = None
+
+logger = logging.getLogger('devices.async_engine')
+
+NETWORK_DEVICE_TYPES = ['switch', 'router', 'firewall']
+
+# 各os_type关闭分页的命令
+DISABLE_PAGING_COMMANDS = {
+    'hp_comware': 'screen-length disable',
+    'huawei': 'screen-length 0 temporary',
+    'huawei_vrp': 'screen-length 0 temporary',
+    'huawei_yunshan': 'screen-length 0 temporary',
+    'cisco_ios': 'terminal length 0',
+    'cisco_nxos': 'terminal length 0',
+    'cisco_xe': 'terminal length 0',
+    'ruijie_os': 'terminal length 0',
+}
+
+# 提示符：<H3C>、[HUAWEI-GigabitEthernet0/0/1]、Switch#、router> 等
+PROMPT_PATTERN = re.compile(r'^[<\[]?[\w\-.:/@~()]+[>\]#$]\s*$')
+# 分页提示：---- More ----、--More--
+MORE_PATTERN = re.compile(r'-+\s*More\s*-+\s*$', re.IGNORECASE)
+ANSI_PATTERN = re.compile(r'\x1b\[[0-9;?]*[A-Za-z]')
+
+
+def async_engine_available():
+    return asyncssh is not None
+
+
+def _normalize(text):
+    return ANSI_PATTERN.sub('', text).replace('\r\n', '\n').replace('\r', '')
+
+
+class ExecSession:
+    """服务器会话，每条命令通过exec通道执行"""
+
+    def __init__(self, conn, logfile, command_timeout):
+        self.conn = conn
+        self.logfile = logfile
+        self.command_timeout = command_timeout
+
+    async def open(self):
+        return self
+
+    async def run(self, cmd):
+        result = await self.conn.run(cmd, check=False, timeout=self.command_timeout)
+        output = result.stdout or result.stderr or ''
+        self.logfile.write(f"Command: {cmd}\n{output}\n")
+        self.logfile.flush()
+        return output
+
+
+class NetworkShellSession:
+    """网络设备会话，在交互式shell中按提示符分隔命令输出"""
+
+    def __init__(self, conn, os_type, logfile, command_timeout):
+        self.conn = conn
+        self.os_type = os_type or ''
+        self.logfile = logfile
+        self.command_timeout = command_timeout
+        self.process = None
+        self.prompt = ''
+        self.hostname = ''
+
+    async def open(self):
+        self.process = await self.conn.create_process(term_type='vt100', term_size=(511, 200))
+        self.process.stdin.write('\n')
+        output = await self._read_until_prompt(any_prompt=True)
+        self.prompt = output.rstrip().split('\n')[-1].strip()
+        self.hostname = self.prompt.strip('<>[]#$ ').split('-')[0]
+        paging_command = DISABLE_PAGING_COMMANDS.get(self.os_type)
+        if paging_command is None and 'huawei' in self.os_type:
+            paging_command = DISABLE_PAGING_COMMANDS['huawei']
+        if paging_command:
+            await self.run(paging_command)
+        return self
+
+    async def run(self, cmd):
+        self.process.stdin.write(cmd + '\n')
+        output = await self._read_until_prompt()
+        lines = output.split('\n')
+        # 去掉命令回显和结尾的提示符
+        if lines and cmd.strip() and cmd.strip() in lines[0]:
+            lines = lines[1:]
+        if lines and self._is_prompt(lines[-1]):
+            lines = lines[:-1]
+        return '\n'.join(lines)
+
+    def _is_prompt(self, line, any_prompt=False):
+        line = line.strip()
+        if not PROMPT_PATTERN.match(line):
+            return False
+        return any_prompt or not self.hostname or self.hostname in line
+
+    async def _read_until_prompt(self, any_prompt=False):
+        buffer = ''
+        deadline = time.monotonic() + self.command_timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise asyncio.TimeoutError(f"等待提示符超时，已接收内容: {buffer[-200:]}")
+            chunk = await asyncio.wait_for(self.process.stdout.read(65535), remaining)
+            if not chunk:
+                raise ConnectionError("会话已关闭")
+            self.logfile.write(chunk)
+            buffer += _normalize(chunk)
+            if MORE_PATTERN.search(buffer):
+                buffer = MORE_PATTERN.sub('', buffer)
+                self.process.stdin.write(' ')
+                continue
+            last_line = buffer.rstrip('\n').split('\n')[-1] if buffer.strip() else ''
+            if buffer.endswith(('\n', ' ', '>', ']', '#', '$')) and self._is_prompt(last_line, any_prompt):
+                self.logfile.flush()
+                return buffer.strip('\n')
+
+
+class AsyncSSHEngine:
+    """
+    基于asyncssh的协程执行引擎
+    设备会话以协程方式运行在事件循环上，不占用工作线程，单个daphne进程即可同时驱动上千台设备
+    """
+
+    def __init__(self, max_concurrency=1000, connect_timeout=20, command_timeout=60):
+        self.max_concurrency = max_concurrency
+        self.connect_timeout = connect_timeout
+        self.command_timeout = command_timeout
+        self._semaphore = None
+        self._loop = None
+
+    @classmethod
+    def from_settings(cls):
+        conf = getattr(settings, 'EXECUTE_CONFIG', {}).get('ASYNC_ENGINE', {})
+        return cls(
+            max_concurrency=conf.get('MAX_CONCURRENCY', 1000),
+            connect_timeout=conf.get('CONNECT_TIMEOUT', 20),
+            command_timeout=conf.get('COMMAND_TIMEOUT', 60),
+        )
+
+    def _get_semaphore(self):
+        loop = asyncio.get_running_loop()
+        if self._semaphore is None or self._loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._loop = loop
+        return self._semaphore
+
+    @asynccontextmanager
+    async def session(self, device_info, session_log):
+        """
+        建立设备会话
+        :param device_info: 设备信息，见BaseexecuteConsumer._get_device_credentials_sync
+        :param session_log: 会话日志文件路径
+        """
+        if asyncssh is None:
+            raise RuntimeError("未安装asyncssh，无法使用异步执行引擎")
+        async with self._get_semaphore():
+            # 建连前按子网/os_type/站点限速，登录完成后释放同时登录数
+            async with get_rate_limiter().connecting_async(device_info):
+                started = time.monotonic()
+                conn = await asyncio.wait_for(
+                    asyncssh.connect(
+                        device_info['ip'],
+                        port=int(device_info['port'] or 22),
+                        username=device_info['username'],
+                        password=device_info['password'],
+                        known_hosts=None
+                    ),
+                    self.connect_timeout
+                )
+                connect_time = time.monotonic() - started
+            logfile = open(session_log, 'a', encoding='utf-8')
+            try:
+                if device_info['device_type'] in NETWORK_DEVICE_TYPES:
+                    session = NetworkShellSession(conn, device_info['os_type'], logfile, self.command_timeout)
+                else:
+                    session = ExecSession(conn, logfile, self.command_timeout)
+                session.connect_time = connect_time # 建连耗时（不含限速等待）
+                opened = time.monotonic()
+                await session.open()
+                session.open_time = time.monotonic() - opened # 打开会话、获取提示符及关闭分页的耗时
+                yield session
+            finally:
+                logfile.close()
+                conn.close()
+                try:
+                    await asyncio.wait_for(conn.wait_closed(), 5)
+                except Exception as e:
+                    logger.debug(f"关闭会话{device_info['ip']}失败: {str(e)}")
+
+
+_async_engine = None
+
+
+def get_async_engine():
+    """获取进程级异步引擎单例"""
+    global _async_engine
+    if _async_engine is None:
+        _async_engine = AsyncSSHEngine.from_settings()
+    return _async_engine
@@ -0,0 +1,143 @@
+import os
+import json
+import time
+import logging
+from threading import Lock
+
+from django.core.cache import cache
+
+from devices.tools.result_spool import ResultSpool
+
+logger = logging.getLogger('devices.checkpoint')
+
+CHECKPOINT_FILE = 'checkpoint.jsonl'
+INDEX_FILE = 'index.json'
+RUNNING_KEY = 'execute_running:{}' # 任务执行中的心跳，避免对仍在执行的任务重复续跑
+RUNNING_TTL = 60 # 心跳过期时间（秒）
+
+# 任务记录（index.json）中的状态
+STATUS_RUNNING = 'running'
+
+
+class JobCheckpoint:
+    """
+    任务检查点（JSON Lines，每台设备执行结束后追加一行）
+    进程中断后续跑同一任务时，已结束的设备不再执行，其报告信息（items）从检查点恢复
+    """
+
+    def __init__(self, execute_dir):
+        self.path = os.path.join(execute_dir, CHECKPOINT_FILE)
+        self._lock = Lock()
+        self._file = None
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def record(self, device_id, status, device_info=None, commands=None):
+        """
+        记录一台设备执行结束，可在任意线程中调用
+        :param commands: 设备写入报告items的命令列表，设备未生成报告信息（如连接失败）时为None
+        """
+        entry = {'device_id': str(device_id), 'status': status, 'time': time.time(), 'commands': commands}
+        if device_info is not None:
+            entry.update(name=device_info['name'], ip=device_info['ip'], os_type=device_info['os_type'])
+        line = json.dumps(entry, ensure_ascii=False) + '\n'
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, 'a', encoding='utf-8')
+            self._file.write(line)
+            self._file.flush()
+
+    def load(self):
+        """读取已结束的设备 {设备ID: 检查点}，同一设备以最后一行为准"""
+        finished = {}
+        if not self.exists():
+            return finished
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # 进程中断时最后一行可能不完整
+                    continue
+                finished[entry['device_id']] = entry
+        return finished
+
+    def reset(self):
+        with self._lock:
+            self._close_locked()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    def close(self):
+        with self._lock:
+            self._close_locked()
+
+    def _close_locked(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def read_index(execute_dir):
+    """读取任务记录，不存在或无法解析时返回None"""
+    path = os.path.join(execute_dir, INDEX_FILE)
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_index(execute_dir, record):
+    """写入任务记录，先写临时文件再替换，中断时不会留下不完整的index.json"""
+    path = os.path.join(execute_dir, INDEX_FILE)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(json.dumps(record))
+    os.replace(tmp_path, path)
+
+
+def retain_finished_results(spool, finished_devices):
+    """
+    续跑前清理结果文件：只保留已结束设备的结果，未结束设备中断前写入的部分结果会在续跑时重新生成
+    :param finished_devices: 已结束设备的(名称, IP)集合
+    """
+    if not spool:
+        return 0
+    tmp = ResultSpool(f"{spool.path}.tmp")
+    tmp.reset()
+    kept = 0
+    for record in spool:
+        if (record.get('device'), record.get('device_ip')) in finished_devices:
+            tmp.append(record)
+            kept += 1
+    tmp.close()
+    spool.close()
+    os.replace(tmp.path, spool.path)
+    return kept
+
+
+def mark_running(report_id):
+    """执行中的任务定期刷新心跳"""
+    try:
+        cache.set(RUNNING_KEY.format(report_id), time.time(), RUNNING_TTL)
+    except Exception as e:
+        logger.warning(f"刷新任务{report_id}心跳失败: {str(e)}")
+
+
+def clear_running(report_id):
+    try:
+        cache.delete(RUNNING_KEY.format(report_id))
+    except Exception as e:
+        logger.warning(f"清除任务{report_id}心跳失败: {str(e)}")
+
+
+def is_running(report_id):
+    return cache.get(RUNNING_KEY.format(report_id)) is not None
+
+
+def resumable(execute_dir, report_id):
+    """任务是否可以续跑：任务记录为执行中且没有进程在执行"""
+    index = read_index(execute_dir)
+    return bool(index) and index.get('status') == STATUS_RUNNING and not is_running(report_id)
@@ -0,0 +1,125 @@
+import time
+import socket
+import logging
+from statistics import median
+from threading import Lock
+
+from django.conf import settings
+
+logger = logging.getLogger('devices.concurrency')
+
+# 连接失败类型，auth/timeout/reset视为AAA服务器或链路过载的信号
+ERROR_AUTH = 'auth'
+ERROR_TIMEOUT = 'timeout'
+ERROR_RESET = 'reset'
+ERROR_OTHER = 'other'
+CONGESTION_ERRORS = (ERROR_AUTH, ERROR_TIMEOUT, ERROR_RESET)
+
+
+def classify_error(exc):
+    """按异常类型及消息判断连接失败的原因"""
+    name = type(exc).__name__.lower()
+    message = str(exc).lower()
+    if 'auth' in name or 'permissiondenied' in name or 'authentication' in message:
+        return ERROR_AUTH
+    if isinstance(exc, (socket.timeout, TimeoutError)) or 'timeout' in name or 'timed out' in message or 'timeout' in message:
+        return ERROR_TIMEOUT
+    if isinstance(exc, (ConnectionResetError, BrokenPipeError, EOFError)) or 'reset' in message or 'closed' in message:
+        return ERROR_RESET
+    return ERROR_OTHER
+
+
+class AdaptiveConcurrency:
+    """
+    AIMD并发控制器
+    每收集window个设备的建连结果评估一次：认证失败、超时、连接重置的比例不超过failure_threshold，
+    且建连耗时中位数不超过基线的latency_factor倍时，并发数加increase；否则乘以decrease_factor。
+    并发数变化记录在history中，随报告保存。
+    """
+
+    def __init__(self, initial=20, minimum=2, maximum=50, window=10, increase=1,
+                 decrease_factor=0.5, failure_threshold=0.2, latency_factor=3.0, on_change=None):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = min(max(initial, self.minimum), self.maximum)
+        self.window = window
+        self.increase = increase
+        self.decrease_factor = decrease_factor
+        self.failure_threshold = failure_threshold
+        self.latency_factor = latency_factor
+        self.on_change = on_change
+        self.baseline = None # 健康状态下建连耗时中位数的最小值
+        self._lock = Lock()
+        self._samples = [] # [(耗时, 失败类型)]
+        self._started = time.monotonic()
+        self.history = []
+        self._record_history('initial', 0, 0)
+
+    @classmethod
+    def from_settings(cls, on_change=None):
+        conf = getattr(settings, 'EXECUTE_CONFIG', {})
+        adaptive = conf.get('ADAPTIVE_CONCURRENCY', {})
+        return cls(
+            initial=adaptive.get('INITIAL', 20),
+            minimum=adaptive.get('MIN', 2),
+            maximum=adaptive.get('MAX', conf.get('SCHEDULER', {}).get('MAX_WORKERS', 50)),
+            window=adaptive.get('WINDOW', 10),
+            decrease_factor=adaptive.get('DECREASE_FACTOR', 0.5),
+            failure_threshold=adaptive.get('FAILURE_THRESHOLD', 0.2),
+            latency_factor=adaptive.get('LATENCY_FACTOR', 3.0),
+            on_change=on_change,
+        )
+
+    def record_success(self, latency):
+        """记录一次成功建连及耗时（秒）"""
+        self._record(latency, None)
+
+    def record_failure(self, exc, latency=None):
+        """记录一次建连失败，非拥塞类失败（如设备不存在）不参与评估"""
+        kind = classify_error(exc)
+        if kind in CONGESTION_ERRORS:
+            self._record(latency, kind)
+        return kind
+
+    def _record(self, latency, error):
+        with self._lock:
+            self._samples.append((latency, error))
+            if len(self._samples) < self.window:
+                return
+            samples, self._samples = self._samples, []
+            changed = self._evaluate_locked(samples)
+            limit = self.limit
+        if changed and self.on_change:
+            self.on_change(limit)
+
+    def _evaluate_locked(self, samples):
+        failures = [error for _, error in samples if error]
+        failure_rate = len(failures) / len(samples)
+        latencies = [latency for latency, error in samples if not error and latency is not None]
+        latency = median(latencies) if latencies else None
+        congested = failure_rate > self.failure_threshold
+        if not congested and latency is not None:
+            if self.baseline is None or latency < self.baseline:
+                self.baseline = latency
+            congested = latency > self.baseline * self.latency_factor
+        previous = self.limit
+        if congested:
+            self.limit = max(self.minimum, int(self.limit * self.decrease_factor))
+            reason = 'decrease'
+        else:
+            self.limit = min(self.maximum, self.limit + self.increase)
+            reason = 'increase'
+        if self.limit == previous:
+            return False
+        self._record_history(reason, failure_rate, latency)
+        logger.info(f"并发数调整为{self.limit}（{reason}），失败率{failure_rate:.2f}，建连耗时中位数{latency}")
+        return True
+
+    def _record_history(self, reason, failure_rate, latency):
+        self.history.append({
+            'elapsed': round(time.monotonic() - self._started, 2), # 距任务开始的秒数
+            'limit': self.limit,
+            'reason': reason,
+            'failure_rate': round(failure_rate, 4),
+            'latency': round(latency, 3) if latency is not None else None,
+        })
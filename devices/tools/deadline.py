@@ -0,0 +1,89 @@
+import time
+import logging
+from threading import Lock
+
+from django.conf import settings
+
+from devices.tools.session_pool import close_session
+
+logger = logging.getLogger('devices.deadline')
+
+
+def time_budget_config():
+    """任务时限配置"""
+    conf = getattr(settings, 'EXECUTE_CONFIG', {}).get('TIME_BUDGET', {})
+    return {
+        'JOB_DEADLINE': conf.get('JOB_DEADLINE', 3600), # 0表示不限制
+        'CONFIG_JOB_DEADLINE': conf.get('CONFIG_JOB_DEADLINE', 0), # 配置下发任务时限，到达后只停止开始新的设备
+        'DEVICE_BUDGET': conf.get('DEVICE_BUDGET', 600),
+        'COMMAND_TIMEOUT': conf.get('COMMAND_TIMEOUT', 60),
+        'GRACE': conf.get('GRACE', 10),
+    }
+
+
+class DeviceTimeout(RuntimeError):
+    """设备执行超出时限"""
+
+
+def is_timeout_error(exc):
+    """命令或设备是否因超时失败"""
+    if isinstance(exc, (DeviceTimeout, TimeoutError)):
+        return True
+    name = type(exc).__name__.lower()
+    return 'timeout' in name or 'timed out' in str(exc).lower()
+
+
+class DeviceBudget:
+    """
+    单台设备的执行时限，从设备开始执行（而不是开始排队）时计时
+    工作线程在每条命令执行前检查是否超时，命令超时时间不超过剩余时间；
+    看门狗发现超时后关闭设备连接，使阻塞在读取上的工作线程尽快退出。
+    """
+
+    def __init__(self, device_info, budget, command_timeout):
+        self.device_info = device_info
+        self.budget = budget
+        self.command_timeout = command_timeout
+        self.started = time.monotonic()
+        self.deadline = self.started + budget
+        self.conn = None # 当前使用的连接
+        self.current_command = None # 正在执行的命令
+        self.timed_out = False
+        self.finished = False # 设备已执行结束（含连接失败），不再检查超时
+        self._lock = Lock()
+
+    def remaining(self):
+        return self.deadline - time.monotonic()
+
+    def finish(self):
+        """设备执行结束，看门狗及任务超时不再处理该设备"""
+        self.finished = True
+
+    def overdue(self):
+        """仍在执行且已超过时限、尚未被看门狗处理"""
+        return not self.finished and not self.timed_out and self.remaining() <= 0
+
+    def expired(self):
+        return self.timed_out or self.remaining() <= 0
+
+    def check(self, command=None):
+        """命令执行前检查，已超时则抛出DeviceTimeout"""
+        if self.expired():
+            self.timed_out = True
+            raise DeviceTimeout(f"设备{self.device_info['name']}执行超过{self.budget}秒，跳过命令{command or ''}")
+
+    def command_timeout_for(self):
+        """本条命令的超时时间，不超过设备剩余时间"""
+        return max(1, min(self.command_timeout, self.remaining()))
+
+    def expire(self):
+        """标记超时并关闭连接，返回超时时正在执行的命令"""
+        with self._lock:
+            if self.timed_out and self.conn is None:
+                return self.current_command
+            self.timed_out = True
+            conn = self.conn
+        if conn is not None:
+            logger.warning(f"设备{self.device_info['name']}({self.device_info['ip']})执行超时，关闭连接")
+            close_session(conn)
+        return self.current_command
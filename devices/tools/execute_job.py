@@ -0,0 +1,1380 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+import os
+import time
+from datetime import datetime
+from threading import Lock
+
+import asyncio
+from contextlib import contextmanager, nullcontext
+from django.conf import settings
+from django.core.cache import cache
+import paramiko
+from netmiko import ConnectHandler
+from asgiref.sync import sync_to_async
+
+from devices.models import Device, Command
+from devices.tools.report import get_report_generator
+from devices.tools.result_spool import ResultSpool
+from devices.tools.progress import ProgressAggregator, device_key, DEVICE_RUNNING, DEVICE_COMPLETED, DEVICE_FAILED, DEVICE_TIMEOUT
+from devices.tools.session_pool import get_session_pool, session_pool_enabled, session_key, close_session
+from devices.tools.scheduler import get_scheduler, resolve_priority
+from devices.tools.concurrency import AdaptiveConcurrency
+from devices.tools.rate_limit import get_rate_limiter
+from devices.tools.preflight import tcp_sweep, preflight_config
+from devices.tools.session_profile import get_profile_registry
+from devices.tools.server_exec import server_exec_config, server_exec_mode, run_batch, is_read_only, MODE_BATCH, MODE_PARALLEL
+from devices.tools.planner import resolve_commands, load_history, estimate_device, planner_config
+from devices.tools.deadline import DeviceBudget, DeviceTimeout, time_budget_config, is_timeout_error
+from devices.tools.async_engine import get_async_engine, async_engine_available, NETWORK_DEVICE_TYPES
+from devices.tools.sharding import ShardCoordinator, ShardResultStream, shard_execute_dir, tag_shard, sharding_config
+from devices.tools.runtime_stats import process_id
+from devices.tools.checkpoint import JobCheckpoint, read_index, write_index, retain_finished_results, mark_running, clear_running, RUNNING_TTL
+from devices.tools.timing import TimingCollector, timed_socket, timed_exec, PHASE_CONNECT, PHASE_SSH_HANDSHAKE, PHASE_PROMPT, PHASE_TEARDOWN
+import logging
+
+logger = logging.getLogger('devices.execute')
+
+def filter_empty_strings(lst):
+    """
+    过滤列表中的空字符串。
+
+    该函数接受一个列表作为输入，返回一个新的列表，其中不包含空字符串。
+
+    参数:
+    lst (list): 输入的列表，列表中的元素应为字符串。
+
+    返回:
+    list: 过滤后的列表，不包含空字符串。
+    """
+    return [item for item in lst if item]
+
+# 巡检任务，与websocket连接解耦：既可以在daphne进程内直接运行，也可以由execute_worker进程从任务队列中取出运行
+class ExecuteJob:
+    execute_type = 'inspect'
+    force_expire = True # 超过时限时关闭执行中设备的连接并记为超时，见ConfigJob
+    history_cache_key = 'devices_inspections' # 历史记录列表的缓存
+
+    def __init__(self, report_id, emit):
+        """
+        :param report_id: 任务ID，同时作为报告目录名
+        :param emit: 协程函数，接收消息字典并推送给前端（websocket或任务的channel group）
+        """
+        self.emit = emit
+        self.progress = None # 进度聚合器，见report_init
+        self.main_loop = None # 运行任务的事件循环，工作线程通过它推送消息
+        # 进程级调度器，所有任务共用工作线程及全局并发上限
+        self.scheduler = get_scheduler()
+        # 新增报告存储结构
+        self.reports  = {} # 存储所有报告信息
+        self.execute_dir = os.path.join(settings.DIR_INFO['REPORT_DIR'],self.execute_type,report_id) # 巡检记录及报告输出目录
+        self.current_report_id  = report_id # 当前巡检ID
+        self.engine = 'thread' # 执行引擎：thread（线程池）或async（asyncssh协程）
+        self.concurrency = None # 自适应并发控制器，未启用时为None
+        self.devices = {} # 任务开始时预取的设备信息 {设备ID: device_info}
+        self.commands = None # 任务开始时预取的命令信息，见_prefetch_commands_sync
+        self.preflight = None # 是否在SSH登录前探测端口，None表示按配置
+        self.priority = None # 调度优先级，None表示按设备数确定
+        self.time_budget = time_budget_config() # 任务、设备、命令时限
+        self.job_deadline = None
+        self.timed_out = False # 任务是否超过时限
+        self._budgets = {} # 正在执行的设备时限 {设备ID: DeviceBudget}
+        self._timeouts = set() # 已记为超时的设备ID
+        self._budget_lock = Lock()
+        self.timings = TimingCollector() # 各设备建连、命令执行等阶段耗时
+        self.shard = None # 分片任务的分片信息，见ShardCoordinator
+        self.resume = False # 是否续跑中断的任务
+        self.checkpoint = None # 设备检查点，分片任务由协调者记录
+        self._finished = {} # 续跑时已结束的设备 {设备ID: 检查点}
+        self._report_commands = {} # 已写入报告items的设备命令 {设备ID: 命令列表}
+        self._async_running = 0 # asyncio引擎下本任务正在处理的设备数
+        self._async_slots = None
+
+    @classmethod
+    def from_spec(cls, spec, emit):
+        """根据任务描述（见BaseexecuteConsumer.build_job_spec）创建任务"""
+        job_class = ConfigJob if spec.get('execute_type') == 'config' else ExecuteJob
+        return job_class(spec['job_id'], emit)
+
+    async def run_spec(self, spec):
+        self.preflight = spec.get('preflight')
+        self.priority = spec.get('priority')
+        self.shard = spec.get('shard')
+        self.resume = bool(spec.get('resume'))
+        if self.shard:
+            # 分片任务：消息推送给协调者，会话日志写入原任务报告目录下
+            self.emit = tag_shard(self.emit, self.shard['index'])
+            self.execute_dir = shard_execute_dir(self.execute_type, self.shard['parent'], self.shard['index'])
+            await self.emit({'type': 'shard.started', 'worker': process_id()})
+        await self.run(
+            spec.get('device_ids', []),
+            spec.get('command_ids', []),
+            spec.get('server_commands', []),
+            spec.get('network_commands', []),
+            spec.get('engine', 'thread')
+        )
+
+    async def report_init(self,device_ids,command_ids,server_commands,network_commands):
+        report_id = self.current_report_id
+        # 初始化巡检目录
+        if not os.path.exists( self.execute_dir):
+            os.makedirs( self.execute_dir)
+        # 命令结果逐条写入报告目录下的结果文件，任务重新执行时清空上次的结果
+        if self.shard:
+            # 分片的结果推送给协调者写入原任务的结果文件
+            conf = sharding_config()
+            self.result_spool = ShardResultStream(self.emit, self.main_loop, conf['RESULT_BATCH'], conf['FLUSH_INTERVAL'])
+            self.result_spool.reset()
+        else:
+            self.result_spool = ResultSpool.for_report(self.execute_dir)
+            self.checkpoint = JobCheckpoint(self.execute_dir)
+            # 续跑或任务队列重新投递（执行进程异常退出）时保留已结束设备的结果
+            if self.resume or self.checkpoint.exists():
+                self._finished = self.checkpoint.load()
+            if self._finished:
+                kept = retain_finished_results(self.result_spool, {
+                    (entry.get('name'), entry.get('ip')) for entry in self._finished.values()
+                })
+                logger.info(f"续跑任务{report_id}，已结束{len(self._finished)}台设备，保留{kept}条结果")
+            else:
+                self.result_spool.reset()
+                self.checkpoint.reset()
+        index = read_index(self.execute_dir) if self._finished else None
+        # 初始化巡检报告信息
+        self.reports[report_id]  = {
+            'report_dir': self.execute_dir, # 报告目录
+            'start_time': index.get('start_time') if index and index.get('start_time') else datetime.now().isoformat(), 
+            'devices': device_ids,
+            'commands': command_ids,
+            "server_commands": server_commands,
+            "network_commands": network_commands,
+            'results_file': self.result_spool.path, # 命令结果文件
+            'status': 'running',
+            'items':{}
+        }
+        logger.info(f"巡检任务初始化，巡检ID：{report_id}，巡检信息:{json.dumps(self.reports[report_id],indent=2)}")
+        # 巡检任务进度跟踪，按固定间隔合并推送
+        self.progress = ProgressAggregator.from_settings(self.emit, {
+            'total': len(device_ids),
+            'completed': 0,
+            'total_commands': len(command_ids)*len(device_ids),
+            'completed_commands': 0,
+            'failed_commands': 0,
+            'failed_devices': 0,
+            'timeout_devices': 0,
+        }, extra=self._queue_stats)
+        self.progress.start()
+
+    async def run(self, device_ids, command_ids,server_commands,network_commands,engine='thread'):
+        """执行任务"""
+        self.main_loop = asyncio.get_running_loop()
+        limit = self._job_time_limit()
+        self.job_deadline = time.monotonic() + limit if limit else None
+        if self.shard and self.shard.get('deadline') is not None:
+            # 分片与原任务同时超时
+            shard_deadline = time.monotonic() + self.shard['deadline'] - time.time()
+            self.job_deadline = shard_deadline if self.job_deadline is None else min(self.job_deadline, shard_deadline)
+        #处理空字符串
+        device_ids = filter_empty_strings(device_ids)
+        command_ids = filter_empty_strings(command_ids)
+        server_commands = filter_empty_strings(server_commands)
+        network_commands = filter_empty_strings(network_commands)
+        # 选择执行引擎，asyncssh未安装时回退到线程引擎
+        if engine == 'async' and not async_engine_available():
+            logger.warning("未安装asyncssh，回退到线程执行引擎")
+            engine = 'thread'
+        self.engine = engine if engine in ['thread', 'async'] else 'thread'
+        #初始化巡检报告信息
+        await self.report_init(device_ids,command_ids,server_commands,network_commands)
+        # 一次性预取设备及命令信息，工作线程直接按ID查找
+        await sync_to_async(self._prefetch_sync)(device_ids, command_ids)
+        if self._finished:
+            self._restore_finished(command_ids)
+        # 执行巡检，执行期间定期刷新心跳，心跳过期且任务记录仍为执行中的任务可以续跑
+        heartbeat = None if self.shard else asyncio.create_task(self._heartbeat())
+        try:
+            await self.execute_commands(device_ids, command_ids,server_commands,network_commands)
+        finally:
+            if heartbeat:
+                heartbeat.cancel()
+                await asyncio.to_thread(clear_running, self.current_report_id)
+        if self.shard:
+            return
+        # 发送完成消息
+        await self.emit({ 
+            'type': 'report.created', 
+            'report_id': self.current_report_id
+        })
+
+    def _job_time_limit(self):
+        """任务时限（秒），0表示不限制"""
+        return self.time_budget['JOB_DEADLINE']
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.to_thread(mark_running, self.current_report_id)
+            await asyncio.sleep(RUNNING_TTL / 3)
+
+    def _restore_finished(self, command_ids):
+        """续跑：已结束的设备计入进度，报告items从检查点恢复"""
+        for device_id, entry in self._finished.items():
+            device_info = self.devices.get(int(device_id))
+            if device_info is None:
+                continue
+            if entry['status'] in (DEVICE_FAILED, DEVICE_TIMEOUT):
+                self.progress.device_status(device_key(device_info), entry['status'])
+            self.progress.device_status(device_key(device_info), DEVICE_COMPLETED)
+            self.progress.incr('completed_commands', len(command_ids))
+            if entry.get('commands') is not None:
+                self._record_report_items(device_info, entry['commands'])
+
+    def _checkpoint_device(self, device_id, failed=False):
+        """记录设备执行结束，超时优先于失败"""
+        if self.checkpoint is None:
+            return
+        device_info = self.devices.get(int(device_id))
+        if device_info is None:
+            return
+        with self._budget_lock:
+            timed_out = device_info['id'] in self._timeouts
+        status = DEVICE_TIMEOUT if timed_out else DEVICE_FAILED if failed else DEVICE_COMPLETED
+        try:
+            self.checkpoint.record(device_id, status, device_info, self._report_commands.get(device_info['id']))
+        except OSError as e:
+            logger.warning(f"写入设备{device_info['name']}检查点失败: {str(e)}")
+
+    def _write_index(self, device_ids, command_ids, server_commands, network_commands):
+        """生成巡检记录文件json文件存放在巡检目录下，任务开始时写入一次（状态为running），结束时更新"""
+        report = self.reports[self.current_report_id]
+        inspect_record = {
+            "device_ids":';'.join(device_ids),
+            "command_ids": ';'.join(command_ids),
+            "server_commands": ';'.join(server_commands),
+            "network_commands": ';'.join(network_commands),
+            "start_time": report['start_time'],
+            "end_time": report.get('end_time', ''),
+            "status": report['status'],
+            "engine": self.engine,
+            "concurrency": self.concurrency.history if self.concurrency else [],
+            "unreachable": len(report.get('unreachable', [])),
+        }
+        write_index(self.execute_dir, inspect_record)
+        cache.delete(self.history_cache_key)
+
+    async def execute_commands(self, device_ids, command_ids,server_commands,network_commands):
+        try:
+            logger.info(f"开始执行任务，设备列表：{device_ids}，命令列表：{command_ids}，server_commands:{server_commands},network_commands:{network_commands}")
+            # 分片任务的记录由协调者生成
+            if not self.shard:
+                await asyncio.to_thread(self._write_index, device_ids, command_ids, server_commands, network_commands)
+            # 续跑时只执行未结束的设备
+            pending_ids = [device_id for device_id in device_ids if str(device_id) not in self._finished]
+            # 端口不可达的设备直接记为失败，不占用SSH工作线程
+            reachable_ids = await self.preflight_sweep(pending_ids, command_ids)
+            reachable_ids = await sync_to_async(self._dispatch_order_sync)(reachable_ids, command_ids, server_commands, network_commands)
+            self.priority = resolve_priority(self.priority, len(device_ids))
+            self.scheduler.set_job_priority(self.current_report_id, self.priority)
+            self._init_concurrency()
+            # 设备数较多时拆分为多个分片，由其它节点的execute_worker分担
+            coordinator = await sync_to_async(ShardCoordinator.for_job)(self, reachable_ids)
+            if coordinator:
+                await coordinator.run(reachable_ids, command_ids, server_commands, network_commands)
+            else:
+                await self._run_devices(reachable_ids, command_ids, server_commands, network_commands)
+            
+        except Exception as e:
+            logger.error(f"执行错误: {str(e)}")
+            await self.send_error_message(f"执行错误: {str(e)}")
+        finally:
+            logger.info("所有任务执行完成")
+            self.scheduler.finish_job(self.current_report_id)
+            await self.progress.stop()
+            # 并发数变化记录写入报告
+            if self.concurrency:
+                self.reports[self.current_report_id]['concurrency'] = self.concurrency.history
+            await self.send_completion_message()
+            if not self.shard:
+                self._write_index(device_ids, command_ids, server_commands, network_commands)
+
+    async def _run_devices(self, device_ids, command_ids, server_commands, network_commands):
+        """
+        在本进程内执行一批设备，超过任务时限仍未完成的设备记为超时
+        force_expire为False的任务（配置下发）超过时限后只取消未开始的设备，执行中的设备等待其执行完
+        """
+        process_device = self.process_device_async if self.engine == 'async' else self.process_device_with_pool
+        device_tasks = [
+            asyncio.create_task(
+                process_device(device_id, command_ids,server_commands,network_commands),
+                name=f"Device-{device_id}"
+            ) for device_id in device_ids
+        ]
+        task_devices = dict(zip(device_tasks, device_ids))
+        # 让设备任务完成提交后推送一次进度，前端可以看到排队情况
+        await asyncio.sleep(0)
+        self.progress.touch()
+        watchdog = asyncio.create_task(self._watchdog()) if self.force_expire else None
+        try:
+            pending = set()
+            if device_tasks:
+                timeout = None if self.job_deadline is None else max(0, self.job_deadline - time.monotonic())
+                _, pending = await asyncio.wait(device_tasks, timeout=timeout)
+            if pending and self.force_expire:
+                await self._expire_job(pending, task_devices)
+            elif pending:
+                await self._stop_dispatch(pending, task_devices)
+        finally:
+            if watchdog:
+                watchdog.cancel()
+
+    async def preflight_sweep(self, device_ids, command_ids):
+        """
+        SSH登录前并发探测所有设备的SSH端口，返回可达的设备ID
+        不可达的设备记入报告的unreachable列表，并按失败计入进度
+        """
+        conf = preflight_config()
+        enabled = conf.get('ENABLED', False) if self.preflight is None else self.preflight
+        if not enabled or not device_ids:
+            return device_ids
+        targets = {}
+        for device_id in device_ids:
+            device_info = self.devices.get(int(device_id))
+            if device_info:
+                targets[device_id] = (device_info['ip'], int(device_info['port'] or 22))
+        started = time.monotonic()
+        results = await tcp_sweep(targets, timeout=conf.get('TIMEOUT', 3), concurrency=conf.get('CONCURRENCY', 2000))
+        unreachable = self.reports[self.current_report_id].setdefault('unreachable', [])
+        reachable_ids = []
+        for device_id in device_ids:
+            # 未预取到的设备交给后续流程报告错误
+            reachable, error, _ = results.get(device_id, (True, '', 0))
+            if reachable:
+                reachable_ids.append(device_id)
+                continue
+            device_info = self.devices[int(device_id)]
+            unreachable.append({
+                'device': device_info['name'],
+                'device_ip': device_info['ip'],
+                'port': device_info['port'],
+                'error': error,
+            })
+            self.progress.device_status(device_key(device_info), DEVICE_FAILED)
+            self.progress.device_status(device_key(device_info), DEVICE_COMPLETED)
+            self.progress.incr('completed_commands', len(command_ids))
+            self.progress.incr('failed_commands', len(command_ids))
+            self._checkpoint_device(device_id, failed=True)
+            await self.send_error_message(f"设备{device_info['name']}({device_info['ip']})SSH端口不可达: {error}")
+        logger.info(f"端口探测完成，耗时{time.monotonic() - started:.2f}秒，可达{len(reachable_ids)}台，不可达{len(unreachable)}台")
+        return reachable_ids
+
+    async def _watchdog(self):
+        """定期检查正在执行的设备，超过设备时限的关闭连接并记为超时"""
+        while True:
+            await asyncio.sleep(1)
+            with self._budget_lock:
+                budgets = [budget for budget in self._budgets.values() if budget.overdue()]
+            for budget in budgets:
+                command = await asyncio.to_thread(budget.expire)
+                self._record_device_timeout(budget.device_info, command)
+
+    async def _expire_job(self, pending, task_devices):
+        """
+        任务超过时限：取消排队中的设备，关闭执行中设备的连接，
+        等待片刻让工作线程写入已获得的结果后，将未完成的设备记为超时
+        """
+        self.timed_out = True
+        await self.send_error_message(f"任务执行超过{self.time_budget['JOB_DEADLINE']}秒，未完成的{len(pending)}台设备记为超时")
+        self.scheduler.finish_job(self.current_report_id, cancel=True)
+        with self._budget_lock:
+            budgets = [budget for budget in self._budgets.values() if not budget.finished]
+        for budget in budgets:
+            await asyncio.to_thread(budget.expire)
+        for task in pending:
+            task.cancel()
+        _, still_pending = await asyncio.wait(pending, timeout=self.time_budget['GRACE'])
+        if still_pending:
+            logger.warning(f"{len(still_pending)}台设备在关闭连接后仍未结束，不再等待")
+        for task in pending:
+            device_id = task_devices[task]
+            device_info = self.devices.get(int(device_id))
+            if device_info is None:
+                continue
+            with self._budget_lock:
+                budget = self._budgets.get(device_info['id'])
+            if budget is not None and budget.finished:
+                # 设备会话已结束，只是任务未来得及写入报告信息
+                continue
+            self._record_device_timeout(device_info, budget.current_command if budget else None)
+            self._checkpoint_device(device_id)
+
+    async def _stop_dispatch(self, pending, task_devices):
+        """
+        任务超过时限但不强制结束（配置下发）：取消排队中的设备，不关闭执行中设备的连接，
+        等待执行中的设备执行完；未开始的设备记为超时
+        """
+        self.timed_out = True
+        await self.send_error_message(f"任务执行超过{self._job_time_limit()}秒，不再开始新的设备，等待执行中的设备完成")
+        self.scheduler.finish_job(self.current_report_id, cancel=True)
+        await asyncio.wait(pending)
+        skipped = 0
+        for task in pending:
+            if not task.cancelled():
+                continue
+            device_info = self.devices.get(int(task_devices[task]))
+            if device_info is None:
+                continue
+            skipped += 1
+            self._record_device_timeout(device_info)
+            self._checkpoint_device(task_devices[task])
+        logger.warning(f"任务{self.current_report_id}超过时限，{skipped}台未开始的设备记为超时")
+
+    def _record_device_timeout(self, device_info, command=None):
+        """设备超时：写入一条timeout状态的结果，已执行完成的命令结果保留在报告中"""
+        with self._budget_lock:
+            if device_info['id'] in self._timeouts:
+                return
+            self._timeouts.add(device_info['id'])
+        now = datetime.now().isoformat()
+        self.result_spool.append({
+            'device': device_info['name'],
+            'device_ip': device_info['ip'],
+            'os_type': device_info['os_type'],
+            'command': command or '-',
+            'result': f"设备执行超时，未完成的命令已跳过",
+            'timestamp': now,
+            'start_time': now,
+            'end_time': now,
+            'status': 'timeout'
+        })
+        self.progress.device_status(device_key(device_info), DEVICE_TIMEOUT)
+        logger.warning(f"设备{device_info['name']}({device_info['ip']})执行超时，当前命令：{command}")
+
+    def _record_command_error(self, device_info, command, error):
+        """命令超时写入timeout状态的结果；设备超时后的命令一并记为设备超时"""
+        if isinstance(error, DeviceTimeout):
+            self._record_device_timeout(device_info, command)
+            return
+        if not is_timeout_error(error):
+            return
+        now = datetime.now().isoformat()
+        self.result_spool.append({
+            'device': device_info['name'],
+            'device_ip': device_info['ip'],
+            'os_type': device_info['os_type'],
+            'command': command,
+            'result': f"命令执行超时: {str(error)}",
+            'timestamp': now,
+            'start_time': now,
+            'end_time': now,
+            'status': 'timeout'
+        })
+
+    def _device_budget(self, device_info):
+        """获取设备时限，设备开始执行时创建"""
+        with self._budget_lock:
+            budget = self._budgets.get(device_info['id'])
+            if budget is None:
+                budget = DeviceBudget(device_info, self.time_budget['DEVICE_BUDGET'], self.time_budget['COMMAND_TIMEOUT'])
+                self._budgets[device_info['id']] = budget
+            return budget
+
+    def _run_command(self, device_info, command, execute):
+        """
+        在设备时限内执行一条命令
+        :param execute: 接收本条命令超时时间（秒）的函数
+        """
+        budget = self._device_budget(device_info)
+        budget.check(command)
+        budget.current_command = command
+        try:
+            return execute(budget.command_timeout_for())
+        finally:
+            budget.current_command = None
+
+    @staticmethod
+    def _exec_generic_command(ssh, command, timeout, timer=None):
+        """通用SSH设备执行命令，读取超过timeout秒抛出socket.timeout"""
+        return timed_exec(ssh, command, timeout, timer)
+
+    def _init_concurrency(self):
+        """按配置启用自适应并发控制"""
+        conf = getattr(settings, 'EXECUTE_CONFIG', {}).get('ADAPTIVE_CONCURRENCY', {})
+        if not conf.get('ENABLED', False):
+            return
+        self.concurrency = AdaptiveConcurrency.from_settings(on_change=self._apply_concurrency_limit)
+        self._async_slots = asyncio.Condition()
+        self._apply_concurrency_limit(self.concurrency.limit)
+
+    def _apply_concurrency_limit(self, limit):
+        """并发数调整后生效：线程引擎由调度器限制本任务的并发，asyncio引擎唤醒等待中的设备协程"""
+        if self.engine == 'async':
+            asyncio.run_coroutine_threadsafe(self._notify_async_slots(), self.main_loop)
+        else:
+            self.scheduler.set_job_limit(self.current_report_id, limit)
+
+    async def _notify_async_slots(self):
+        async with self._async_slots:
+            self._async_slots.notify_all()
+
+    async def _acquire_async_slot(self):
+        if self.concurrency is None:
+            return
+        async with self._async_slots:
+            await self._async_slots.wait_for(lambda: self._async_running < self.concurrency.limit)
+            self._async_running += 1
+
+    async def _release_async_slot(self):
+        if self.concurrency is None:
+            return
+        async with self._async_slots:
+            self._async_running -= 1
+            self._async_slots.notify_all()
+
+    def _record_connect(self, started, error=None, latency=None):
+        """记录建连结果，供自适应并发控制器评估"""
+        if self.concurrency is None:
+            return
+        if latency is None:
+            latency = time.monotonic() - started
+        if error is None:
+            self.concurrency.record_success(latency)
+        else:
+            self.concurrency.record_failure(error, latency)
+
+    def _timed_factory(self, device_info, factory):
+        """包装建连函数：建连前按子网/os_type/站点限速，并记录建连耗时及失败原因"""
+        def connect():
+            with get_rate_limiter().connecting(device_info):
+                started = time.monotonic()
+                try:
+                    conn = factory()
+                except Exception as e:
+                    self._record_connect(started, e)
+                    raise
+                self._record_connect(started)
+                return conn
+        return connect
+
+    async def process_device_with_pool(self, device_id, command_ids,server_commands,network_commands):
+        """设备处理入口"""
+        loop = asyncio.get_running_loop()
+        try:
+            await asyncio.wrap_future(
+                self.scheduler.submit(
+                    self.current_report_id,
+                    self._process_device_sync,
+                    device_id,
+                    command_ids,
+                    server_commands,
+                    network_commands
+                )
+            )
+        except Exception as e:
+            self._checkpoint_device(device_id, failed=True)
+            error_msg = f"设备 {device_id} 处理失败: {str(e)}"
+            await self.send_error_message(error_msg)
+        else:
+            self._checkpoint_device(device_id)
+
+    async def process_device_async(self, device_id, command_ids,server_commands,network_commands):
+        """设备处理入口（asyncio引擎，设备会话直接以协程运行在事件循环上）"""
+        try:
+            device_info = await sync_to_async(self._get_device_credentials_sync)(device_id)
+            commands = await sync_to_async(self._resolve_commands_sync)(device_info, command_ids, server_commands, network_commands)
+            await self._acquire_async_slot()
+            try:
+                device_budget = self.time_budget['DEVICE_BUDGET'] if self.force_expire else None
+                await asyncio.wait_for(self._handle_device_async(device_info, commands), device_budget)
+            except asyncio.TimeoutError:
+                # 超时后会话随协程取消而关闭
+                self._record_device_timeout(device_info)
+            finally:
+                await self._release_async_slot()
+            self._record_report_items(device_info, commands)
+            self._checkpoint_device(device_id)
+        except Exception as e:
+            self._checkpoint_device(device_id, failed=True)
+            logger.error(f"设备 {device_id} 处理失败: {str(e)}")
+            await self.send_error_message(f"设备 {device_id} 处理失败: {str(e)}")
+
+    def _process_device_sync(self, device_id, command_ids,server_commands,network_commands):
+        """同步设备处理核心"""
+        try:
+            # 同步获取设备凭证和命令
+            device_info = self._get_device_credentials_sync(device_id)
+            commands = self._resolve_commands_sync(device_info, command_ids, server_commands, network_commands)
+            if device_info['device_type'] in NETWORK_DEVICE_TYPES:
+                self._handle_network_device_sync(device_info, commands)
+            else:
+                self._handle_generic_device_sync(device_info, commands)
+            #填充报告中的items信息
+            self._record_report_items(device_info, commands)
+        except Exception as e:
+            logger.error(f"设备 {device_id} 处理失败: {str(e)}")
+            raise RuntimeError(f"设备处理失败: {str(e)}")
+
+    def _resolve_commands_sync(self, device_info, command_ids, server_commands, network_commands):
+        """根据设备os_type筛选命令，并合并自定义命令"""
+        command_info = []
+        # 同步获取命令名称
+        #command_ids = [cmd for cmd in command_ids if cmd] # 删除空字符串
+        if len(command_ids)>0:
+            # 获取命令信息
+            logger.debug(f"获取命令ID {command_ids} 的信息")
+            command_info = self._get_command_credentials_sync(command_ids)
+            logger.debug(f"获取命令ID {command_ids} 的信息成功{command_info}")
+        # 根据os_type筛选命令，合并自定义命令并去重
+        return resolve_commands(device_info, command_info, server_commands, network_commands)
+
+    def _planned_commands_sync(self, device_info, command_ids, server_commands, network_commands):
+        """预估耗时使用的设备命令列表"""
+        return self._resolve_commands_sync(device_info, command_ids, server_commands, network_commands)
+
+    def _dispatch_order_sync(self, device_ids, command_ids, server_commands, network_commands):
+        """
+        按预计耗时从长到短排列设备（最长处理时间优先），耗时长的设备先开始，避免在任务末尾拖长整体耗时
+        预计耗时见planner.estimate_device：没有该设备历史耗时的命令按同os_type的命令耗时估算
+        """
+        conf = planner_config()
+        if not conf['LPT_ORDER'] or len(device_ids) < 2:
+            return device_ids
+        try:
+            history = load_history(self.execute_type)
+            costs = {}
+            for device_id in device_ids:
+                device_info = self.devices.get(int(device_id))
+                if device_info is None:
+                    costs[device_id] = 0
+                    continue
+                commands = self._planned_commands_sync(device_info, command_ids, server_commands, network_commands)
+                costs[device_id] = estimate_device(device_info, commands, history, conf)[0]
+        except Exception as e:
+            logger.warning(f"预估设备耗时失败，按提交顺序下发: {str(e)}")
+            return device_ids
+        ordered = sorted(device_ids, key=lambda device_id: costs[device_id], reverse=True)
+        logger.debug(f"设备下发顺序：{[(device_id, round(costs[device_id], 1)) for device_id in ordered[:20]]}")
+        return ordered
+
+    def _record_report_items(self, device_info, commands):
+        """填充报告中的items信息"""
+        self._report_commands[device_info['id']] = commands
+        if device_info['os_type'] not in self.reports[self.current_report_id]['items']:
+            self.reports[self.current_report_id]['items'][device_info['os_type']] = {
+                'commands':commands,
+                'devices':[device_info['name']]
+            }
+        else:
+            self.reports[self.current_report_id]['items'][device_info['os_type']]['devices'].append(device_info['name'])
+
+    async def _handle_device_async(self, device_info, commands):
+        """处理设备（asyncio引擎，命令串行）"""
+        session_log = os.path.join(self.execute_dir,f"{device_info['name']}__{device_info['ip']}.log")
+        self.progress.device_status(device_key(device_info), DEVICE_RUNNING)
+        started = time.monotonic()
+        connected = False
+        timer = self.timings.device(device_info)
+        try:
+            async with get_async_engine().session(device_info, session_log) as session:
+                connected = True
+                self._record_connect(started, latency=session.connect_time)
+                # asyncssh的建连无法拆分TCP与握手，整体计入ssh_handshake
+                timer.add(PHASE_SSH_HANDSHAKE, session.connect_time)
+                timer.add(PHASE_PROMPT, session.open_time)
+                logger.info(f"成功连接到设备 {device_info['name']} ({device_info['ip']}),执行命令列表：{commands}")
+                for cmd in commands:
+                    try:
+                        start_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                        command_started = time.monotonic()
+                        output = await session.run(cmd)
+                        timer.command(cmd, time.monotonic() - command_started)
+                        end_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                        self.send_instant_result(
+                            device_info['name'],
+                            device_info['ip'],
+                            device_info['device_type'],
+                            device_info['os_type'],
+                            cmd,
+                            output,
+                            start_time,
+                            end_time
+                        )
+                    except Exception as e:
+                        self.progress.incr('failed_commands')
+                        self._record_command_error(device_info, cmd, e)
+                        await self.send_error_message(f"{device_info['name']}命令 {cmd} 执行失败: {str(e)}")
+                    finally:
+                        self.progress.incr('completed_commands')
+                teardown_started = time.monotonic()
+            timer.add(PHASE_TEARDOWN, time.monotonic() - teardown_started)
+        except Exception as e:
+            if not connected:
+                self._record_connect(started, e)
+            self.progress.device_status(device_key(device_info), DEVICE_FAILED)
+            await self.send_error_message(f"设备连接失败: {str(e)}")
+            raise RuntimeError(f"设备连接失败: {str(e)}")
+        finally:
+            self.progress.device_status(device_key(device_info), DEVICE_COMPLETED)
+
+    def _prefetch_sync(self, device_ids, command_ids):
+        """预取本次任务涉及的全部设备和命令，每类各一次查询"""
+        device_ids = [int(device_id) for device_id in device_ids]
+        self.devices = {
+            device.id: self._device_info(device)
+            for device in Device.objects.filter(id__in=device_ids)
+        }
+        missing = set(device_ids) - set(self.devices)
+        if missing:
+            logger.warning(f"设备ID {sorted(missing)} 不存在")
+        self.commands = self._prefetch_commands_sync(command_ids)
+        logger.debug(f"预取设备{len(self.devices)}台，命令{len(self.commands)}条")
+
+    def _prefetch_commands_sync(self, command_ids):
+        """预取命令 {命令ID: {'os_type': os_type, 'command_text': 命令}}"""
+        return {
+            str(command.id): {
+                'os_type': command.os_type.name,
+                'command_text': command.command_text
+            }
+            for command in Command.objects.filter(id__in=command_ids).select_related('os_type')
+        }
+
+    def _get_command_credentials_sync(self, command_ids):
+        """同步获取命令名称"""
+        if self.commands is None:
+            self.commands = self._prefetch_commands_sync(command_ids)
+        return [self.commands[str(command_id)] for command_id in command_ids if str(command_id) in self.commands]
+
+    @staticmethod
+    def _device_info(device):
+        return {
+            'device_type': device.device_type,
+            'os_type': device.os_type,
+            'ip': device.ip_address,
+            'username': device.username,
+            'password': device.password,
+            'port': device.port or 22,
+            'name': device.name,
+            'id': device.id
+        }
+
+    def _get_device_credentials_sync(self, device_id):
+        """同步获取设备凭证"""
+        device_id = int(device_id)
+        device_info = self.devices.get(device_id)
+        if device_info is None:
+            try:
+                device_info = self._device_info(Device.objects.get(id=device_id))
+            except Device.DoesNotExist:
+                logger.error(f"设备ID {device_id} 不存在")
+                raise RuntimeError(f"设备ID {device_id} 不存在")
+            self.devices[device_id] = device_info
+        return device_info
+
+    def _open_network_connection(self, device_info, session_log=None):
+        """建立网络设备连接，建连参数按os_type的会话参数"""
+        registry = get_profile_registry()
+        timer = self.timings.device(device_info)
+        # netmiko的公开接口无法拆分TCP建连、握手、认证及获取提示符，整体计入connect
+        with timer.phase(PHASE_CONNECT):
+            conn = ConnectHandler(session_log=session_log, **registry.connect_kwargs(device_info))
+        try:
+            # 会话参数中额外的会话准备（如关闭分页）
+            with timer.phase(PHASE_PROMPT):
+                registry.prepare(conn, device_info['os_type'])
+        except Exception:
+            close_session(conn)
+            raise
+        return conn
+
+    def _open_generic_connection(self, device_info):
+        """建立通用SSH设备连接"""
+        timer = self.timings.device(device_info)
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        sock = None
+        try:
+            # TCP建连单独计时，经sock参数交给paramiko；握手与认证整体计时
+            sock = timed_socket(device_info['ip'], device_info['port'], 15, timer)
+            with timer.phase(PHASE_SSH_HANDSHAKE):
+                ssh.connect(
+                    hostname=device_info['ip'],
+                    port=device_info['port'],
+                    username=device_info['username'],
+                    password=device_info['password'],
+                    timeout=15,
+                    sock=sock
+                )
+        except Exception:
+            ssh.close()
+            if sock is not None:
+                sock.close()
+            raise
+        return ssh
+
+    @contextmanager
+    def _device_session(self, device_info, factory):
+        """
+        获取设备连接
+        启用会话池时从进程级会话池借出（巡检与配置下发共用），结束后归还；
+        未启用时每次新建连接并在结束后断开
+        """
+        self.progress.device_status(device_key(device_info), DEVICE_RUNNING)
+        budget = self._device_budget(device_info)
+        timer = self.timings.device(device_info)
+        factory = self._timed_factory(device_info, factory)
+        if not session_pool_enabled():
+            try:
+                conn = factory()
+                budget.conn = conn
+                try:
+                    yield conn
+                finally:
+                    budget.conn = None
+                    with timer.phase(PHASE_TEARDOWN):
+                        close_session(conn)
+            finally:
+                budget.finish()
+            return
+        teardown_started = None
+        try:
+            with get_session_pool().session(session_key(device_info), factory) as conn:
+                budget.conn = conn
+                try:
+                    yield conn
+                finally:
+                    budget.conn = None
+                    if budget.timed_out:
+                        # 超时时连接已被关闭，不再放回会话池
+                        self._discard_session(conn)
+                    teardown_started = time.monotonic()
+        finally:
+            # 设备执行结束（含建连失败），看门狗不再将其记为超时
+            budget.finish()
+            if teardown_started is not None:
+                # 归还会话池（损坏的会话在此断开）
+                timer.add(PHASE_TEARDOWN, time.monotonic() - teardown_started)
+
+    def _discard_session(self, conn):
+        """命令执行异常后会话状态不可控，归还时不再放回会话池"""
+        if session_pool_enabled():
+            get_session_pool().mark_broken(conn)
+
+    @contextmanager
+    def _network_session(self, device_info):
+        """获取网络设备连接，并将会话日志写入本次执行目录"""
+        session_log = os.path.join(self.execute_dir,f"{device_info['name']}__{device_info['ip']}.log")
+        with self._device_session(device_info, lambda: self._open_network_connection(device_info, session_log)) as conn:
+            if conn.session_log is None:
+                # 复用的会话需要重新挂载本次执行的会话日志
+                conn.open_session_log(session_log, mode='append')
+            try:
+                yield conn
+            finally:
+                try:
+                    conn.close_session_log()
+                except Exception as e:
+                    logger.debug(f"关闭会话日志失败: {str(e)}")
+                conn.session_log = None
+
+    def _handle_network_device_sync(self, device_info, commands):
+        """处理网络设备（命令串行）"""
+        try:
+            with self._network_session(device_info) as conn:
+                logger.info(f"成功连接到网络设备 {device_info['name']} ({device_info['ip']}),执行命令列表：{commands}")
+                registry = get_profile_registry()
+                os_type = device_info['os_type']
+                # 串行执行命令
+                for cmd in commands:
+                    logger.debug(f"{device_info['name']} 执行命令{cmd}")
+                    # 按提示符正则等待命令结束，省去每条命令前获取提示符的往返
+                    command_kwargs = registry.command_kwargs(conn, os_type)
+                    try:
+                        start_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                        started = time.monotonic()
+                        output = self._run_command(device_info, cmd, lambda timeout: conn.send_command(
+                            cmd, read_timeout=registry.read_timeout(os_type, timeout), **command_kwargs))
+                        latency = time.monotonic() - started
+                        registry.record_success(os_type, latency, bool(command_kwargs))
+                        # 交互式会话的输出随命令执行返回，耗时全部计入exec
+                        self.timings.device(device_info).command(cmd, latency)
+                        end_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                        self.send_instant_result(
+                            device_info['name'],
+                            device_info['ip'],
+                            device_info['device_type'],
+                            device_info['os_type'],
+                            cmd,
+                            output,
+                            start_time,
+                            end_time
+                        )
+                    except Exception as e:
+                        registry.record_failure(os_type, e, bool(command_kwargs))
+                        self._discard_session(conn)
+                        self.progress.incr('failed_commands')
+                        self._record_command_error(device_info, cmd, e)
+                        self._send_error_sync(f"{device_info['name']}命令 {cmd} 执行失败: {str(e)}")
+                    finally:
+                        self.progress.incr('completed_commands')
+        except Exception as e:
+            self.progress.device_status(device_key(device_info), DEVICE_FAILED)
+            self._send_error_sync(f"网络设备连接失败: {str(e)}")
+            raise RuntimeError(f"网络设备连接失败: {str(e)}")
+        finally:
+            self.progress.device_status(device_key(device_info), DEVICE_COMPLETED)
+
+    def _handle_generic_device_sync(self, device_info, commands):
+        """处理通用SSH设备（命令串行）"""
+        session_log=os.path.join(self.execute_dir,f"{device_info['name']}__{device_info['ip']}.log")
+        logfile_handler = open(session_log,'w')
+        try:
+            with self._device_session(device_info, lambda: self._open_generic_connection(device_info)) as ssh:
+                #对commands进行转换，如果cmd中有__，则表示是命令集，需要读取命令集文件中的所有命令
+                # for cmd in commands:
+                #     if '__' in cmd:
+                #         cmd_file = f"{cmd}.conf"
+                #         cmd_file_path = os.path.join(settings.DIR_INFO['CONF_DIR'], 'netconf',f"{cmd_file}.conf")
+                #         if os.path.exists(cmd_file_path):
+                #             with open(cmd_file_path, 'r') as f:
+                #                 commands.extend(f.readlines())
+                logger.info(f"成功连接到通用SSH设备 {device_info['name']} ({device_info['ip']}),执行命令列表：{commands}")
+                pending = commands
+                mode = server_exec_mode()
+                if mode == MODE_BATCH and len(commands) > 1:
+                    pending = self._run_generic_batch(device_info, ssh, commands, logfile_handler)
+                elif mode == MODE_PARALLEL and len(commands) > 1:
+                    self._run_generic_parallel(device_info, ssh, commands, logfile_handler)
+                    pending = []
+                # 串行执行命令
+                for cmd in pending:
+                    self._run_generic_command(device_info, ssh, cmd, logfile_handler)
+        except Exception as e:
+            self.progress.device_status(device_key(device_info), DEVICE_FAILED)
+            self._send_error_sync(f"SSH连接失败: {str(e)}")
+            raise RuntimeError(f"SSH连接失败: {str(e)}")
+        finally:
+            self.progress.device_status(device_key(device_info), DEVICE_COMPLETED)
+            logfile_handler.close()
+
+    def _run_generic_command(self, device_info, ssh, cmd, logfile_handler, log_lock=None):
+        """通用SSH设备执行一条命令并推送结果"""
+        try:
+            logger.debug(f"{device_info['name']} {device_info['ip']} 执行命令{cmd}")
+            start_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            output = self._run_command(device_info, cmd, lambda timeout: self._exec_generic_command(ssh, cmd, timeout, self.timings.device(device_info)))
+            end_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            #记录日志
+            with log_lock or nullcontext():
+                logfile_handler.write(f"Command: {cmd}\n{output}\n")
+                logfile_handler.flush()
+            self.send_instant_result(
+                device_info['name'],
+                device_info['ip'],
+                device_info['device_type'],
+                device_info['os_type'],
+                cmd,
+                output,
+                start_time,
+                end_time
+            )
+        except Exception as e:
+            self._discard_session(ssh)
+            self.progress.incr('failed_commands')
+            self._record_command_error(device_info, cmd, e)
+            self._send_error_sync(f"SSH命令 {cmd} 失败: {str(e)}")
+        finally:
+            self.progress.incr('completed_commands')
+
+    def _run_generic_parallel(self, device_info, ssh, commands, logfile_handler):
+        """
+        按原顺序执行命令：连续的多条只读命令在同一连接上打开多个通道并发执行（每台设备不超过PARALLEL_CHANNELS个），
+        全部结束后再执行后面的命令；其余命令逐条执行
+        """
+        runs = [] # 连续的只读或非只读命令 [(是否只读, [命令])]
+        for cmd in commands:
+            read_only = is_read_only(cmd)
+            if runs and runs[-1][0] == read_only:
+                runs[-1][1].append(cmd)
+            else:
+                runs.append((read_only, [cmd]))
+        longest = max((len(run) for read_only, run in runs if read_only), default=0)
+        if longest < 2:
+            for cmd in commands:
+                self._run_generic_command(device_info, ssh, cmd, logfile_handler)
+            return
+        channels = min(server_exec_config().get('PARALLEL_CHANNELS', 4), longest)
+        log_lock = Lock()
+        with ThreadPoolExecutor(max_workers=channels, thread_name_prefix=f"exec-{device_info['ip']}") as executor:
+            for read_only, run in runs:
+                if not read_only or len(run) < 2:
+                    for cmd in run:
+                        self._run_generic_command(device_info, ssh, cmd, logfile_handler, log_lock)
+                    continue
+                logger.debug(f"{device_info['name']} {device_info['ip']} 并发执行{len(run)}条只读命令，通道数{min(channels, len(run))}")
+                futures = [
+                    executor.submit(self._run_generic_command, device_info, ssh, cmd, logfile_handler, log_lock)
+                    for cmd in run
+                ]
+                for future in futures:
+                    future.result()
+
+    def _run_generic_batch(self, device_info, ssh, commands, logfile_handler):
+        """
+        在一个通道中批量执行服务器命令，返回仍需逐条执行的命令
+        未开始执行任何命令就失败（如设备不支持sh）时全部改为逐条执行；
+        中途失败时当前命令记为失败，剩余命令逐条执行
+        """
+        budget = self._device_budget(device_info)
+        timer = self.timings.device(device_info)
+        state = {'started': -1, 'done': 0, 'started_at': time.monotonic()}
+
+        def on_start(index):
+            state['started'] = index
+            state['started_at'] = time.monotonic()
+            budget.current_command = commands[index]
+
+        def on_result(index, output, start_time, end_time):
+            cmd = commands[index]
+            # 批量执行时各命令输出经同一通道返回，耗时全部计入exec
+            timer.command(cmd, time.monotonic() - state['started_at'])
+            logfile_handler.write(f"Command: {cmd}\n{output}\n")
+            logfile_handler.flush()
+            self.send_instant_result(
+                device_info['name'],
+                device_info['ip'],
+                device_info['device_type'],
+                device_info['os_type'],
+                cmd,
+                output,
+                start_time,
+                end_time
+            )
+            self.progress.incr('completed_commands')
+            state['done'] = index + 1
+
+        try:
+            budget.check(commands[0])
+            run_batch(ssh, commands, budget.command_timeout_for, on_start, on_result)
+            return []
+        except Exception as e:
+            if state['started'] < 0:
+                logger.warning(f"{device_info['name']}({device_info['ip']})批量执行失败，改为逐条执行: {str(e)}")
+                return commands
+            cmd = commands[state['done']]
+            self.progress.incr('failed_commands')
+            self._record_command_error(device_info, cmd, e)
+            self._send_error_sync(f"SSH命令 {cmd} 失败: {str(e)}")
+            self.progress.incr('completed_commands')
+            return commands[state['done'] + 1:]
+        finally:
+            budget.current_command = None
+
+    def _send_error_sync(self, error_msg):
+        """错误信息同理"""
+        logger.error(error_msg)
+        if self.main_loop.is_closed():
+            # 任务超时结束后才退出的工作线程，只记录日志
+            return
+        asyncio.run_coroutine_threadsafe(
+            self.send_error_message(error_msg),
+            self.main_loop
+        )
+    
+    def send_instant_result(self, device_name, device_ip, device_type,os_type, command, result, start_time, end_time):
+        # 记录结果到报告结果文件
+        if self.current_report_id: 
+            self.result_spool.append({ 
+                'device': device_name,
+                'device_ip': device_ip,
+                'os_type': os_type,
+                'command': command,
+                'result': result,
+                'timestamp': datetime.now().isoformat(),
+                'start_time': start_time,
+                'end_time': end_time,
+                'status': 'success'
+            })
+        if self.shard:
+            # 分片任务的结果由协调者推送给前端
+            return
+        if self.main_loop.is_closed():
+            # 任务超时结束后才退出的工作线程，结果已写入结果文件，不再推送
+            return
+
+        # 发送即时结果
+        asyncio.run_coroutine_threadsafe(
+            self.command_result({
+                "type": "command.result",
+                "device_name": device_name,
+                "device_type": device_type,
+                "os_type": os_type,
+                "device_ip": device_ip,
+                "command": command,
+                "result": result,
+                'send_time':datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            }),
+            self.main_loop
+        )
+        
+    def _queue_stats(self):
+        """进度消息中的排队情况"""
+        queue_stats = self.scheduler.job_stats(self.current_report_id)
+        return {
+            'queued': queue_stats['queued'], # 本任务排队中的设备数
+            'running': queue_stats['running'], # 本任务执行中的设备数
+            'global_queued': queue_stats['global_queued'], # 所有任务排队中的设备数
+            'concurrency': self.concurrency.limit if self.concurrency else None, # 当前并发上限
+            'priority': queue_stats['priority'], # 调度优先级
+            'ahead': queue_stats['ahead'], # 优先级更高的任务中排队的设备数
+        }
+
+    async def send_completion_message(self):
+        report_id = self.current_report_id 
+        if report_id in self.reports: 
+            # 生成报告文件
+            report_data = self.reports[report_id] 
+            report_data['end_time'] = datetime.now().isoformat()
+            report_data['status'] = 'timeout' if self.timed_out else 'completed'
+            if self.shard:
+                await self._send_shard_done(report_data)
+                return
+            self.result_spool.close()
+            self.checkpoint.close()
+            await asyncio.get_event_loop().run_in_executor(None, self.timings.save, self.execute_dir, report_id)
+            
+            # 异步生成报告文件
+            await asyncio.get_event_loop().run_in_executor( 
+                None, 
+                self.generate_report_file, 
+                report_id,
+                report_data,
+                self.execute_type
+            )
+            # 直接发送给当前连接
+            await self.emit({
+                "type": "execute.complete", 
+                "message": "所有任务执行完成",
+                "report_id": report_id
+            })
+            logger.info(f"所有任务执行完成，报告ID：{report_id}，报告信息:{json.dumps(report_data,indent=2)}")
+    async def _send_shard_done(self, report_data):
+        """分片任务结束：推送剩余结果及报告信息，由协调者合并"""
+        await self.result_spool.flush()
+        self.result_spool.close()
+        await self.emit({
+            'type': 'shard.done',
+            'status': report_data['status'],
+            'timed_out': self.timed_out,
+            'items': report_data['items'],
+            'timings': self.timings.summary()['devices'],
+            'concurrency': self.concurrency.history if self.concurrency else [],
+        })
+
+    def generate_report_file(self, report_id, data,execute_type):
+        #生成报告
+        generator = get_report_generator()
+        # 生成html报告
+        generator.generate_report_file(report_id, data,execute_type, output_format='html')
+        # 清理巡检记录缓存，因为巡检记录是根据巡检报告获取的
+        cache.delete('devices_inspections')
+        # 清理命令缓存，生成报告的同时也生成了解析结果，与命令界面的解析结果现实有关系
+        cache.delete('commands')
+
+
+    async def send_error_message(self, error_msg):
+        logger.error(error_msg)
+        await self.emit({
+            "type": "error",
+            "message": error_msg
+        })
+
+    async def command_result(self, event):
+        await self.emit(event)
+
+    async def progress_update(self, event):
+        await self.emit(event)
+
+
+# 配置下发任务
+class ConfigJob(ExecuteJob):
+    """
+    配置下发任务
+    中途断开连接会在设备上留下只下发了一部分的配置，因此不强制执行设备及命令时限：
+    任务时限（CONFIG_JOB_DEADLINE，默认不限制）到达后只停止开始新的设备，命令超时使用netmiko/paramiko的默认值
+    """
+    execute_type = 'config'
+    history_cache_key = 'devices_configs'
+    force_expire = False
+
+    def _job_time_limit(self):
+        return self.time_budget['CONFIG_JOB_DEADLINE']
+
+    def _run_command(self, device_info, command, execute):
+        budget = self._device_budget(device_info)
+        budget.current_command = command
+        try:
+            return execute(None)
+        finally:
+            budget.current_command = None
+
+    def _process_device_sync(self, device_id, commands_ids,server_commands,network_commands):
+        """同步设备处理核心"""
+        try:
+            # 同步获取设备凭证和命令
+            device_info = self._get_device_credentials_sync(device_id)
+            os_type = device_info['os_type']
+            
+            if len(commands_ids)>0:
+                commands_info = self._get_command_credentials_sync(commands_ids)
+                # 根据os_type筛选命令
+                commands = {k: v for k, v in commands_info.items() if os_type in k}
+            if device_info['device_type'] in ['switch', 'router', 'firewall']:
+                network_commands = filter_empty_strings(network_commands)
+                if len(network_commands)>0:
+                    commands['temp_network_commands'] = network_commands
+                self._handle_network_device_sync(device_info, commands)
+            else:
+                server_commands = filter_empty_strings(server_commands)
+                if len(server_commands)>0:
+                    commands['temp_server_commands'] = server_commands
+                #commands = [cmd for cmd in commands if cmd] # 删除空字符串
+                self._handle_generic_device_sync(device_info, commands)
+            #填充报告中的items信息
+            self._record_report_items(device_info, commands)
+        except Exception as e:
+            raise RuntimeError(f"设备处理失败: {str(e)}")
+    
+    def _planned_commands_sync(self, device_info, commands_ids, server_commands, network_commands):
+        """预估耗时使用的命令列表：按os_type筛选的命令集ID及自定义命令"""
+        commands = [commands_id for commands_id in self._get_command_credentials_sync(commands_ids) if device_info['os_type'] in commands_id]
+        if device_info['device_type'] in NETWORK_DEVICE_TYPES:
+            return commands + filter_empty_strings(network_commands)
+        return commands + filter_empty_strings(server_commands)
+
+    def _prefetch_commands_sync(self, commands_ids):
+        """
+        预取命令集，命令集ID对应netconf目录下的配置文件
+        {
+            "hp_comware__ntp":[
+                "cmd1",
+                "cmd2"
+            ],
+            "hp_comware__clock":[
+                "cmd1",
+                "cmd2"
+            ]
+        }
+        
+        """
+        commands_dict = {}
+        for commands_id in commands_ids:
+            commands = []
+            config_file = os.path.join(settings.DIR_INFO['CONF_DIR'],"netconf",f"{commands_id}.conf")
+            try:
+                if os.path.exists(config_file):
+                    with open(config_file, 'r', encoding='utf-8') as file:
+                        for line in file:
+                            commands.append(line.strip())
+            except Exception as e:
+                logger.error(f"获取命令ID {commands_id} 失败: {str(e)}")
+                raise RuntimeError(f"获取命令ID {commands_id} 失败: {str(e)}")
+            if commands_id not in commands_dict:
+                commands_dict[commands_id] = commands
+        return commands_dict
+
+    def _get_command_credentials_sync(self, commands_ids):
+        """同步获取命令集"""
+        if self.commands is None:
+            self.commands = self._prefetch_commands_sync(commands_ids)
+        return {commands_id: self.commands[commands_id] for commands_id in commands_ids if commands_id in self.commands}
+
+    def _handle_network_device_sync(self, device_info, commands):
+        """处理网络设备（命令串行）"""
+        try:
+            with self._network_session(device_info) as conn:
+                # 串行执行命令
+                logger.info(f"开始执行网络命令{json.dumps(commands,indent=4)}")
+                for command_id in commands:
+                    command_name = command_id.split('__')[1]
+                    cmd = commands[command_id]
+                    try:
+                        start_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                        started = time.monotonic()
+                        output = self._run_command(device_info, command_id, lambda timeout: conn.send_config_set(cmd, read_timeout=timeout))
+                        self.timings.device(device_info).command(command_id, time.monotonic() - started)
+                        end_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                        self.send_instant_result(
+                            device_info['name'],
+                            device_info['ip'],
+                            device_info['device_type'],
+                            device_info['os_type'],
+                            command_id,
+                            output,
+                            start_time,
+                            end_time
+                        )
+                    except Exception as e:
+                        self._discard_session(conn)
+                        self.progress.incr('failed_commands')
+                        self._record_command_error(device_info, cmd, e)
+                        self._send_error_sync(f"{device_info['name']}命令 {cmd} 执行失败: {str(e)}")
+                    finally:
+                        self.progress.incr('completed_commands')
+                        conn.save_config()
+        except Exception as e:
+            self.progress.device_status(device_key(device_info), DEVICE_FAILED)
+            self._send_error_sync(f"网络设备连接失败: {str(e)}")
+            raise RuntimeError(f"网络设备连接失败: {str(e)}")
+        finally:
+            self.progress.device_status(device_key(device_info), DEVICE_COMPLETED)
+    def _handle_generic_device_sync(self, device_info, commands):
+        """处理通用SSH设备（命令串行）"""
+        session_log=os.path.join(self.execute_dir,f"{device_info['name']}__{device_info['ip']}.log")
+        logfile_handler = open(session_log,'w')
+        try:
+            with self._device_session(device_info, lambda: self._open_generic_connection(device_info)) as ssh:
+                logger.info(f"成功连接到通用SSH设备 {device_info['name']} ({device_info['ip']}),执行命令列表：{commands}")
+                commands_arr = []
+                for cmd_name in commands:
+                    commands_arr+=commands[cmd_name]
+                commands = commands_arr
+                # 串行执行命令
+                for cmd in commands:
+                    try:
+                        logger.debug(f"{device_info['name']} {device_info['ip']} 执行命令{cmd}")
+                        start_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                        output = self._run_command(device_info, cmd, lambda timeout: self._exec_generic_command(ssh, cmd, timeout, self.timings.device(device_info)))
+                        end_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                        #记录日志
+                        logfile_handler.write(f"Command: {cmd}\n{output}\n")
+                        logfile_handler.flush()
+                        self.send_instant_result(
+                            device_info['name'],
+                            device_info['ip'],
+                            device_info['device_type'],
+                            device_info['os_type'],
+                            cmd,
+                            output,
+                            start_time,
+                            end_time
+                        )
+                    except Exception as e:
+                        self._discard_session(ssh)
+                        self.progress.incr('failed_commands')
+                        self._record_command_error(device_info, cmd, e)
+                        self._send_error_sync(f"SSH命令 {cmd} 失败: {str(e)}")
+                    finally:
+                        self.progress.incr('completed_commands')
+        except Exception as e:
+            self.progress.device_status(device_key(device_info), DEVICE_FAILED)
+            self._send_error_sync(f"SSH连接失败: {str(e)}")
+            raise RuntimeError(f"SSH连接失败: {str(e)}")
+        finally:
+            self.progress.device_status(device_key(device_info), DEVICE_COMPLETED)
+            logfile_handler.close()
+    def generate_report_file(self, report_id, data,execute_type):
+        #生成报告
+        generator = get_report_generator()
+        # 生成html报告
+        generator.generate_report_file(report_id, data,execute_type, output_format='html')
+        # 清理配置下发记录缓存，因为配置下发记录是根据配置下发报告获取的
+        cache.delete('devices_configs')
\ No newline at end of file
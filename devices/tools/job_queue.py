@@ -0,0 +1,416 @@
+import json
+import time
+import uuid
+import asyncio
+import logging
+import threading
+from collections import deque
+
+from django.conf import settings
+
+from devices.tools.runtime_stats import process_id
+from devices.tools.scheduler import PRIORITY_INTERACTIVE
+
+logger = logging.getLogger('devices.job_queue')
+
+# 任务状态
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_COMPLETED = 'completed'
+JOB_FAILED = 'failed'
+JOB_CANCELLED = 'cancelled'
+
+
+def job_queue_config():
+    return getattr(settings, 'EXECUTE_CONFIG', {}).get('JOB_QUEUE', {})
+
+
+def job_queue_mode():
+    """任务执行方式：inline（在websocket连接所在进程内执行）或queue（投递到任务队列，由execute_worker执行）"""
+    return job_queue_config().get('MODE', 'inline')
+
+
+def job_group_name(job_id):
+    """任务的channel group名称，执行过程中的消息都推送到该组"""
+    return f"execute_{job_id}"
+
+
+def build_job_spec(job_id, execute_type, device_ids, command_ids, server_commands, network_commands, engine='thread', preflight=None, priority=None):
+    """任务描述，可被JSON序列化，worker据此重建ExecuteJob"""
+    return {
+        'job_id': job_id,
+        'execute_type': execute_type,
+        'device_ids': device_ids,
+        'command_ids': command_ids,
+        'server_commands': server_commands,
+        'network_commands': network_commands,
+        'engine': engine,
+        'preflight': preflight, # SSH登录前是否探测端口，None表示按配置
+        'priority': priority, # 调度优先级，None表示按设备数确定
+        'created_at': time.time(),
+    }
+
+
+class InMemoryJobQueue:
+    """
+    进程内任务队列，接口与RedisJobQueue一致
+    用于单元测试及无Redis的开发环境，任务由同进程内的JobWorker线程执行，进程退出后任务丢失。
+    """
+
+    def __init__(self, lease_ttl=60, max_attempts=3):
+        self.lease_ttl = lease_ttl
+        self.max_attempts = max_attempts
+        self._cond = threading.Condition()
+        self._pending = deque() # 待执行的job_id，左进右出
+        self._jobs = {} # {job_id: 任务信息}
+        self._leases = {} # {job_id: 租约到期时间}
+
+    def enqueue(self, spec):
+        with self._cond:
+            self._jobs[spec['job_id']] = {
+                'spec': spec,
+                'status': JOB_QUEUED,
+                'attempts': 0,
+                'worker': '',
+                'updated_at': time.time(),
+            }
+            if spec.get('priority') == PRIORITY_INTERACTIVE:
+                # 交互任务放在队首，不等待排在前面的大批量任务
+                self._pending.append(spec['job_id'])
+            else:
+                self._pending.appendleft(spec['job_id'])
+            self._cond.notify()
+        return self.position(spec['job_id'])
+
+    def dequeue(self, worker_id, timeout=5):
+        """取出一个任务并加租约，超时返回None"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while not self._pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+            job_id = self._pending.pop()
+            job = self._jobs[job_id]
+            job.update(status=JOB_RUNNING, worker=worker_id, updated_at=time.time())
+            job['attempts'] += 1
+            self._leases[job_id] = time.monotonic() + self.lease_ttl
+            return job['spec']
+
+    def heartbeat(self, job_id):
+        with self._cond:
+            if job_id in self._leases:
+                self._leases[job_id] = time.monotonic() + self.lease_ttl
+
+    def ack(self, job_id, status=JOB_COMPLETED):
+        with self._cond:
+            self._leases.pop(job_id, None)
+            if job_id in self._jobs:
+                self._jobs[job_id].update(status=status, updated_at=time.time())
+
+    def cancel(self, job_id):
+        """撤回尚未被取出的任务，返回是否撤回成功"""
+        with self._cond:
+            try:
+                self._pending.remove(job_id)
+            except ValueError:
+                return False
+            self._jobs[job_id].update(status=JOB_CANCELLED, updated_at=time.time())
+            return True
+
+    def requeue_stale(self):
+        """租约过期（worker异常退出）的任务重新入队，超过最大尝试次数则置为失败"""
+        now = time.monotonic()
+        requeued = []
+        with self._cond:
+            for job_id, expires in list(self._leases.items()):
+                if expires > now:
+                    continue
+                del self._leases[job_id]
+                job = self._jobs[job_id]
+                if job['attempts'] >= self.max_attempts:
+                    job.update(status=JOB_FAILED, updated_at=time.time())
+                    continue
+                job.update(status=JOB_QUEUED, updated_at=time.time())
+                self._pending.append(job_id) # 放在队首，优先执行
+                requeued.append(job_id)
+            if requeued:
+                self._cond.notify_all()
+        return requeued
+
+    def status(self, job_id):
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            return {key: value for key, value in job.items() if key != 'spec'}
+
+    def position(self, job_id):
+        """任务在队列中的位置，1表示下一个执行，不在队列中返回0"""
+        with self._cond:
+            try:
+                return len(self._pending) - self._pending.index(job_id)
+            except ValueError:
+                return 0
+
+    def stats(self):
+        with self._cond:
+            return {'pending': len(self._pending), 'running': len(self._leases)}
+
+
+class RedisJobQueue:
+    """
+    基于Redis的持久化任务队列
+    execute:jobs:pending   待执行任务ID列表，LPUSH入队，worker通过BLMOVE原子地移入processing列表
+    execute:jobs:processing 执行中任务ID列表
+    execute:job:<id>       任务信息hash（spec、status、attempts、worker）
+    execute:job:<id>:lease 租约，worker定期续期；worker异常退出后租约过期，任务由requeue_stale重新入队
+    """
+    PENDING_KEY = 'execute:jobs:pending'
+    PROCESSING_KEY = 'execute:jobs:processing'
+    JOB_KEY = 'execute:job:{}'
+    LEASE_KEY = 'execute:job:{}:lease'
+
+    def __init__(self, client=None, lease_ttl=60, max_attempts=3, result_ttl=60*60*24*7):
+        if client is None:
+            import redis
+            client = redis.Redis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=settings.REDIS_DB, password=settings.REDIS_PASSWORD)
+        self.client = client
+        self.lease_ttl = lease_ttl
+        self.max_attempts = max_attempts
+        self.result_ttl = result_ttl # 任务结束后任务信息保留时间
+
+    def enqueue(self, spec):
+        job_id = spec['job_id']
+        pipe = self.client.pipeline()
+        pipe.hset(self.JOB_KEY.format(job_id), mapping={
+            'spec': json.dumps(spec),
+            'status': JOB_QUEUED,
+            'attempts': 0,
+            'worker': '',
+            'updated_at': time.time(),
+        })
+        if spec.get('priority') == PRIORITY_INTERACTIVE:
+            # 交互任务放在队首，不等待排在前面的大批量任务
+            pipe.rpush(self.PENDING_KEY, job_id)
+        else:
+            pipe.lpush(self.PENDING_KEY, job_id)
+        pipe.execute()
+        return self.position(job_id)
+
+    def dequeue(self, worker_id, timeout=5):
+        job_id = self.client.blmove(self.PENDING_KEY, self.PROCESSING_KEY, timeout, 'RIGHT', 'LEFT')
+        if job_id is None:
+            return None
+        job_id = job_id.decode('utf-8')
+        job_key = self.JOB_KEY.format(job_id)
+        pipe = self.client.pipeline()
+        pipe.set(self.LEASE_KEY.format(job_id), worker_id, ex=self.lease_ttl)
+        pipe.hset(job_key, mapping={'status': JOB_RUNNING, 'worker': worker_id, 'updated_at': time.time()})
+        pipe.hincrby(job_key, 'attempts', 1)
+        pipe.hget(job_key, 'spec')
+        spec = pipe.execute()[-1]
+        if spec is None:
+            # 任务信息已过期，丢弃
+            self.client.lrem(self.PROCESSING_KEY, 0, job_id)
+            return None
+        return json.loads(spec)
+
+    def heartbeat(self, job_id):
+        self.client.expire(self.LEASE_KEY.format(job_id), self.lease_ttl)
+
+    def ack(self, job_id, status=JOB_COMPLETED):
+        job_key = self.JOB_KEY.format(job_id)
+        pipe = self.client.pipeline()
+        pipe.lrem(self.PROCESSING_KEY, 0, job_id)
+        pipe.delete(self.LEASE_KEY.format(job_id))
+        pipe.hset(job_key, mapping={'status': status, 'updated_at': time.time()})
+        pipe.expire(job_key, self.result_ttl)
+        pipe.execute()
+
+    def cancel(self, job_id):
+        # LREM成功说明任务尚未被worker取出
+        if not self.client.lrem(self.PENDING_KEY, 0, job_id):
+            return False
+        job_key = self.JOB_KEY.format(job_id)
+        self.client.hset(job_key, mapping={'status': JOB_CANCELLED, 'updated_at': time.time()})
+        self.client.expire(job_key, self.result_ttl)
+        return True
+
+    def requeue_stale(self):
+        requeued = []
+        for job_id in self.client.lrange(self.PROCESSING_KEY, 0, -1):
+            job_id = job_id.decode('utf-8')
+            if self.client.exists(self.LEASE_KEY.format(job_id)):
+                continue
+            job_key = self.JOB_KEY.format(job_id)
+            # 刚被取出、尚未写入租约的任务不处理
+            if time.time() - float(self.client.hget(job_key, 'updated_at') or 0) < self.lease_ttl:
+                continue
+            # LREM成功的worker负责重新入队，避免多个worker重复处理
+            if not self.client.lrem(self.PROCESSING_KEY, 1, job_id):
+                continue
+            attempts = int(self.client.hget(job_key, 'attempts') or 0)
+            if attempts >= self.max_attempts:
+                logger.error(f"任务{job_id}已尝试{attempts}次，不再重试")
+                self.client.hset(job_key, mapping={'status': JOB_FAILED, 'updated_at': time.time()})
+                self.client.expire(job_key, self.result_ttl)
+                continue
+            self.client.hset(job_key, mapping={'status': JOB_QUEUED, 'updated_at': time.time()})
+            self.client.rpush(self.PENDING_KEY, job_id) # 放在队首，优先执行
+            requeued.append(job_id)
+        return requeued
+
+    def status(self, job_id):
+        job = self.client.hgetall(self.JOB_KEY.format(job_id))
+        if not job:
+            return None
+        job = {key.decode('utf-8'): value.decode('utf-8') for key, value in job.items()}
+        job.pop('spec', None)
+        job['attempts'] = int(job.get('attempts') or 0)
+        return job
+
+    def position(self, job_id):
+        pending = [item.decode('utf-8') for item in self.client.lrange(self.PENDING_KEY, 0, -1)]
+        try:
+            return len(pending) - pending.index(job_id)
+        except ValueError:
+            return 0
+
+    def stats(self):
+        return {
+            'pending': self.client.llen(self.PENDING_KEY),
+            'running': self.client.llen(self.PROCESSING_KEY),
+        }
+
+
+def channel_layer_emitter(job_id):
+    """把任务消息推送到任务的channel group，由订阅该组的websocket连接转发给前端"""
+    from channels.layers import get_channel_layer
+    channel_layer = get_channel_layer()
+    group = job_group_name(job_id)
+
+    async def emit(event):
+        await channel_layer.group_send(group, {'type': 'execute.event', 'event': event})
+    return emit
+
+
+class JobWorker:
+    """
+    任务执行器，从任务队列取出任务并执行
+    每个任务在独立线程的事件循环中运行，设备级并发仍由进程级调度器控制
+    """
+
+    def __init__(self, queue, concurrency=2, emitter_factory=channel_layer_emitter, poll_timeout=5):
+        self.queue = queue
+        self.concurrency = concurrency
+        self.emitter_factory = emitter_factory
+        self.poll_timeout = poll_timeout
+        self.worker_id = f"{process_id()}:{uuid.uuid4().hex[:8]}"
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """在后台线程中运行"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run_forever, name="JobWorker", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def run_forever(self):
+        logger.info(f"任务执行器{self.worker_id}启动，并发任务数：{self.concurrency}")
+        last_check = 0
+        while not self._stop.is_set():
+            if time.monotonic() - last_check > self.queue.lease_ttl / 2:
+                last_check = time.monotonic()
+                try:
+                    requeued = self.queue.requeue_stale()
+                    if requeued:
+                        logger.warning(f"重新入队租约过期的任务：{requeued}")
+                except Exception as e:
+                    logger.error(f"检查过期任务失败: {str(e)}")
+            if not self._slots.acquire(timeout=self.poll_timeout):
+                continue
+            try:
+                spec = self.queue.dequeue(self.worker_id, timeout=self.poll_timeout)
+            except Exception as e:
+                self._slots.release()
+                logger.error(f"获取任务失败: {str(e)}")
+                time.sleep(self.poll_timeout)
+                continue
+            if spec is None:
+                self._slots.release()
+                continue
+            threading.Thread(target=self._run_job, args=(spec,), name=f"Job-{spec['job_id']}", daemon=True).start()
+
+    def _run_job(self, spec):
+        job_id = spec['job_id']
+        stop_heartbeat = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat_loop, args=(job_id, stop_heartbeat), daemon=True)
+        heartbeat.start()
+        status = JOB_COMPLETED
+        try:
+            logger.info(f"开始执行任务{job_id}，类型：{spec.get('execute_type')}")
+            asyncio.run(self.run_spec(spec))
+        except Exception as e:
+            status = JOB_FAILED
+            logger.error(f"任务{job_id}执行失败: {str(e)}")
+        finally:
+            stop_heartbeat.set()
+            try:
+                self.queue.ack(job_id, status)
+            except Exception as e:
+                logger.error(f"确认任务{job_id}失败: {str(e)}")
+            self._slots.release()
+
+    async def run_spec(self, spec):
+        from devices.tools.execute_job import ExecuteJob
+        # 分片任务的消息推送给协调者，而不是分片自身的channel group
+        shard = spec.get('shard')
+        job = ExecuteJob.from_spec(spec, self.emitter_factory(shard['reply_to'] if shard else spec['job_id']))
+        await job.run_spec(spec)
+
+    def _heartbeat_loop(self, job_id, stop):
+        while not stop.wait(self.queue.lease_ttl / 3):
+            try:
+                self.queue.heartbeat(job_id)
+            except Exception as e:
+                logger.warning(f"任务{job_id}续期失败: {str(e)}")
+
+
+_job_queue = None
+_local_worker = None
+_job_queue_lock = threading.Lock()
+
+
+def get_job_queue():
+    """获取进程级任务队列单例"""
+    global _job_queue
+    if _job_queue is None:
+        with _job_queue_lock:
+            if _job_queue is None:
+                conf = job_queue_config()
+                queue_class = InMemoryJobQueue if conf.get('BACKEND', 'redis') == 'memory' else RedisJobQueue
+                _job_queue = queue_class(
+                    lease_ttl=conf.get('LEASE_TTL', 60),
+                    max_attempts=conf.get('MAX_ATTEMPTS', 3)
+                )
+    return _job_queue
+
+
+def ensure_local_worker():
+    """进程内队列没有独立的worker进程，在当前进程内启动执行器"""
+    global _local_worker
+    queue = get_job_queue()
+    if not isinstance(queue, InMemoryJobQueue):
+        return
+    with _job_queue_lock:
+        if _local_worker is None:
+            _local_worker = JobWorker(queue, concurrency=job_queue_config().get('WORKER_CONCURRENCY', 2))
+        _local_worker.start()
@@ -0,0 +1,256 @@
+import os
+import heapq
+import logging
+from datetime import datetime
+from statistics import median
+
+from django.conf import settings
+from django.core.cache import cache
+
+from devices.models import Device, Command
+from devices.tools.result_spool import RESULTS_FILE, ResultSpool
+from devices.tools.timing import TIMINGS_FILE, load_timings
+from devices.tools.async_engine import NETWORK_DEVICE_TYPES
+
+logger = logging.getLogger('devices.planner')
+
+HISTORY_CACHE_KEY = 'planner_history:{}'
+
+
+def planner_config():
+    conf = getattr(settings, 'EXECUTE_CONFIG', {}).get('PLANNER', {})
+    return {
+        'MAX_REPORTS': conf.get('MAX_REPORTS', 50), # 参与统计的最近报告数
+        'HISTORY_TTL': conf.get('HISTORY_TTL', 600), # 历史耗时汇总的缓存时间（秒）
+        'DEFAULT_COMMAND_SECONDS': conf.get('DEFAULT_COMMAND_SECONDS', 2), # 没有任何历史数据时单条命令的耗时
+        'CONNECT_SECONDS': conf.get('CONNECT_SECONDS', 3), # 建连及登录耗时
+        'SLOW_FACTOR': conf.get('SLOW_FACTOR', 3), # 预计耗时超过中位数该倍数的设备视为慢设备
+        'LPT_ORDER': conf.get('LPT_ORDER', True), # 执行时按预计耗时从长到短下发设备
+    }
+
+
+def planned_concurrency():
+    """任务开始时的并发数：启用自适应并发时为初始并发数，否则为全局工作线程数"""
+    conf = getattr(settings, 'EXECUTE_CONFIG', {})
+    max_workers = conf.get('SCHEDULER', {}).get('MAX_WORKERS', 50)
+    adaptive = conf.get('ADAPTIVE_CONCURRENCY', {})
+    if adaptive.get('ENABLED', False):
+        return min(adaptive.get('INITIAL', 20), max_workers)
+    return max_workers
+
+
+def device_key(name, ip):
+    return f"{name}@{ip}"
+
+
+def resolve_commands(device_info, command_info, server_commands, network_commands):
+    """根据设备os_type筛选命令，并合并自定义命令"""
+    commands = [command['command_text'] for command in command_info if command['os_type'] == device_info['os_type']]
+    if device_info['device_type'] in NETWORK_DEVICE_TYPES:
+        commands = commands + network_commands # 合并命令
+    else:
+        commands = commands + server_commands # 合并命令
+    return list(set(commands)) # 去重
+
+
+def _parse_time(value):
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _command_timings(execute_dir):
+    """报告的各命令耗时（timings.json，单调时钟计时），没有或无法读取时返回None"""
+    try:
+        timings = load_timings(execute_dir)
+    except (OSError, ValueError) as e:
+        logger.warning(f"读取耗时统计{execute_dir}失败: {str(e)}")
+        return None
+    if timings is None:
+        return None
+    return [
+        (device_key(device['device'], device['device_ip']), device['os_type'], item['command'], item['exec'] + item['transfer'])
+        for device in timings.get('devices', []) for item in device.get('commands', [])
+    ]
+
+
+def _report_summary(path):
+    """
+    单份报告的耗时汇总（各键的耗时中位数），报告完成后结果文件不再变化，按文件路径及修改时间长期缓存
+    命令耗时取报告目录中timings.json的精确耗时；较早的报告没有timings.json，按结果中秒级的start_time/end_time计算
+    """
+    execute_dir = os.path.dirname(path)
+    timings_path = os.path.join(execute_dir, TIMINGS_FILE)
+    timings_mtime = int(os.path.getmtime(timings_path)) if os.path.exists(timings_path) else 0
+    key = f"planner_report:{path}:{int(os.path.getmtime(path))}:{timings_mtime}"
+    summary = cache.get(key)
+    if summary is not None:
+        return summary
+    samples = _command_timings(execute_dir) if timings_mtime else None
+    precise = samples is not None
+    samples = samples or []
+    timeouts = {}
+    for record in ResultSpool(path):
+        device = device_key(record.get('device'), record.get('device_ip'))
+        if record.get('status') == 'timeout':
+            timeouts[device] = timeouts.get(device, 0) + 1
+            continue
+        if precise:
+            continue
+        start, end = _parse_time(record.get('start_time')), _parse_time(record.get('end_time'))
+        if start is None or end is None:
+            continue
+        samples.append((device, record.get('os_type'), record.get('command'), max(0.0, (end - start).total_seconds())))
+    device_command, os_type_command, os_type = {}, {}, {}
+    for device, device_os_type, command, seconds in samples:
+        device_command.setdefault((device, command), []).append(seconds)
+        os_type_command.setdefault((device_os_type, command), []).append(seconds)
+        os_type.setdefault(device_os_type, []).append(seconds)
+    summary = {
+        'device_command': {key: median(values) for key, values in device_command.items()},
+        'os_type_command': {key: median(values) for key, values in os_type_command.items()},
+        'os_type': {key: median(values) for key, values in os_type.items()},
+        'timeouts': timeouts,
+    }
+    cache.set(key, summary, 60*60*24*7)
+    return summary
+
+
+def load_history(execute_type='inspect'):
+    """
+    汇总最近报告的命令耗时（见_report_summary），各报告的中位数再取中位数
+    :return: {
+        'device_command': {(设备, 命令): 耗时},
+        'os_type_command': {(os_type, 命令): 耗时},
+        'os_type': {os_type: 单条命令耗时},
+        'timeouts': {设备: 超时次数},
+        'reports': 参与统计的报告数,
+    }
+    """
+    conf = planner_config()
+    key = HISTORY_CACHE_KEY.format(execute_type)
+    history = cache.get(key)
+    if history is not None:
+        return history
+    report_dir = os.path.join(settings.DIR_INFO['REPORT_DIR'], execute_type)
+    results_files = []
+    if os.path.isdir(report_dir):
+        for report_id in os.listdir(report_dir):
+            path = os.path.join(report_dir, report_id, RESULTS_FILE)
+            if os.path.exists(path):
+                results_files.append((os.path.getmtime(path), path))
+    results_files.sort(reverse=True)
+    samples = {'device_command': {}, 'os_type_command': {}, 'os_type': {}}
+    timeouts = {}
+    for _, path in results_files[:conf['MAX_REPORTS']]:
+        summary = _report_summary(path)
+        for field, values in samples.items():
+            for item, seconds in summary[field].items():
+                values.setdefault(item, []).append(seconds)
+        for device, count in summary['timeouts'].items():
+            timeouts[device] = timeouts.get(device, 0) + count
+    history = {field: {item: median(values) for item, values in samples[field].items()} for field in samples}
+    history['timeouts'] = timeouts
+    history['reports'] = min(len(results_files), conf['MAX_REPORTS'])
+    cache.set(key, history, conf['HISTORY_TTL'])
+    return history
+
+
+def estimate_device(device_info, commands, history, conf=None):
+    """
+    预计单台设备的执行耗时（秒）
+    每条命令依次取：该设备该命令的历史耗时、同os_type该命令的历史耗时、同os_type所有命令的耗时、默认耗时
+    :return: (耗时, 数据来源)，来源为history/os_type/default中最粗略的一级
+    """
+    conf = conf or planner_config()
+    device = device_key(device_info['name'], device_info['ip'])
+    levels = ['history', 'os_type', 'default']
+    source = 0
+    seconds = conf['CONNECT_SECONDS']
+    for command in commands:
+        if (device, command) in history['device_command']:
+            seconds += history['device_command'][(device, command)]
+        elif (device_info['os_type'], command) in history['os_type_command']:
+            seconds += history['os_type_command'][(device_info['os_type'], command)]
+            source = max(source, 1)
+        elif device_info['os_type'] in history['os_type']:
+            seconds += history['os_type'][device_info['os_type']]
+            source = max(source, 1)
+        else:
+            seconds += conf['DEFAULT_COMMAND_SECONDS']
+            source = 2
+    return seconds, levels[source]
+
+
+def simulate_makespan(durations, concurrency):
+    """按给定顺序把设备分配给最先空闲的并发槽位，返回总耗时"""
+    slots = [0.0] * max(1, min(concurrency, len(durations) or 1))
+    heapq.heapify(slots)
+    for duration in durations:
+        heapq.heappush(slots, heapq.heappop(slots) + duration)
+    return max(slots)
+
+
+def plan_job(devices, command_info, server_commands, network_commands, concurrency=None, execute_type='inspect'):
+    """
+    预估任务耗时并生成下发顺序（预计耗时长的设备先执行，缩短整体耗时）
+    :param devices: 设备信息列表（含id、name、ip、os_type、device_type）
+    :param command_info: 命令信息列表（含command_text、os_type）
+    """
+    conf = planner_config()
+    history = load_history(execute_type)
+    concurrency = concurrency or planned_concurrency()
+    estimates = []
+    for device_info in devices:
+        commands = resolve_commands(device_info, command_info, server_commands, network_commands)
+        seconds, source = estimate_device(device_info, commands, history, conf)
+        estimates.append({
+            'device_id': device_info['id'],
+            'name': device_info['name'],
+            'ip': device_info['ip'],
+            'os_type': device_info['os_type'],
+            'commands': len(commands),
+            'estimate': round(seconds, 2),
+            'source': source,
+            'timeouts': history['timeouts'].get(device_key(device_info['name'], device_info['ip']), 0),
+        })
+    typical = median([item['estimate'] for item in estimates]) if estimates else 0
+    for item in estimates:
+        item['slow'] = item['timeouts'] > 0 or (typical > 0 and item['estimate'] >= typical * conf['SLOW_FACTOR'])
+    ordered = sorted(estimates, key=lambda item: item['estimate'], reverse=True)
+    return {
+        'concurrency': concurrency,
+        'history_reports': history['reports'],
+        'estimated_seconds': round(simulate_makespan([item['estimate'] for item in ordered], concurrency), 2),
+        # 按提交顺序下发时的预计耗时，用于对比
+        'unordered_seconds': round(simulate_makespan([item['estimate'] for item in estimates], concurrency), 2),
+        'total_device_seconds': round(sum(item['estimate'] for item in estimates), 2),
+        'dispatch_order': [item['device_id'] for item in ordered],
+        'slow_devices': [item for item in ordered if item['slow']],
+        'devices': ordered,
+    }
+
+
+def plan_inspection(device_ids, command_ids, server_commands, network_commands, concurrency=None):
+    """按页面提交的设备ID、命令ID生成巡检计划（不连接设备）"""
+    order = {str(device_id): index for index, device_id in enumerate(device_ids)}
+    devices = [
+        {
+            'id': device.id,
+            'name': device.name,
+            'ip': device.ip_address,
+            'os_type': device.os_type,
+            'device_type': device.device_type,
+        }
+        for device in Device.objects.filter(id__in=[int(device_id) for device_id in device_ids if device_id])
+    ]
+    # 保持页面提交的顺序，用于对比按预计耗时排序前后的总耗时
+    devices.sort(key=lambda device: order.get(str(device['id']), len(order)))
+    command_info = [
+        {'os_type': command.os_type.name, 'command_text': command.command_text}
+        for command in Command.objects.filter(id__in=[command_id for command_id in command_ids if command_id]).select_related('os_type')
+    ]
+    server_commands = [cmd for cmd in server_commands if cmd]
+    network_commands = [cmd for cmd in network_commands if cmd]
+    return plan_job(devices, command_info, server_commands, network_commands, concurrency)
@@ -0,0 +1,48 @@
+import time
+import asyncio
+import logging
+
+from django.conf import settings
+
+logger = logging.getLogger('devices.preflight')
+
+
+def preflight_config():
+    return getattr(settings, 'EXECUTE_CONFIG', {}).get('PREFLIGHT', {})
+
+
+async def tcp_probe(host, port, timeout=3):
+    """
+    探测TCP端口是否可连接
+    :return: (是否可达, 失败原因, 耗时秒数)
+    """
+    started = time.monotonic()
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    except asyncio.TimeoutError:
+        return False, f"连接{host}:{port}超时（{timeout}秒）", time.monotonic() - started
+    except OSError as e:
+        return False, f"连接{host}:{port}失败: {e.strerror or str(e)}", time.monotonic() - started
+    latency = time.monotonic() - started
+    writer.close()
+    try:
+        await asyncio.wait_for(writer.wait_closed(), 1)
+    except Exception:
+        pass
+    return True, '', latency
+
+
+async def tcp_sweep(targets, timeout=3, concurrency=2000):
+    """
+    并发探测一批设备的SSH端口
+    :param targets: {键: (host, port)}
+    :return: {键: (是否可达, 失败原因, 耗时秒数)}
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def probe(key, host, port):
+        async with semaphore:
+            return key, await tcp_probe(host, port, timeout)
+
+    results = await asyncio.gather(*[probe(key, host, port) for key, (host, port) in targets.items()])
+    return dict(results)
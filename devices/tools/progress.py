@@ -0,0 +1,184 @@
+import time
+import asyncio
+import logging
+from datetime import datetime
+from threading import Lock
+
+from django.conf import settings
+
+logger = logging.getLogger('devices.progress')
+
+# 设备状态
+DEVICE_RUNNING = 'running'
+DEVICE_COMPLETED = 'completed'
+DEVICE_FAILED = 'failed'
+DEVICE_TIMEOUT = 'timeout'
+
+
+def device_key(device_info):
+    """进度中标识设备的键，设备名称可能重复，与IP一起区分（与检查点、分片结果一致）"""
+    return f"{device_info['name']}({device_info['ip']})"
+
+
+class ProgressAggregator:
+    """
+    任务进度聚合器
+    工作线程只在内存中累加计数和记录设备状态变化，由事件循环上的刷新协程按固定间隔（或累计事件数达到上限时）
+    合并推送一帧progress.update：计数为当前累计值，devices只包含上一帧之后状态发生变化的设备。
+    """
+
+    def __init__(self, emit, counters, extra=None, interval=0.25, max_events=200):
+        """
+        :param emit: 协程函数，推送消息
+        :param counters: 初始计数，如{'total': 10, 'completed': 0}
+        :param extra: 无参函数，刷新时调用，返回附加到消息中的字段（如调度器排队情况）
+        :param interval: 刷新间隔（秒）
+        :param max_events: 累计事件数达到该值时立即刷新
+        """
+        self.emit = emit
+        self.counters = dict(counters)
+        self.extra = extra
+        self.interval = interval
+        self.max_events = max_events
+        self._lock = Lock()
+        self._device_changes = {} # 上一帧之后的设备状态变化 {设备键: 状态}，设备键见device_key
+        self._device_status = {}
+        self._finished = set() # 已计入completed的设备
+        self._pending_events = 0
+        self._seq = 0
+        self._loop = None
+        self._wakeup = None
+        self._task = None
+        self.frames = 0 # 已推送的帧数
+        self.events = 0 # 已合并的事件数
+
+    @classmethod
+    def from_settings(cls, emit, counters, extra=None):
+        conf = getattr(settings, 'EXECUTE_CONFIG', {}).get('PROGRESS', {})
+        return cls(
+            emit,
+            counters,
+            extra=extra,
+            interval=conf.get('FLUSH_INTERVAL', 0.25),
+            max_events=conf.get('FLUSH_EVENTS', 200),
+        )
+
+    def start(self):
+        """在当前事件循环上启动刷新协程"""
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._task = self._loop.create_task(self._flush_loop())
+
+    async def stop(self):
+        """停止刷新协程并推送最后一帧"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def incr(self, counter, value=1):
+        """累加计数，可在任意线程中调用"""
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+            self._add_event_locked()
+
+    def device_status(self, device, status):
+        """
+        记录设备状态变化，可在任意线程中调用
+        failed计入failed_devices；completed计入completed，已失败的设备保持failed状态
+        timeout计入timeout_devices并视为已完成，之后的completed不再重复计数
+        """
+        with self._lock:
+            previous = self._device_status.get(device)
+            if status == DEVICE_FAILED:
+                self.counters['failed_devices'] = self.counters.get('failed_devices', 0) + 1
+            elif status == DEVICE_TIMEOUT:
+                self.counters['timeout_devices'] = self.counters.get('timeout_devices', 0) + 1
+                self._finish_locked(device)
+            elif status == DEVICE_COMPLETED:
+                self._finish_locked(device)
+                if previous in (DEVICE_FAILED, DEVICE_TIMEOUT):
+                    status = previous
+            if previous != status:
+                self._device_status[device] = status
+                self._device_changes[device] = status
+            self._add_event_locked()
+
+    def merge(self, counters, devices=None):
+        """
+        合并其它进程（如任务分片）的进度，可在任意线程中调用
+        :param counters: 计数增量
+        :param devices: 设备状态变化，对方已计入counters，这里只更新状态不再计数
+        """
+        with self._lock:
+            for counter, value in counters.items():
+                self.counters[counter] = self.counters.get(counter, 0) + value
+            for device, status in (devices or {}).items():
+                if self._device_status.get(device) != status:
+                    self._device_status[device] = status
+                    self._device_changes[device] = status
+            self._add_event_locked()
+
+    def touch(self):
+        """不改变计数，仅要求推送一帧（如设备提交到调度器后推送排队情况）"""
+        with self._lock:
+            self._add_event_locked()
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.counters)
+
+    async def flush(self):
+        """推送一帧，没有变化时不推送"""
+        with self._lock:
+            if not self._pending_events:
+                return
+            self.events += self._pending_events
+            self._pending_events = 0
+            changes, self._device_changes = self._device_changes, {}
+            self._seq += 1
+            frame = dict(self.counters)
+            frame['seq'] = self._seq
+        frame['type'] = 'progress.update'
+        if changes:
+            frame['devices'] = changes
+        if self.extra:
+            frame.update(self.extra())
+        frame['send_time'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        self.frames += 1
+        await self.emit(frame)
+
+    # --------------------------
+    # 内部方法
+    # --------------------------
+    def _finish_locked(self, device):
+        if device not in self._finished:
+            self._finished.add(device)
+            self.counters['completed'] = self.counters.get('completed', 0) + 1
+
+    def _add_event_locked(self):
+        self._pending_events += 1
+        if self._pending_events >= self.max_events and self._loop is not None:
+            # 事件过多时提前唤醒刷新协程
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def _flush_loop(self):
+        while True:
+            started = time.monotonic()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.warning(f"推送进度失败: {str(e)}")
+            # 两帧之间至少间隔interval的一半，避免事件密集时刷新过于频繁
+            elapsed = time.monotonic() - started
+            if elapsed < self.interval / 2:
+                await asyncio.sleep(self.interval / 2 - elapsed)
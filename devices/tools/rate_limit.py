@@ -0,0 +1,206 @@
+import time
+import asyncio
+import ipaddress
+import logging
+import threading
+from contextlib import contextmanager, asynccontextmanager
+
+from django.conf import settings
+
+logger = logging.getLogger('devices.rate_limit')
+
+
+class TokenBucket:
+    """令牌桶，rate为每秒补充的令牌数，burst为桶容量；调用方需自行加锁"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or max(1, rate))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        """获取一个令牌还需等待的秒数"""
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate if self.rate > 0 else 1
+
+    def consume(self):
+        self.tokens -= 1
+
+
+class _Limit:
+    """单个限制键（如某个子网）的令牌桶及同时登录数"""
+    __slots__ = ('name', 'bucket', 'max_concurrent', 'active')
+
+    def __init__(self, name, conf):
+        self.name = name
+        self.bucket = TokenBucket(conf['RATE'], conf.get('BURST')) if conf.get('RATE') else None
+        self.max_concurrent = conf.get('MAX_CONCURRENT')
+        self.active = 0
+
+
+class ConnectionRateLimiter:
+    """
+    设备建连限速器
+    按子网（由设备IP及前缀长度得出）、os_type、站点分别限制建连速率（令牌桶）及同时登录的连接数，
+    避免同一网段、同一AAA服务器后的设备同时被大量登录而触发设备侧的登录限制。
+    规则示例：
+    {
+        'SUBNET_PREFIX': 24,
+        'SUBNET': {'*': {'RATE': 5, 'BURST': 10}, '10.1.1.0/24': {'RATE': 1}},
+        'OS_TYPE': {'hp_comware': {'RATE': 2, 'BURST': 4, 'MAX_CONCURRENT': 4}},
+        'SITE': {'*': {'RATE': 20}},
+        'SITES': {'机房A': ['10.1.0.0/16', '10.2.0.0/16']},
+    }
+    '*'为该维度的默认规则，未配置的维度不限制。
+    """
+
+    def __init__(self, rules=None):
+        rules = rules or {}
+        self.subnet_prefix = rules.get('SUBNET_PREFIX', 24)
+        self.rules = {
+            'subnet': rules.get('SUBNET', {}),
+            'os_type': rules.get('OS_TYPE', {}),
+            'site': rules.get('SITE', {}),
+        }
+        self.sites = [
+            (site, ipaddress.ip_network(network, strict=False))
+            for site, networks in rules.get('SITES', {}).items()
+            for network in networks
+        ]
+        self._cond = threading.Condition()
+        self._limits = {} # {(维度, 键): _Limit}
+        self._stats = {'acquired': 0, 'waits': 0, 'wait_seconds': 0.0}
+
+    @classmethod
+    def from_settings(cls):
+        conf = getattr(settings, 'EXECUTE_CONFIG', {}).get('RATE_LIMIT', {})
+        return cls(conf if conf.get('ENABLED', False) else {})
+
+    def keys_for(self, device_info):
+        """设备所属的限制键 [(维度, 键)]"""
+        keys = []
+        try:
+            address = ipaddress.ip_address(device_info['ip'])
+        except ValueError:
+            address = None
+        if address is not None:
+            subnet = ipaddress.ip_network(f"{address}/{self.subnet_prefix}", strict=False)
+            keys.append(('subnet', str(subnet)))
+            for site, network in self.sites:
+                if address in network:
+                    keys.append(('site', site))
+                    break
+        if device_info.get('os_type'):
+            keys.append(('os_type', device_info['os_type']))
+        return keys
+
+    def _limits_for(self, device_info):
+        limits = []
+        for dimension, key in self.keys_for(device_info):
+            rules = self.rules[dimension]
+            conf = rules.get(key) or rules.get('*')
+            if not conf:
+                continue
+            limit = self._limits.get((dimension, key))
+            if limit is None:
+                limit = _Limit(f"{dimension}:{key}", conf)
+                self._limits[(dimension, key)] = limit
+            limits.append(limit)
+        return limits
+
+    def _try_acquire_locked(self, limits):
+        """所有限制都满足时一次性占用，返回需要等待的秒数，0表示已占用"""
+        now = time.monotonic()
+        wait = 0
+        for limit in limits:
+            if limit.max_concurrent and limit.active >= limit.max_concurrent:
+                wait = max(wait, 0.05)
+            if limit.bucket:
+                wait = max(wait, limit.bucket.wait_time(now))
+        if wait:
+            return wait
+        for limit in limits:
+            if limit.bucket:
+                limit.bucket.consume()
+            limit.active += 1
+        self._stats['acquired'] += 1
+        return 0
+
+    def _release(self, limits):
+        with self._cond:
+            for limit in limits:
+                limit.active -= 1
+            self._cond.notify_all()
+
+    def _record_wait(self, waited):
+        if waited:
+            with self._cond:
+                self._stats['waits'] += 1
+                self._stats['wait_seconds'] += waited
+
+    @contextmanager
+    def connecting(self, device_info):
+        """建连前获取许可，块结束（登录完成或失败）后释放同时登录数"""
+        started = time.monotonic()
+        with self._cond:
+            limits = self._limits_for(device_info)
+            while True:
+                wait = self._try_acquire_locked(limits)
+                if not wait:
+                    break
+                self._cond.wait(wait)
+        waited = time.monotonic() - started
+        if waited > 0.01:
+            logger.debug(f"设备{device_info['ip']}等待建连许可{waited:.2f}秒")
+            self._record_wait(waited)
+        try:
+            yield
+        finally:
+            self._release(limits)
+
+    @asynccontextmanager
+    async def connecting_async(self, device_info):
+        """connecting的协程版本，等待期间不阻塞事件循环"""
+        started = time.monotonic()
+        while True:
+            with self._cond:
+                limits = self._limits_for(device_info)
+                wait = self._try_acquire_locked(limits)
+            if not wait:
+                break
+            await asyncio.sleep(wait)
+        waited = time.monotonic() - started
+        if waited > 0.01:
+            self._record_wait(waited)
+        try:
+            yield
+        finally:
+            self._release(limits)
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats['wait_seconds'] = round(stats['wait_seconds'], 3)
+            stats['active'] = {limit.name: limit.active for limit in self._limits.values() if limit.active}
+            return stats
+
+
+_rate_limiter = None
+_rate_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    """获取进程级建连限速器单例"""
+    global _rate_limiter
+    if _rate_limiter is None:
+        with _rate_limiter_lock:
+            if _rate_limiter is None:
+                _rate_limiter = ConnectionRateLimiter.from_settings()
+    return _rate_limiter
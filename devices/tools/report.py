@@ -1,17 +1,175 @@
 import html 
+import gzip
 import logging 
+import tempfile
+import time
+from threading import Lock
 from datetime import datetime 
 from pathlib import Path 
-from jinja2 import Environment, FileSystemLoader, select_autoescape 
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache, select_autoescape 
 from devices.models import Device
-from devices.serializers import DeviceSerializer
 from django.conf import settings
 import os
 import sys
 #from .tools_songhz import list_write_csv
 from devices.tools.tools_songhz import list_write_csv
+from devices.tools.result_spool import ResultSpool
+from devices.tools.textfsm_parse import TextFSMPipeline
 import csv
 
+logger = logging.getLogger('devices.report')
+
+REPORT_TEMPLATE = 'report2.html'
+REPORT_FILE = 'index.html'
+REPORT_GZIP_FILE = 'index.html.gz'
+DEVICE_QUERY_BATCH = 500 # 批量查询设备时每条语句的设备数
+
+_environment = None
+_environment_lock = Lock()
+_generator = None
+_generator_lock = Lock()
+
+
+def report_config():
+    conf = getattr(settings, 'EXECUTE_CONFIG', {}).get('REPORT', {})
+    return {
+        # 模板编译结果的缓存目录，进程重启后无需重新编译，为空时不缓存
+        'BYTECODE_CACHE_DIR': conf.get('BYTECODE_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'device_manager_jinja')),
+        'AUTO_RELOAD': conf.get('AUTO_RELOAD', True), # 模板文件修改后（按修改时间判断）自动重新编译
+        'GZIP': conf.get('GZIP', False), # 报告边渲染边压缩，写入index.html.gz
+        'GZIP_LEVEL': conf.get('GZIP_LEVEL', 6),
+        'WRITE_BUFFER': conf.get('WRITE_BUFFER', 256*1024), # 渲染输出累计该字符数后写入文件
+    }
+
+
+def report_file_path(report_dir):
+    """报告目录中的html报告文件，压缩保存时为index.html.gz，不存在时返回None"""
+    for filename in (REPORT_FILE, REPORT_GZIP_FILE):
+        path = os.path.join(report_dir, filename)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def write_stream(file, chunks, buffer_size):
+    """把模板逐段生成的输出合并成较大的块写入文件，返回写入的字符数"""
+    buffer, buffered, written = [], 0, 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        buffered += len(chunk)
+        if buffered >= buffer_size:
+            file.write(''.join(buffer))
+            written += buffered
+            buffer, buffered = [], 0
+    if buffer:
+        file.write(''.join(buffer))
+        written += buffered
+    return written
+
+
+def report_template_paths():
+    return [
+        '/opt/app/templates',
+        os.path.join(settings.BASE_DIR, 'devices/conf/template')
+    ]
+
+
+def static_url(filename: str) -> str:
+    """智能定位静态资源"""
+    for path in [os.path.join(settings.BASE_DIR,  'static')]:
+        full_path = Path(path) / filename 
+        if full_path.exists(): 
+            return f"file://{full_path.absolute()}" 
+    return ""
+
+
+def format_timestamp(value, format_str: str = "%Y-%m-%d %H:%M:%S %Z") -> str:
+    """
+    时间戳格式化（支持多种输入类型）
+    :param value: 输入时间（支持datetime、字符串、Unix时间戳）
+    :param format_str: 输出格式（默认：2025-02-20 16:43:00 UTC+8）
+    :return: 格式化后的时间字符串 
+    """
+    if not value:
+        return "N/A"
+        
+    try:
+        # 统一转换为datetime对象 
+        if isinstance(value, datetime):
+            dt = value 
+        elif isinstance(value, (int, float)):
+            dt = datetime.fromtimestamp(value) 
+        elif isinstance(value, str):
+            if value.isdigit(): 
+                dt = datetime.fromtimestamp(int(value)) 
+            else:
+                dt = datetime.fromisoformat(value) 
+        else:
+            raise ValueError("不支持的时间格式")
+        
+        # 自动添加时区信息（如未包含）
+        if not dt.tzinfo: 
+            dt = dt.astimezone()   # 使用系统时区 
+            
+        return dt.strftime(format_str) 
+        
+    except Exception as e:
+        logger.warning(f" 时间格式化失败: {str(e)}")
+        return f"Invalid Time: {str(value)}"
+
+
+def build_report_environment(bytecode_cache_dir=None, auto_reload=True):
+    """创建报告模板环境"""
+    bytecode_cache = None
+    if bytecode_cache_dir:
+        try:
+            os.makedirs(bytecode_cache_dir, exist_ok=True)
+            bytecode_cache = FileSystemBytecodeCache(str(bytecode_cache_dir))
+        except OSError as e:
+            logger.warning(f"模板缓存目录{bytecode_cache_dir}不可用: {str(e)}")
+    env = Environment(
+        loader=FileSystemLoader(report_template_paths()), 
+        extensions=['jinja2.ext.do'],   # 启用扩展功能 
+        autoescape=select_autoescape(['html', 'xml']),
+        trim_blocks=True,
+        lstrip_blocks=True,
+        bytecode_cache=bytecode_cache,
+        auto_reload=auto_reload
+    )
+    env.filters.update({
+        'format_time': format_timestamp 
+    })
+    # 添加静态路径处理函数 
+    env.globals.update({ 
+        'static': static_url,
+    })
+    return env
+
+
+def get_report_environment():
+    """
+    进程内共用的报告模板环境
+    编译后的模板缓存在环境中，auto_reload时每次获取模板检查文件修改时间，模板修改后重新编译
+    """
+    global _environment
+    if _environment is None:
+        with _environment_lock:
+            if _environment is None:
+                conf = report_config()
+                _environment = build_report_environment(conf['BYTECODE_CACHE_DIR'], conf['AUTO_RELOAD'])
+    return _environment
+
+
+def get_report_generator():
+    """进程内共用的报告生成器"""
+    global _generator
+    if _generator is None:
+        with _generator_lock:
+            if _generator is None:
+                _generator = ReportGenerator()
+    return _generator
+
+
 class ThemeManager:
     """多主题样式加载器"""
     THEMES = {
@@ -25,63 +183,22 @@ class ThemeManager:
 
 
 class ReportGenerator:
-    """专业报告生成器（完整实现版）"""
+    """
+    专业报告生成器（完整实现版）
+    不保存单次报告的状态，可被多个线程同时使用，通过get_report_generator获取共用的实例
+    """
     
     def __init__(self):
         # 初始化配置 
-        self.template_paths  = [
-            '/opt/app/templates',
-            os.path.join(settings.BASE_DIR, 'devices/conf/template')
-        ]
-        # 静态资源路径
-        self.static_paths  = [
-            os.path.join(settings.BASE_DIR,  'static')
-        ]
-        self.report_dir = ''
+        self.template_paths  = report_template_paths()
         self.textfsm_csv_dir = os.path.join(settings.DIR_INFO['REPORT_DIR'],'textfsm')
         self.logger  = self._init_logger()
 
     def _get_static_url(self, filename: str) -> str:
-        """智能定位静态资源"""
-        for path in self.static_paths: 
-            full_path = Path(path) / filename 
-            if full_path.exists(): 
-                return f"file://{full_path.absolute()}" 
-        return ""
+        return static_url(filename)
 
     def _format_timestamp(self, value, format_str: str = "%Y-%m-%d %H:%M:%S %Z") -> str:
-        """
-        时间戳格式化（支持多种输入类型）
-        :param value: 输入时间（支持datetime、字符串、Unix时间戳）
-        :param format_str: 输出格式（默认：2025-02-20 16:43:00 UTC+8）
-        :return: 格式化后的时间字符串 
-        """
-        if not value:
-            return "N/A"
-            
-        try:
-            # 统一转换为datetime对象 
-            if isinstance(value, datetime):
-                dt = value 
-            elif isinstance(value, (int, float)):
-                dt = datetime.fromtimestamp(value) 
-            elif isinstance(value, str):
-                if value.isdigit(): 
-                    dt = datetime.fromtimestamp(int(value)) 
-                else:
-                    dt = datetime.fromisoformat(value) 
-            else:
-                raise ValueError("不支持的时间格式")
-            
-            # 自动添加时区信息（如未包含）
-            if not dt.tzinfo: 
-                dt = dt.astimezone()   # 使用系统时区 
-                
-            return dt.strftime(format_str) 
-            
-        except Exception as e:
-            self.logger.warning(f" 时间格式化失败: {str(e)}")
-            return f"Invalid Time: {str(value)}"
+        return format_timestamp(value, format_str)
 
     def generate_report_file(self, report_id, data, execute_type,output_format='html'):
         """
@@ -92,17 +209,15 @@ class ReportGenerator:
         :return: 生成文件路径 
         """
         try:
-            self.report_dir = os.path.join(settings.DIR_INFO['REPORT_DIR'],execute_type)
-            if not os.path.exists(self.report_dir):
-                os.makedirs(self.report_dir)
+            report_dir = os.path.join(settings.DIR_INFO['REPORT_DIR'],execute_type)
+            if not os.path.exists(report_dir):
+                os.makedirs(report_dir)
             # 上下文构建 
             context = self._build_report_context(report_id, data)
             # 模板渲染 
             template = self._get_report_template()
-            # 渲染模板
-            html_content = template.render(context)
-            # 文件输出到html
-            output_path = self._write_output_file(report_id, html_content)
+            # 边渲染边写入html文件，结果从结果文件逐条读取，报告大小不影响内存占用
+            output_path = self._write_output_file(report_dir, report_id, template, context, compress=output_format != 'pdf')
 
             #生成textfsm解析文件
             if execute_type == 'inspect':
@@ -124,25 +239,8 @@ class ReportGenerator:
 
 
     def _get_report_template(self):
-        """增强版模板加载方法"""
-        env = Environment(
-            loader=FileSystemLoader(self.template_paths), 
-            extensions=['jinja2.ext.do'],   # 启用扩展功能 
-            autoescape=select_autoescape(['html', 'xml']),
-            trim_blocks=True,
-            lstrip_blocks=True 
-        )
-            
-        env.filters.update({
-            'format_time': self._format_timestamp 
-        })
-        # 添加静态路径处理函数 
-        env.globals.update({ 
-            'static': self._get_static_url,
-            'now': datetime.now().strftime("%Y-%m-%d") 
-        })
-        
-        return env.get_template('report2.html') 
+        """获取编译后的报告模板，见get_report_environment"""
+        return get_report_environment().get_template(REPORT_TEMPLATE) 
  
     # --------------------------
     # 数据处理模块 
@@ -151,15 +249,23 @@ class ReportGenerator:
         """构建模板上下文"""
         return {
             'static_url': self._get_static_url,
+            'now': datetime.now().strftime("%Y-%m-%d"),
             'selected_theme': ThemeManager().get_theme_path(data.get('theme')), 
             'meta': self._build_metadata(report_id),
             'timing': self._process_timing(data),
             'content': self._process_content(data),
             'statistics': self._generate_statistics(data),
+            'concurrency': data.get('concurrency', []),
+            'unreachable': data.get('unreachable', []),
             'results': self._process_results(data)
         }
     def _process_results(self, data):
-        """结果数据处理"""
+        """
+        结果数据处理
+        结果保存在结果文件中时返回可重复迭代的ResultSpool，逐条读取，不一次性载入内存
+        """
+        if data.get('results_file'):
+            return ResultSpool(data['results_file'])
         return data.get('results',  [])
 
     def _generate_statistics(self, data):
@@ -175,7 +281,7 @@ class ReportGenerator:
             commands_length += os_type_command_length*os_type_devices_length
         return {
             "device_count": len(devices),
-            "success_count": sum(1 for d in data['results'] if d.get('status') == 'success'),
+            "success_count": sum(1 for d in self._process_results(data) if d.get('status') == 'success'),
             "command_types": commands_length,
             #"success_rate": int(sum(1 for d in data['results'] if d.get('status') == 'success')/(len(devices)*len(commands))*100),
             #'os_types': len(items.keys())
@@ -230,7 +336,7 @@ class ReportGenerator:
                 'devices':items[item]['devices']
             })
         return {
-            'devices': [self._sanitize_device(d) for d in data.get('devices',  [])],
+            'devices': self._resolve_devices(data.get('devices',  [])),
             'commands': data.get('commands',  []),
             'os_commands': os_commands,
             'os_devices': os_devices
@@ -240,12 +346,7 @@ class ReportGenerator:
     # 工具方法模块 
     # --------------------------
     def _init_logger(self):
-        """初始化日志配置"""
-        logger = logging.getLogger(__name__) 
-        handler = logging.StreamHandler()
-        formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-        handler.setFormatter(formatter) 
-        logger.addHandler(handler) 
+        """日志输出由settings.LOGGING中的devices logger配置"""
         return logger 
  
     def _calculate_duration(self, start, end):
@@ -260,27 +361,73 @@ class ReportGenerator:
             response += f"{seconds}s"
         return response 
  
+    def _resolve_devices(self, device_ids):
+        """
+        批量查询报告中的设备，只读取需要的字段
+        执行后已删除的设备不影响报告生成，显示为已删除
+        """
+        ids = []
+        for device_id in device_ids:
+            try:
+                ids.append(int(device_id))
+            except (TypeError, ValueError):
+                continue
+        rows = {}
+        # 分批查询，避免超过数据库单条语句的参数个数限制
+        for start in range(0, len(ids), DEVICE_QUERY_BATCH):
+            batch = ids[start:start + DEVICE_QUERY_BATCH]
+            for row in Device.objects.filter(id__in=batch).values('id', 'name', 'device_type', 'status'):
+                rows[row['id']] = row
+        devices = []
+        for device_id in ids:
+            row = rows.get(device_id)
+            if row is None:
+                self.logger.warning(f"报告中的设备{device_id}已删除")
+                devices.append({'name': f"设备{device_id}（已删除）", 'type': '', 'status': 'deleted'})
+                continue
+            devices.append(self._sanitize_device(row))
+        return devices
+
     def _sanitize_device(self, device):
         """设备信息清洗"""
-        device = Device.objects.get(id=device)
-        serializer = DeviceSerializer(device)
-
         return {
-            'name': html.escape(serializer.data.get('name')),
-            'type': html.escape(serializer.data.get('device_type')),
-            'status': serializer.data.get('status')
+            'name': html.escape(device.get('name') or ''),
+            'type': html.escape(device.get('device_type') or ''),
+            'status': device.get('status')
         }
  
     # --------------------------
     # 输出处理模块 
     # --------------------------
-    def _write_output_file(self, report_id, content):
-        """写入输出文件"""
+    def _write_output_file(self, report_dir, report_id, template, context, compress=True):
+        """
+        流式渲染并写入输出文件，先写临时文件再替换
+        :param compress: 按配置压缩保存，生成pdf时需要未压缩的html
+        """
+        conf = report_config()
+        gzipped = compress and conf['GZIP']
         # 定义输出路径
-        output_path = Path(f"{self.report_dir}/{report_id}/index.html")
+        output_path = Path(f"{report_dir}/{report_id}") / (REPORT_GZIP_FILE if gzipped else REPORT_FILE)
         output_path.parent.mkdir(exist_ok=True) 
-        with open(output_path, 'w', encoding='utf-8') as f:
-            f.write(content) 
+        tmp_path = output_path.with_name(output_path.name + '.tmp')
+        started = time.monotonic()
+        if gzipped:
+            f = gzip.open(tmp_path, 'wt', encoding='utf-8', compresslevel=conf['GZIP_LEVEL'])
+        else:
+            f = open(tmp_path, 'w', encoding='utf-8')
+        try:
+            with f:
+                written = write_stream(f, template.generate(context), conf['WRITE_BUFFER'])
+            os.replace(tmp_path, output_path)
+        except Exception:
+            if tmp_path.exists():
+                tmp_path.unlink()
+            raise
+        # 切换压缩方式后删除另一种格式的旧报告，避免查看到旧报告
+        stale_path = output_path.with_name(REPORT_FILE if gzipped else REPORT_GZIP_FILE)
+        if stale_path.exists():
+            stale_path.unlink()
+        self.logger.info(f"报告{report_id}渲染完成，{written}字符，耗时{time.monotonic() - started:.2f}秒")
         return output_path 
  
     def export_as_pdf(self, html_path):
@@ -290,55 +437,25 @@ class ReportGenerator:
         pdfkit.from_file(str(html_path),  str(html_path.with_suffix('.pdf'))) 
 
     def config_textfsm(self, report_id, data):
-        """配置textfsm解析文件"""
+        """
+        配置textfsm解析文件
+        结果按模板分组交给解析进程池并行解析（见textfsm_parse.TextFSMPipeline），解析结果在当前线程中写入csv
+        :return: 解析统计（结果数、解析条数、耗时及每秒解析条数等）
+        """
         print("textfsm解析开始",datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-        # 定义textfsm解析文件的输出路径
-        output_path = self.textfsm_csv_dir
-        #output_path = f'{output_path}/{report_id}'
-        # 需要安装textfsm
-        import textfsm
-        # 获取结果列表
-        results = data.get('results', [])
-        # 遍历结果列表
-        for command_result in results:
-            # 获取设备信息
-            device_name = command_result.get('device', '')
-            # 获取设备ip
-            device_ip = command_result.get('device_ip', '')
-            # 获取命令信息 
-            command = command_result.get('command', '')
-            # 获取结果信息
-            command_output = command_result.get('result', '')
-            # 获取os_type信息
-            os_type = command_result.get('os_type', '')
-            # 获取更新时间
-            update_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            # csv文件附加字段
-            extra_datas = {
-                'device_name': device_name,
-                'device_ip': device_ip,
-                'update_time': update_time
-            }
-            if 'huawei' in os_type:
-                os_type = 'huawei_vrp'
-            # 判断是否存在textfsm解析文件
-            textfsm_path = os.path.join(settings.DIR_INFO['CONF_DIR'],'textfsm', f"{os_type}_{command.replace(' ', '_')}.textfsm")
-            if os.path.exists(textfsm_path):
-                textfsm_result = []
-                # 定义textfsm解析文件的输出文件名
-                output_file_name = f"{os_type}_{command.replace(' ', '_')}.csv"
-                # 读取textfsm解析文件
-                with open(textfsm_path, 'r', encoding='utf-8') as template_file:
-                    fsm = textfsm.TextFSM(template_file)
-                    textfsm_result = fsm.ParseText(command_output)
-                # 将解析结果写入csv文件
-                if len(textfsm_result) > 0:
-                    list_write_csv(os.path.join(output_path,output_file_name),textfsm_result,fsm.header,extra_datas)
-                    # 更新解析数据库文件总表
-                    self.update_textfsm_database(os_type,command,textfsm_result,fsm.header,extra_datas)
-            else:
-                continue
+        # 获取结果列表，逐条读取结果文件
+        results = self._process_results(data)
+        stats = TextFSMPipeline(self._write_textfsm_rows).run(results)
         print("textfsm解析结束")
+        return stats
+
+    def _write_textfsm_rows(self, os_type, command, textfsm_result, headers, extra_datas):
+        """将解析结果写入csv文件"""
+        # 定义textfsm解析文件的输出文件名
+        output_file_name = f"{os_type}_{command.replace(' ', '_')}.csv"
+        list_write_csv(os.path.join(self.textfsm_csv_dir,output_file_name),textfsm_result,headers,extra_datas)
+        # 更新解析数据库文件总表
+        self.update_textfsm_database(os_type,command,textfsm_result,headers,extra_datas)
 
     def update_textfsm_database(self, os_type, command, textfsm_result, headers, extra_datas):
         """更新textfsm解析数据库文件"""    
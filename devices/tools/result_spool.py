@@ -0,0 +1,78 @@
+import json
+import os
+import logging
+from threading import Lock
+
+logger = logging.getLogger('devices.result_spool')
+
+RESULTS_FILE = 'results.jsonl'
+
+
+class ResultSpool:
+    """
+    命令结果暂存文件（JSON Lines，每行一条命令结果）
+    执行过程中结果到达即追加写入报告目录，不在内存中累积；
+    报告生成、TextFSM解析通过迭代逐条读取，对象可以被多次迭代（如模板中多次遍历results）。
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self._lock = Lock()
+        self._file = None
+        self._count = None
+
+    @classmethod
+    def for_report(cls, report_dir):
+        return cls(os.path.join(report_dir, RESULTS_FILE))
+
+    def append(self, record):
+        """追加一条结果，可在多个工作线程中并发调用"""
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, 'a', encoding='utf-8')
+            self._file.write(line)
+            # 逐条刷新，进程异常退出时已完成的结果不丢失
+            self._file.flush()
+            if self._count is not None:
+                self._count += 1
+
+    def reset(self):
+        """清空已有结果"""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            self._count = 0
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def __iter__(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line_no, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # 进程中断时最后一行可能不完整
+                    logger.warning(f"结果文件{self.path}第{line_no}行无法解析，已跳过")
+
+    def __len__(self):
+        with self._lock:
+            if self._count is None:
+                if self._file is not None:
+                    self._file.flush()
+                self._count = sum(1 for _ in self)
+            return self._count
+
+    def __bool__(self):
+        return os.path.exists(self.path) and os.path.getsize(self.path) > 0
@@ -0,0 +1,68 @@
+import os
+import socket
+import time
+import logging
+from datetime import datetime
+from threading import Lock
+
+from django.core.cache import cache
+
+logger = logging.getLogger('devices.runtime_stats')
+
+# daphne(websocket)与gunicorn(http)运行在不同的进程中，进程内的统计数据无法被HTTP接口直接读取，
+# 因此各进程定期把统计快照写入缓存，查询接口再汇总所有进程的快照。
+STATS_PREFIX = 'runtime_stats'
+STATS_TIMEOUT = 60*10 # 快照过期时间，进程退出后其快照会自动失效
+
+_publish_lock = Lock()
+_last_publish = {}
+
+
+def process_id():
+    """当前进程标识（主机名:进程号）"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def publish_stats(name, stats, interval=5, force=False):
+    """
+    发布当前进程的统计快照
+    :param name: 统计项名称，如session_pool
+    :param stats: 可被缓存序列化的统计字典
+    :param interval: 最小发布间隔（秒），避免高频写缓存
+    :param force: 忽略发布间隔立即发布
+    :return: 是否实际发布
+    """
+    now = time.monotonic()
+    with _publish_lock:
+        if not force and now - _last_publish.get(name, 0) < interval:
+            return False
+        _last_publish[name] = now
+    proc = process_id()
+    index_key = f"{STATS_PREFIX}:{name}"
+    try:
+        processes = cache.get(index_key) or []
+        if proc not in processes:
+            processes.append(proc)
+            cache.set(index_key, processes, None)
+        cache.set(f"{index_key}:{proc}", {
+            'process': proc,
+            'updated_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'stats': stats
+        }, STATS_TIMEOUT)
+    except Exception as e:
+        logger.warning(f"发布统计信息{name}失败: {str(e)}")
+        return False
+    return True
+
+
+def collect_stats(name):
+    """汇总所有进程发布的统计快照，同时清理已失效的进程"""
+    index_key = f"{STATS_PREFIX}:{name}"
+    processes = cache.get(index_key) or []
+    if not processes:
+        return []
+    snapshots = cache.get_many([f"{index_key}:{proc}" for proc in processes])
+    alive = [proc for proc in processes if f"{index_key}:{proc}" in snapshots]
+    if len(alive) != len(processes):
+        cache.set(index_key, alive, None)
+    return [snapshots[f"{index_key}:{proc}"] for proc in alive]
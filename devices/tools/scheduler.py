@@ -0,0 +1,228 @@
+import logging
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+from django.conf import settings
+
+logger = logging.getLogger('devices.scheduler')
+
+# 优先级：interactive（历史记录再次执行等交互操作）> normal > bulk（大批量巡检）
+PRIORITY_INTERACTIVE = 'interactive'
+PRIORITY_NORMAL = 'normal'
+PRIORITY_BULK = 'bulk'
+PRIORITY_ORDER = {PRIORITY_INTERACTIVE: 0, PRIORITY_NORMAL: 1, PRIORITY_BULK: 2}
+
+
+def resolve_priority(priority, device_count):
+    """任务优先级，未指定时设备数达到SCHEDULER['BULK_DEVICES']的任务为bulk"""
+    if priority in PRIORITY_ORDER:
+        return priority
+    bulk_devices = getattr(settings, 'EXECUTE_CONFIG', {}).get('SCHEDULER', {}).get('BULK_DEVICES', 200)
+    return PRIORITY_BULK if device_count >= bulk_devices else PRIORITY_NORMAL
+
+
+class _Job:
+    """调度器中的单个任务（一次巡检或配置下发）"""
+    __slots__ = ('job_id', 'queue', 'running', 'submitted', 'finished', 'limit', 'priority')
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.queue = deque() # 等待执行的(future, fn, args, kwargs)
+        self.running = 0
+        self.submitted = 0
+        self.finished = False
+        self.limit = None # 任务自身的并发上限，None表示只受全局上限限制
+        self.priority = PRIORITY_NORMAL
+
+
+class JobScheduler:
+    """
+    进程级设备任务调度器
+    所有websocket连接的巡检、配置下发任务共用一组工作线程，总并发受max_workers限制；
+    工作线程优先从高优先级的任务取排队中的设备（已开始执行的设备不中断），
+    同一优先级的任务之间轮转取任务，保证多个任务同时运行时公平分配线程。
+    """
+
+    def __init__(self, max_workers=50, thread_name_prefix="DeviceWorker-"):
+        self.max_workers = max_workers
+        self.thread_name_prefix = thread_name_prefix
+        self._cond = threading.Condition()
+        self._jobs = OrderedDict() # {job_id: _Job}
+        self._rotation = deque() # 轮转顺序
+        self._workers = []
+        self._running = 0
+
+    @classmethod
+    def from_settings(cls):
+        conf = getattr(settings, 'EXECUTE_CONFIG', {}).get('SCHEDULER', {})
+        return cls(max_workers=conf.get('MAX_WORKERS', 50))
+
+    def submit(self, job_id, fn, *args, **kwargs):
+        """
+        提交设备任务
+        :param job_id: 所属任务ID（报告ID）
+        :return: concurrent.futures.Future
+        """
+        future = Future()
+        with self._cond:
+            job = self._get_job_locked(job_id)
+            job.queue.append((future, fn, args, kwargs))
+            job.submitted += 1
+            self._ensure_workers_locked()
+            self._cond.notify()
+        return future
+
+    def set_job_limit(self, job_id, limit):
+        """设置任务的并发上限（如自适应并发控制器的调整结果）"""
+        with self._cond:
+            job = self._get_job_locked(job_id)
+            job.limit = limit
+            self._cond.notify_all()
+
+    def set_job_priority(self, job_id, priority):
+        """设置任务优先级，需在提交设备任务前调用"""
+        with self._cond:
+            job = self._get_job_locked(job_id)
+            job.priority = priority
+            self._cond.notify_all()
+
+    def finish_job(self, job_id, cancel=False):
+        """
+        任务结束后注销，cancel为True时取消尚未开始的设备任务
+        """
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            if cancel:
+                while job.queue:
+                    future = job.queue.popleft()[0]
+                    future.cancel()
+            job.finished = True
+            if not job.queue and job.running == 0:
+                self._remove_job_locked(job_id)
+
+    def job_stats(self, job_id):
+        """任务的排队情况，用于进度消息"""
+        with self._cond:
+            job = self._jobs.get(job_id)
+            return {
+                'queued': len(job.queue) if job else 0,
+                'running': job.running if job else 0,
+                'limit': job.limit if job else None,
+                'priority': job.priority if job else None,
+                # 优先级更高的任务中排队的设备数，这些设备会先于本任务执行
+                'ahead': sum(
+                    len(item.queue) for item in self._jobs.values()
+                    if job and PRIORITY_ORDER[item.priority] < PRIORITY_ORDER[job.priority]
+                ),
+                'active_jobs': len(self._jobs),
+                'global_running': self._running,
+                'global_queued': sum(len(item.queue) for item in self._jobs.values()),
+                'max_workers': self.max_workers,
+            }
+
+    def stats(self):
+        with self._cond:
+            return {
+                'max_workers': self.max_workers,
+                'workers': len(self._workers),
+                'running': self._running,
+                'jobs': {
+                    job_id: {'queued': len(job.queue), 'running': job.running, 'submitted': job.submitted, 'limit': job.limit, 'priority': job.priority}
+                    for job_id, job in self._jobs.items()
+                }
+            }
+
+    # --------------------------
+    # 内部方法
+    # --------------------------
+    def _ensure_workers_locked(self):
+        # 按需启动工作线程，直到达到并发上限
+        pending = sum(len(job.queue) for job in self._jobs.values())
+        idle = len(self._workers) - self._running
+        while idle < pending and len(self._workers) < self.max_workers:
+            worker = threading.Thread(
+                target=self._worker_loop,
+                name=f"{self.thread_name_prefix}{len(self._workers)}",
+                daemon=True
+            )
+            self._workers.append(worker)
+            worker.start()
+            idle += 1
+
+    def _get_job_locked(self, job_id):
+        job = self._jobs.get(job_id)
+        if job is None:
+            job = _Job(job_id)
+            self._jobs[job_id] = job
+            self._rotation.append(job_id)
+        return job
+
+    def _remove_job_locked(self, job_id):
+        self._jobs.pop(job_id, None)
+        try:
+            self._rotation.remove(job_id)
+        except ValueError:
+            pass
+
+    def _next_task_locked(self):
+        """
+        从有排队任务且未达到自身并发上限的job中，取优先级最高、轮转顺序最靠前的job的任务，
+        取出后该job移到轮转顺序末尾
+        """
+        selected = None
+        for index, job_id in enumerate(self._rotation):
+            job = self._jobs[job_id]
+            if not job.queue or (job.limit is not None and job.running >= job.limit):
+                continue
+            if selected is None or PRIORITY_ORDER[job.priority] < PRIORITY_ORDER[selected[1].priority]:
+                selected = (index, job)
+                if job.priority == PRIORITY_INTERACTIVE:
+                    break
+        if selected is None:
+            return None, None
+        index, job = selected
+        self._rotation.rotate(-(index + 1))
+        return job, job.queue.popleft()
+
+    def _worker_loop(self):
+        while True:
+            with self._cond:
+                job, task = self._next_task_locked()
+                while task is None:
+                    self._cond.wait()
+                    job, task = self._next_task_locked()
+                job.running += 1
+                self._running += 1
+            future, fn, args, kwargs = task
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(fn(*args, **kwargs))
+                    except BaseException as e:
+                        future.set_exception(e)
+            finally:
+                with self._cond:
+                    job.running -= 1
+                    self._running -= 1
+                    # 受任务并发上限阻塞的排队任务可能可以执行了
+                    if job.limit is not None and job.queue:
+                        self._cond.notify()
+                    if job.finished and not job.queue and job.running == 0:
+                        self._remove_job_locked(job.job_id)
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """获取进程级调度器单例"""
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = JobScheduler.from_settings()
+    return _scheduler
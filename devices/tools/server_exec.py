@@ -0,0 +1,269 @@
+import re
+import time
+import getopt
+import uuid
+import shlex
+import socket
+import logging
+from datetime import datetime
+
+from django.conf import settings
+
+logger = logging.getLogger('devices.server_exec')
+
+# 服务器命令执行方式
+MODE_SERIAL = 'serial' # 每条命令单独打开一个exec通道
+MODE_BATCH = 'batch' # 设备的所有命令在一个通道中执行，按分隔符拆分输出
+MODE_PARALLEL = 'parallel' # 只读命令在同一连接的多个通道中并发执行，其余命令逐条执行
+
+# 默认视为只读的命令，可通过SERVER_EXEC['READ_ONLY_COMMANDS']覆盖
+# {命令（含子命令）: (允许的短选项（getopt格式，带值的选项后加冒号）, 允许的长选项, 其余参数需匹配的正则，空字符串表示不接受参数)}
+# 命令按最长的子命令匹配，未列出的选项（如tail -f、sort -o、dmesg -c）及参数（如ip addr add、hostname newname）均不视为只读；
+# 持续输出不会结束的选项（follow、间隔采样等）同样不列出
+ANY = r'.*'
+READ_ONLY_COMMANDS = {
+    'cat': ('nAbeEsTv', [], ANY),
+    'ls': ('aAlhtrdRS1iFnGgocuLs', ['all', 'human-readable', 'color=', 'full-time', 'time-style=', 'sort='], ANY),
+    'df': ('ahHiklPTt:x:', ['human-readable', 'inodes', 'total', 'local', 'print-type', 'all', 'output='], ANY),
+    'du': ('ahsckmxd:', ['human-readable', 'summarize', 'max-depth=', 'apparent-size'], ANY),
+    'free': ('bkmghltw', ['human', 'total', 'wide', 'mega', 'giga'], ''),
+    'uptime': ('ps', ['pretty', 'since'], ''),
+    'uname': ('asnrvmpio', ['all'], ''),
+    'hostname': ('sfdiIA', ['short', 'fqdn', 'domain', 'ip-address', 'all-ip-addresses'], ''),
+    'date': ('uRd:', ['utc', 'rfc-2822', 'rfc-3339=', 'iso-8601=', 'date='], r'\+.*'),
+    'ps': ('AaefFlLjHwxTo:p:C:U:u:G:g:t:', ['sort=', 'forest', 'no-headers', 'pid=', 'ppid='], ANY),
+    'who': ('abHqrsu', [], ''),
+    'w': ('hus', [], ANY),
+    'last': ('xFwaidn:', [], ANY),
+    'id': ('ugGnr', [], ANY),
+    'whoami': ('', [], ''),
+    'netstat': ('tulpnaexrisogWv46', [], ''),
+    'ss': ('tulpnaexrismoH46', ['tcp', 'udp', 'listening', 'processes', 'numeric', 'all', 'summary'], ANY),
+    'ip addr': ('', [], ''),
+    'ip addr show': ('', [], ANY),
+    'ip a': ('', [], ''),
+    'ip a s': ('', [], ANY),
+    'ip route': ('', [], ''),
+    'ip route show': ('', [], ANY),
+    'ip route get': ('', [], ANY),
+    'ip r': ('', [], ''),
+    'ip link': ('', [], ''),
+    'ip link show': ('', [], ANY),
+    'ip neigh': ('', [], ''),
+    'ip neigh show': ('', [], ANY),
+    'ifconfig': ('a', [], ''),
+    'route': ('ne', [], ''),
+    'lsblk': ('abdfilmnopstJOS', [], ANY),
+    'blkid': ('o:s:', [], ANY),
+    'mount': ('lt:', [], ''),
+    'lscpu': ('aebcxyJ', [], ''),
+    'lsmem': ('abJnr', [], ''),
+    'lspci': ('vknmtD', [], ''),
+    'lsof': ('nPtlwip:u:c:', [], ANY),
+    'nproc': ('', ['all'], ''),
+    'vmstat': ('adDsSfmtw', [], ''),
+    'iostat': ('xdcmkhNtyzp:', [], ''),
+    'mpstat': ('uP:', [], ''),
+    'dmesg': ('HTtxkrul:f:', ['human', 'ctime', 'notime', 'decode', 'kernel', 'userspace', 'nopager', 'level=',
+                               'facility=', 'time-format=', 'color='], ''),
+    'journalctl': ('u:n:t:p:o:S:U:bkqrxaeNl', ['unit=', 'user-unit=', 'lines=', 'identifier=', 'priority=', 'output=',
+                                               'since=', 'until=', 'grep=', 'boot', 'dmesg', 'no-pager', 'reverse',
+                                               'catalog', 'quiet', 'no-hostname', 'utc', 'full', 'all', 'system',
+                                               'list-boots', 'disk-usage'], ANY),
+    'systemctl status': ('n:l', ['no-pager', 'lines=', 'full'], ANY),
+    'systemctl is-active': ('q', ['quiet'], ANY),
+    'systemctl is-enabled': ('q', ['quiet'], ANY),
+    'systemctl is-failed': ('q', ['quiet'], ANY),
+    'systemctl show': ('p:', ['property=', 'value', 'no-pager'], ANY),
+    'systemctl list-units': ('at:', ['all', 'type=', 'state=', 'failed', 'no-pager', 'no-legend', 'plain'], ANY),
+    'systemctl list-unit-files': ('t:', ['type=', 'state=', 'no-pager', 'no-legend', 'plain'], ANY),
+    'rpm -q': ('', [], ANY),
+    'rpm -qa': ('', [], ANY),
+    'rpm -qi': ('', [], ANY),
+    'rpm -ql': ('', [], ANY),
+    'dpkg -l': ('', [], ANY),
+    'timedatectl': ('', ['no-pager'], ''),
+    'timedatectl status': ('', ['no-pager'], ''),
+    'timedatectl show': ('', ['no-pager'], ''),
+    'hostnamectl': ('', [], ''),
+    'hostnamectl status': ('', [], ''),
+    'chronyc tracking': ('nc', [], ''),
+    'chronyc sources': ('nvc', [], ''),
+    'chronyc sourcestats': ('nvc', [], ''),
+    'ntpq -p': ('n', [], ''),
+    'ntpq -pn': ('', [], ''),
+    'getenforce': ('', [], ''),
+    'sestatus': ('v', [], ''),
+    'iptables': ('LSnvxt:', ['line-numbers', 'list', 'list-rules', 'numeric', 'verbose', 'exact', 'table='], ANY),
+    'firewall-cmd': ('', ['state', 'list-all', 'list-all-zones', 'list-services', 'list-ports', 'list-rich-rules',
+                          'get-active-zones', 'get-default-zone', 'zone='], ''),
+    # 管道中常用的过滤命令
+    'grep': ('EFPivwxcLlnhHoqsrRaIUzZA:B:C:m:e:f:', ['color=', 'include=', 'exclude=', 'line-number', 'ignore-case',
+                                                  'invert-match', 'count', 'extended-regexp', 'fixed-strings'], ANY),
+    'egrep': ('ivwxcLlnhHoqsrRaIA:B:C:m:e:', ['color='], ANY),
+    'head': ('n:c:qvz', ['lines=', 'bytes='], ANY),
+    'tail': ('n:c:qvz', ['lines=', 'bytes='], ANY),
+    'wc': ('lwcmL', [], ANY),
+    'sort': ('bdfghiMnRrVsuzk:t:', ['key=', 'field-separator=', 'numeric-sort', 'human-numeric-sort', 'reverse',
+                                    'unique', 'version-sort'], ANY),
+    'uniq': ('cdDiuzf:s:w:', ['count', 'repeated', 'unique', 'ignore-case'], ''),
+    'cut': ('b:c:d:f:sz', ['complement', 'delimiter=', 'fields=', 'output-delimiter='], ANY),
+    'tr': ('cCdst', [], ANY),
+    'echo': ('neE', [], ANY),
+}
+# 出现以下内容的命令可能修改设备状态或依赖前后顺序，不并发执行
+UNSAFE_TOKENS = ('>', '<', ';', '&', '`', '$(', '\n')
+
+
+def server_exec_config():
+    return getattr(settings, 'EXECUTE_CONFIG', {}).get('SERVER_EXEC', {})
+
+
+def server_exec_mode():
+    return server_exec_config().get('MODE', MODE_SERIAL)
+
+
+def _segment_read_only(words, read_only_commands):
+    """管道中的一段是否只读：按最长的子命令匹配，其余选项及参数需在允许范围内"""
+    for size in range(len(words), 0, -1):
+        spec = read_only_commands.get(' '.join(words[:size]))
+        if spec is not None:
+            break
+    else:
+        return False
+    short_options, long_options, operand_pattern = spec
+    try:
+        _, operands = getopt.gnu_getopt(words[size:], short_options, long_options)
+    except getopt.GetoptError:
+        return False
+    if not operand_pattern:
+        return not operands
+    return all(re.fullmatch(operand_pattern, operand) for operand in operands)
+
+
+def is_read_only(cmd, read_only_commands=None):
+    """命令是否为可以并发执行的只读命令，管道中的每一段都需只读"""
+    if read_only_commands is None:
+        read_only_commands = server_exec_config().get('READ_ONLY_COMMANDS', READ_ONLY_COMMANDS)
+    cmd = cmd.strip()
+    if not cmd or any(token in cmd for token in UNSAFE_TOKENS):
+        return False
+    for segment in cmd.split('|'):
+        try:
+            words = shlex.split(segment)
+        except ValueError:
+            return False
+        if not words or not _segment_read_only(words, read_only_commands):
+            return False
+    return True
+
+
+class BatchError(Exception):
+    """批量执行的通道在全部命令完成前关闭"""
+
+
+def build_batch_script(commands, marker):
+    """
+    生成批量执行脚本，由sh -s从标准输入读取
+    每条命令前后向stdout和stderr各输出一行分隔符；命令通过登录shell执行（与exec_command一致），
+    命令文本经过转义，单条命令引号不匹配等语法错误不影响其他命令，标准输入重定向避免命令读取脚本内容。
+    """
+    lines = [f"M={shlex.quote(marker)}", 'S=${SHELL:-sh}']
+    for index, cmd in enumerate(commands):
+        lines.append(f"printf '%s S {index}\\n' \"$M\"; printf '%s S {index}\\n' \"$M\" >&2")
+        lines.append(f"\"$S\" -c {shlex.quote(cmd)} </dev/null")
+        lines.append(f"printf '\\n%s E {index}\\n' \"$M\"; printf '\\n%s E {index}\\n' \"$M\" >&2")
+    return '\n'.join(lines) + '\n'
+
+
+class MarkerStream:
+    """按分隔符拆分一个输出流（stdout或stderr），返回各命令的开始、结束事件"""
+
+    def __init__(self, marker):
+        self._pattern = re.compile(rb'\n?' + re.escape(marker.encode()) + rb' ([SE]) (\d+)\n')
+        self._tail = len(marker) + 32 # 分隔符行的最大长度
+        self._buffer = b''
+        self._content_start = 0
+        self._scan_from = 0
+
+    def feed(self, data):
+        """
+        :return: [('S', 序号, None)] 或 [('E', 序号, 输出字节)]
+        """
+        self._buffer += data
+        events = []
+        while True:
+            match = self._pattern.search(self._buffer, self._scan_from)
+            if match is None:
+                # 分隔符可能被拆在两次读取之间，下次从末尾往前一段开始查找
+                self._scan_from = max(self._content_start, len(self._buffer) - self._tail)
+                return events
+            index = int(match.group(2))
+            if match.group(1) == b'S':
+                events.append(('S', index, None))
+                self._content_start = self._scan_from = match.end()
+            else:
+                # E分隔符前的换行是脚本添加的，不属于命令输出
+                events.append(('E', index, self._buffer[self._content_start:match.start()]))
+                self._buffer = self._buffer[match.end():]
+                self._content_start = self._scan_from = 0
+
+
+def run_batch(ssh, commands, timeout_for, on_start=None, on_result=None):
+    """
+    在一个exec通道中执行设备的所有命令，每条命令完成即回调
+    :param ssh: paramiko.SSHClient
+    :param timeout_for: 无参函数，返回当前命令的超时时间（秒）
+    :param on_start: on_start(序号)，命令开始执行
+    :param on_result: on_result(序号, 输出, 开始时间, 结束时间)，输出规则与串行执行相同（stdout为空时取stderr）
+    :raises socket.timeout: 当前命令超时，已完成命令的结果已回调
+    :raises BatchError: 通道在全部命令完成前关闭
+    """
+    marker = f"__DM_BATCH_{uuid.uuid4().hex}__"
+    channel = ssh.get_transport().open_session()
+    try:
+        channel.exec_command('sh -s')
+        channel.sendall(build_batch_script(commands, marker).encode())
+        channel.shutdown_write()
+        channel.settimeout(0.1)
+        streams = {'stdout': MarkerStream(marker), 'stderr': MarkerStream(marker)}
+        outputs = {} # {序号: {'stdout': 输出, 'stderr': 输出}}
+        start_times = {}
+        done = 0
+        current_started = time.monotonic()
+        current_timeout = timeout_for()
+        while done < len(commands):
+            events = []
+            try:
+                data = channel.recv(65536)
+            except socket.timeout:
+                data = None
+            if data:
+                events.extend(('stdout',) + event for event in streams['stdout'].feed(data))
+            while channel.recv_stderr_ready():
+                events.extend(('stderr',) + event for event in streams['stderr'].feed(channel.recv_stderr(65536)))
+            for stream, kind, index, output in events:
+                if kind == 'S' and stream == 'stdout':
+                    start_times[index] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                    current_started = time.monotonic()
+                    current_timeout = timeout_for()
+                    if on_start:
+                        on_start(index)
+                elif kind == 'E':
+                    outputs.setdefault(index, {})[stream] = output.decode(errors='replace')
+            # stdout与stderr都读到结束分隔符后，按顺序回调已完成的命令
+            while done in outputs and len(outputs[done]) == 2:
+                result = outputs.pop(done)
+                end_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                if on_result:
+                    on_result(done, result['stdout'] or result['stderr'], start_times.pop(done, end_time), end_time)
+                done += 1
+            if done >= len(commands):
+                break
+            if data == b'':
+                raise BatchError(f"批量执行通道已关闭，已完成{done}/{len(commands)}条命令")
+            if time.monotonic() - current_started > current_timeout:
+                raise socket.timeout(f"命令执行超时（{current_timeout:.0f}秒）")
+        return done
+    finally:
+        channel.close()
@@ -0,0 +1,331 @@
+import time
+import logging
+import threading
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from devices.tools.runtime_stats import publish_stats
+
+logger = logging.getLogger('devices.session_pool')
+
+
+def session_key(device_info):
+    """会话池键：(ip, port, username, os_type)"""
+    return (
+        device_info['ip'],
+        int(device_info['port'] or 22),
+        device_info['username'],
+        device_info['os_type'] or ''
+    )
+
+
+def _probe_session(conn):
+    """
+    会话健康检查
+    netmiko连接通过获取提示符确认会话可用，paramiko连接检查transport并发送ignore报文
+    """
+    if hasattr(conn, 'find_prompt'):
+        return bool(conn.find_prompt())
+    transport = conn.get_transport()
+    if transport is None or not transport.is_active():
+        return False
+    transport.send_ignore()
+    return True
+
+
+def close_session(conn):
+    """关闭会话，忽略关闭过程中的异常"""
+    try:
+        if hasattr(conn, 'disconnect'):
+            conn.disconnect()
+        else:
+            conn.close()
+    except Exception as e:
+        logger.debug(f"关闭会话失败: {str(e)}")
+
+
+class PooledSession:
+    """会话池中的连接条目"""
+    __slots__ = ('key', 'conn', 'created_at', 'last_used', 'uses', 'broken')
+
+    def __init__(self, key, conn):
+        self.key = key
+        self.conn = conn
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        self.uses = 0
+        self.broken = False
+
+
+class SessionPool:
+    """
+    进程级SSH会话池
+    按(ip, port, username, os_type)缓存已登录的netmiko/paramiko连接，供巡检和配置下发复用，
+    支持空闲过期、单设备会话上限、借出前提示符探测和LRU淘汰。
+    """
+
+    def __init__(self, max_per_host=2, max_total=500, idle_ttl=300, acquire_timeout=60):
+        self.max_per_host = max_per_host
+        self.max_total = max_total
+        self.idle_ttl = idle_ttl
+        self.acquire_timeout = acquire_timeout
+        self._cond = threading.Condition()
+        self._idle = defaultdict(list) # {key: [PooledSession]}，列表尾部为最近归还的会话
+        self._lru = OrderedDict() # {id(session): session}，按归还时间排序的全部空闲会话
+        self._in_use = {} # {id(conn): PooledSession}
+        self._host_counts = defaultdict(int) # {(ip, port): 空闲+借出+正在建立的会话数}
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'created': 0,
+            'closed': 0,
+            'evicted': 0,
+            'expired': 0,
+            'health_check_failed': 0,
+            'waits': 0,
+            'timeouts': 0,
+        }
+        self._sweeper = None
+
+    @classmethod
+    def from_settings(cls):
+        conf = getattr(settings, 'EXECUTE_CONFIG', {}).get('SESSION_POOL', {})
+        return cls(
+            max_per_host=conf.get('MAX_PER_HOST', 2),
+            max_total=conf.get('MAX_TOTAL', 500),
+            idle_ttl=conf.get('IDLE_TTL', 300),
+            acquire_timeout=conf.get('ACQUIRE_TIMEOUT', 60),
+        )
+
+    @contextmanager
+    def session(self, key, factory):
+        """
+        借出会话的上下文管理器，退出时自动归还；块内抛出异常视为会话损坏并关闭
+        :param key: 会话池键，见session_key
+        :param factory: 无参函数，用于新建连接
+        """
+        conn = self.acquire(key, factory)
+        broken = False
+        try:
+            yield conn
+        except Exception:
+            broken = True
+            raise
+        finally:
+            self.release(conn, broken=broken)
+
+    def acquire(self, key, factory):
+        """借出会话，优先复用空闲会话，否则在不超过上限的前提下新建"""
+        self._ensure_sweeper()
+        host = key[:2]
+        deadline = time.monotonic() + self.acquire_timeout
+        with self._cond:
+            while True:
+                self._expire_idle_locked()
+                pooled = self._pop_idle_locked(key)
+                if pooled:
+                    break
+                if self._host_counts[host] < self.max_per_host or self._evict_host_locked(host):
+                    # 预占名额，在锁外建立连接
+                    self._host_counts[host] += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise RuntimeError(f"等待设备{host[0]}:{host[1]}的可用会话超时")
+                self._stats['waits'] += 1
+                self._cond.wait(remaining)
+
+        if pooled:
+            try:
+                healthy = _probe_session(pooled.conn)
+            except Exception:
+                healthy = False
+            if healthy:
+                with self._cond:
+                    self._stats['hits'] += 1
+                    pooled.uses += 1
+                    self._in_use[id(pooled.conn)] = pooled
+                return pooled.conn
+            logger.info(f"会话{key[0]}:{key[1]}健康检查失败，重新建立连接")
+            close_session(pooled.conn)
+            with self._cond:
+                self._stats['health_check_failed'] += 1
+                self._stats['closed'] += 1
+            # 名额沿用被丢弃的会话，直接新建
+
+        try:
+            conn = factory()
+        except Exception:
+            with self._cond:
+                self._host_counts[host] -= 1
+                self._cond.notify_all()
+            raise
+        with self._cond:
+            self._stats['misses'] += 1
+            self._stats['created'] += 1
+            pooled = PooledSession(key, conn)
+            pooled.uses = 1
+            self._in_use[id(conn)] = pooled
+            if self.total_sessions() > self.max_total:
+                self._evict_lru_locked()
+        return conn
+
+    def mark_broken(self, conn):
+        """标记借出中的会话不可复用（如命令超时后通道中残留输出），归还时直接关闭"""
+        with self._cond:
+            pooled = self._in_use.get(id(conn))
+            if pooled:
+                pooled.broken = True
+
+    def release(self, conn, broken=False):
+        """归还会话；损坏的会话直接关闭"""
+        with self._cond:
+            pooled = self._in_use.pop(id(conn), None)
+            if pooled is None:
+                return
+            broken = broken or pooled.broken
+            if broken:
+                self._host_counts[pooled.key[:2]] -= 1
+                self._stats['closed'] += 1
+            else:
+                pooled.last_used = time.monotonic()
+                self._idle[pooled.key].append(pooled)
+                self._lru[id(pooled)] = pooled
+            self._cond.notify_all()
+        if broken:
+            close_session(conn)
+        publish_stats('session_pool', self.stats())
+
+    def clear(self):
+        """关闭全部空闲会话"""
+        with self._cond:
+            sessions = list(self._lru.values())
+            for pooled in sessions:
+                self._remove_idle_locked(pooled)
+            self._stats['closed'] += len(sessions)
+            self._cond.notify_all()
+        for pooled in sessions:
+            close_session(pooled.conn)
+        publish_stats('session_pool', self.stats(), force=True)
+
+    def total_sessions(self):
+        return len(self._lru) + len(self._in_use)
+
+    def stats(self):
+        """会话池统计信息"""
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update({
+                'idle': len(self._lru),
+                'in_use': len(self._in_use),
+                'hosts': sum(1 for count in self._host_counts.values() if count > 0),
+                'max_per_host': self.max_per_host,
+                'max_total': self.max_total,
+                'idle_ttl': self.idle_ttl,
+            })
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / lookups, 4) if lookups else 0
+        return stats
+
+    # --------------------------
+    # 内部方法，调用方需持有self._cond
+    # --------------------------
+    def _pop_idle_locked(self, key):
+        sessions = self._idle.get(key)
+        if not sessions:
+            return None
+        pooled = sessions.pop()
+        if not sessions:
+            del self._idle[key]
+        del self._lru[id(pooled)]
+        return pooled
+
+    def _remove_idle_locked(self, pooled):
+        sessions = self._idle.get(pooled.key, [])
+        if pooled in sessions:
+            sessions.remove(pooled)
+            if not sessions:
+                del self._idle[pooled.key]
+        self._lru.pop(id(pooled), None)
+        self._host_counts[pooled.key[:2]] -= 1
+
+    def _close_later(self, sessions):
+        # 关闭连接涉及网络交互，放到后台线程避免持锁阻塞
+        if sessions:
+            threading.Thread(
+                target=lambda: [close_session(pooled.conn) for pooled in sessions],
+                name="SessionPoolCloser",
+                daemon=True
+            ).start()
+
+    def _expire_idle_locked(self):
+        now = time.monotonic()
+        expired = [pooled for pooled in self._lru.values() if now - pooled.last_used > self.idle_ttl]
+        for pooled in expired:
+            self._remove_idle_locked(pooled)
+        if expired:
+            self._stats['expired'] += len(expired)
+            self._stats['closed'] += len(expired)
+            self._close_later(expired)
+        return expired
+
+    def _evict_host_locked(self, host):
+        """同一设备已达上限时，淘汰该设备其它键（如不同账号）下最久未用的空闲会话"""
+        for pooled in self._lru.values():
+            if pooled.key[:2] == host:
+                self._remove_idle_locked(pooled)
+                self._stats['evicted'] += 1
+                self._stats['closed'] += 1
+                self._close_later([pooled])
+                return True
+        return False
+
+    def _evict_lru_locked(self):
+        evicted = []
+        while self.total_sessions() > self.max_total and self._lru:
+            pooled = next(iter(self._lru.values()))
+            self._remove_idle_locked(pooled)
+            evicted.append(pooled)
+        self._stats['evicted'] += len(evicted)
+        self._stats['closed'] += len(evicted)
+        self._close_later(evicted)
+
+    def _ensure_sweeper(self):
+        # 后台线程定期清理过期的空闲会话，避免长时间占用设备的VTY
+        if self._sweeper and self._sweeper.is_alive():
+            return
+        with self._cond:
+            if self._sweeper and self._sweeper.is_alive():
+                return
+            self._sweeper = threading.Thread(target=self._sweep_loop, name="SessionPoolSweeper", daemon=True)
+            self._sweeper.start()
+
+    def _sweep_loop(self):
+        interval = max(min(self.idle_ttl / 2, 30), 1)
+        while True:
+            time.sleep(interval)
+            with self._cond:
+                if self._expire_idle_locked():
+                    self._cond.notify_all()
+            publish_stats('session_pool', self.stats())
+
+
+_session_pool = None
+_session_pool_lock = threading.Lock()
+
+
+def get_session_pool():
+    """获取进程级会话池单例"""
+    global _session_pool
+    if _session_pool is None:
+        with _session_pool_lock:
+            if _session_pool is None:
+                _session_pool = SessionPool.from_settings()
+    return _session_pool
+
+
+def session_pool_enabled():
+    return getattr(settings, 'EXECUTE_CONFIG', {}).get('SESSION_POOL', {}).get('ENABLED', True)
@@ -0,0 +1,251 @@
+import re
+import time
+import logging
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+
+from devices.tools.runtime_stats import publish_stats
+
+logger = logging.getLogger('devices.session_profile')
+
+PROFILE_CACHE_PREFIX = 'session_profile'
+
+# 未配置的os_type使用的默认参数
+DEFAULT_PROFILE = {
+    'DEVICE_TYPE': None, # netmiko的device_type，None表示与os_type相同
+    'FAST_CLI': True,
+    'GLOBAL_DELAY_FACTOR': 1,
+    'CONN_TIMEOUT': 20,
+    'READ_TIMEOUT': None, # 单条命令读取超时（秒），None表示按学习到的命令耗时，样本不足时使用TIME_BUDGET的COMMAND_TIMEOUT
+    'PROMPT_PATTERN': None, # 提示符正则，{prompt}替换为登录时获取的base_prompt；None表示每条命令前重新获取提示符
+    'DISABLE_PAGING': None, # 登录后额外执行的关闭分页命令，netmiko驱动已关闭分页的os_type无需配置
+}
+
+# 内置的os_type参数，可被EXECUTE_CONFIG['SESSION_PROFILE']['PROFILES']覆盖
+BUILTIN_PROFILES = {
+    'hp_comware': {'PROMPT_PATTERN': r'[<\[]{prompt}[^\r\n]*[>\]]\s*$'},
+    'huawei': {'DEVICE_TYPE': 'huawei', 'PROMPT_PATTERN': r'[<\[]{prompt}[^\r\n]*[>\]]\s*$'},
+    'huawei_vrp': {'DEVICE_TYPE': 'huawei', 'PROMPT_PATTERN': r'[<\[]{prompt}[^\r\n]*[>\]]\s*$'},
+    'huawei_yunshan': {'DEVICE_TYPE': 'huawei', 'PROMPT_PATTERN': r'[<\[]{prompt}[^\r\n]*[>\]]\s*$'},
+    'cisco_ios': {'PROMPT_PATTERN': r'{prompt}[^\r\n]*[>#]\s*$'},
+    'cisco_xe': {'PROMPT_PATTERN': r'{prompt}[^\r\n]*[>#]\s*$'},
+    'cisco_nxos': {'PROMPT_PATTERN': r'{prompt}[^\r\n]*[>#]\s*$'},
+    'ruijie_os': {'PROMPT_PATTERN': r'{prompt}[^\r\n]*[>#]\s*$'},
+}
+
+
+def session_profile_config():
+    return getattr(settings, 'EXECUTE_CONFIG', {}).get('SESSION_PROFILE', {})
+
+
+def _netmiko_device_type(os_type):
+    """华为各系列统一使用netmiko的huawei驱动"""
+    return 'huawei' if 'huawei' in os_type else os_type
+
+
+def _is_read_timeout(exc):
+    return type(exc).__name__ == 'ReadTimeout'
+
+
+class SessionProfileRegistry:
+    """
+    按os_type保存的netmiko会话参数
+    内置/配置的参数决定建连参数及命令结束的提示符正则：有提示符正则时每条命令直接按正则等待结束，
+    不再由netmiko在每条命令前发送回车重新获取提示符。
+    执行结果按os_type学习：使用提示符正则的命令连续读取超时达到FALLBACK_FAILURES次时，
+    该os_type回退为每条命令获取提示符，回退标记写入缓存由所有进程共享；
+    同时记录各os_type的命令耗时，最长耗时写入缓存由所有进程共享，样本足够后命令读取超时收紧为最长耗时的
+    READ_TIMEOUT_FACTOR倍（不小于MIN_READ_TIMEOUT，不超过COMMAND_TIMEOUT），卡住的会话尽早失败；统计通过runtime_stats发布。
+    默认不启用，未启用时使用netmiko的默认建连参数及每条命令获取提示符的行为。
+    """
+
+    def __init__(self, conf=None):
+        conf = conf or {}
+        self.enabled = conf.get('ENABLED', False)
+        self.overrides = conf.get('PROFILES', {})
+        self.fallback_failures = conf.get('FALLBACK_FAILURES', 3)
+        self.learn_ttl = conf.get('LEARN_TTL', 60*60*24*7)
+        self.sync_interval = conf.get('SYNC_INTERVAL', 30)
+        self.read_timeout_factor = conf.get('READ_TIMEOUT_FACTOR', 3) # 0表示不按耗时收紧读取超时
+        self.min_read_timeout = conf.get('MIN_READ_TIMEOUT', 10)
+        self.min_samples = conf.get('MIN_SAMPLES', 20)
+        self._lock = threading.Lock()
+        self._learned = {} # {os_type: 学习结果}
+        self._synced = {} # {os_type: 上次与缓存同步的时间}
+
+    @classmethod
+    def from_settings(cls):
+        return cls(session_profile_config())
+
+    def profile(self, os_type):
+        """os_type的会话参数（默认值 < 内置 < 配置 < 学习结果）"""
+        os_type = os_type or ''
+        profile = dict(DEFAULT_PROFILE)
+        profile.update(BUILTIN_PROFILES.get(os_type, {}))
+        profile.update(self.overrides.get(os_type, {}))
+        if not profile['DEVICE_TYPE']:
+            profile['DEVICE_TYPE'] = _netmiko_device_type(os_type)
+        if not self.enabled or self._learned_state(os_type).get('fallback'):
+            profile['PROMPT_PATTERN'] = None
+        return profile
+
+    def connect_kwargs(self, device_info):
+        """ConnectHandler的参数"""
+        profile = self.profile(device_info['os_type'])
+        kwargs = {
+            'device_type': profile['DEVICE_TYPE'],
+            'host': device_info['ip'],
+            'username': device_info['username'],
+            'password': device_info['password'],
+            'port': device_info['port'],
+            'timeout': profile['CONN_TIMEOUT'],
+        }
+        if self.enabled:
+            kwargs['fast_cli'] = profile['FAST_CLI']
+            kwargs['global_delay_factor'] = profile['GLOBAL_DELAY_FACTOR']
+        return kwargs
+
+    def prepare(self, conn, os_type):
+        """登录后按参数执行额外的会话准备（如关闭分页）"""
+        if not self.enabled:
+            return
+        profile = self.profile(os_type)
+        if profile['DISABLE_PAGING']:
+            conn.disable_paging(command=profile['DISABLE_PAGING'])
+        if profile['PROMPT_PATTERN']:
+            # 关闭分页只读到命令回显，提示符仍留在缓冲区；每个会话获取一次提示符将其读出，之后的命令按正则读到提示符为止
+            conn.find_prompt()
+
+    def command_kwargs(self, conn, os_type):
+        """send_command的参数，返回空字典表示使用netmiko默认行为"""
+        pattern = self.profile(os_type)['PROMPT_PATTERN']
+        base_prompt = getattr(conn, 'base_prompt', None)
+        if not pattern or not base_prompt:
+            return {}
+        return {
+            'expect_string': pattern.replace('{prompt}', re.escape(base_prompt)),
+            'auto_find_prompt': False,
+        }
+
+    def read_timeout(self, os_type, timeout):
+        """命令读取超时，不超过设备剩余时限；未配置READ_TIMEOUT时按学习到的命令耗时"""
+        profile_timeout = self.profile(os_type)['READ_TIMEOUT'] or self._learned_read_timeout(os_type)
+        return min(timeout, profile_timeout) if profile_timeout else timeout
+
+    def record_success(self, os_type, latency, tuned):
+        """记录一条命令执行成功及耗时（秒），tuned表示使用了提示符正则"""
+        with self._lock:
+            state = self._learned_state_locked(os_type)
+            state['commands'] += 1
+            state['samples'] += 1
+            state['total_seconds'] += latency
+            state['max_seconds'] = max(state['max_seconds'], latency)
+            if tuned:
+                state['tuned_commands'] += 1
+                state['consecutive_failures'] = 0
+        self._sync(os_type)
+
+    def record_failure(self, os_type, exc, tuned):
+        """记录一条命令执行失败，使用提示符正则时读取超时视为正则不匹配"""
+        if not tuned or not _is_read_timeout(exc):
+            return
+        with self._lock:
+            state = self._learned_state_locked(os_type)
+            state['consecutive_failures'] += 1
+            fallback = not state['fallback'] and state['consecutive_failures'] >= self.fallback_failures
+            if fallback:
+                state['fallback'] = True
+        if fallback:
+            logger.warning(f"{os_type}使用提示符正则连续{self.fallback_failures}次读取超时，回退为每条命令获取提示符")
+        self._sync(os_type, force=fallback)
+
+    def stats(self):
+        with self._lock:
+            stats = {}
+            for os_type, state in self._learned.items():
+                stats[os_type] = {
+                    'commands': state['commands'],
+                    'tuned_commands': state['tuned_commands'],
+                    'avg_seconds': round(state['total_seconds'] / state['commands'], 3) if state['commands'] else None,
+                    'max_seconds': round(state['max_seconds'], 3),
+                    'fallback': state['fallback'],
+                }
+            return stats
+
+    # --------------------------
+    # 内部方法
+    # --------------------------
+    def _learned_read_timeout(self, os_type):
+        """所有进程观察到的最长命令耗时的READ_TIMEOUT_FACTOR倍，样本不足时为None"""
+        if not self.enabled or not self.read_timeout_factor:
+            return None
+        state = self._learned_state(os_type)
+        if state['samples'] < self.min_samples:
+            return None
+        return max(self.min_read_timeout, state['max_seconds'] * self.read_timeout_factor)
+
+    def _learned_state(self, os_type):
+        with self._lock:
+            state = self._learned.get(os_type)
+            stale = time.monotonic() - self._synced.get(os_type, 0) >= self.sync_interval
+        if state is None or stale:
+            self._sync(os_type)
+        with self._lock:
+            return dict(self._learned_state_locked(os_type))
+
+    def _learned_state_locked(self, os_type):
+        state = self._learned.get(os_type)
+        if state is None:
+            state = {
+                'commands': 0,
+                'tuned_commands': 0,
+                'total_seconds': 0.0,
+                'max_seconds': 0.0, # 与缓存合并后的最长耗时
+                'samples': 0, # 与缓存合并后的命令数，决定是否按耗时收紧读取超时
+                'consecutive_failures': 0,
+                'fallback': False,
+            }
+            self._learned[os_type] = state
+        return state
+
+    def _sync(self, os_type, force=False):
+        """
+        与缓存中的回退标记（任一进程回退则全部回退）及最长命令耗时合并，并发布本进程的命令耗时统计
+        按SYNC_INTERVAL限制频率，避免每条命令都读写缓存
+        """
+        now = time.monotonic()
+        with self._lock:
+            if not force and os_type in self._synced and now - self._synced[os_type] < self.sync_interval:
+                return
+            self._synced[os_type] = now
+        key = f"{PROFILE_CACHE_PREFIX}:{os_type}"
+        try:
+            shared = cache.get(key) or {}
+            with self._lock:
+                state = self._learned_state_locked(os_type)
+                state['fallback'] = state['fallback'] or shared.get('fallback', False)
+                state['max_seconds'] = max(state['max_seconds'], shared.get('max_seconds', 0.0))
+                state['samples'] = max(state['samples'], shared.get('samples', 0))
+                merged = {name: state[name] for name in ('fallback', 'max_seconds', 'samples')}
+            if merged != shared:
+                cache.set(key, merged, self.learn_ttl)
+        except Exception as e:
+            logger.warning(f"同步{os_type}会话参数学习结果失败: {str(e)}")
+            return
+        publish_stats('session_profile', self.stats())
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_profile_registry():
+    """获取进程级会话参数注册表单例"""
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = SessionProfileRegistry.from_settings()
+    return _registry
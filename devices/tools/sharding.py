@@ -0,0 +1,297 @@
+import os
+import time
+import asyncio
+import logging
+from threading import Lock
+
+from django.conf import settings
+from asgiref.sync import sync_to_async
+
+from devices.tools.progress import device_key, DEVICE_RUNNING
+from devices.tools.job_queue import get_job_queue, job_group_name, build_job_spec, ensure_local_worker
+
+logger = logging.getLogger('devices.sharding')
+
+# 从分片进度中合并的计数（分片的total等只描述分片本身，不合并）
+SHARD_COUNTERS = ['completed', 'completed_commands', 'failed_commands', 'failed_devices', 'timeout_devices']
+SHARD_CHANNEL_PREFIX = 'execute_shard' # 协调者接收分片消息的channel前缀，见CHANNEL_LAYERS的channel_capacity
+
+
+def sharding_config():
+    conf = getattr(settings, 'EXECUTE_CONFIG', {}).get('SHARDING', {})
+    return {
+        'ENABLED': conf.get('ENABLED', False),
+        'MIN_DEVICES': conf.get('MIN_DEVICES', 500), # 设备数达到该值才拆分
+        'SHARD_SIZE': conf.get('SHARD_SIZE', 250), # 每个分片的设备数
+        'MAX_SHARDS': conf.get('MAX_SHARDS', 8), # 最多拆分的分片数（含协调者本地执行的分片）
+        'RESULT_BATCH': conf.get('RESULT_BATCH', 100), # 分片结果累计该条数时立即推送
+        'FLUSH_INTERVAL': conf.get('FLUSH_INTERVAL', 0.5), # 分片结果推送间隔（秒）
+    }
+
+
+def split_shards(device_ids, shards):
+    """
+    按顺序轮流分配设备，device_ids已按预计耗时从长到短排序时，各分片的总耗时接近，
+    且每个分片内仍是耗时长的设备在前
+    """
+    shards = max(1, min(shards, len(device_ids)))
+    return [device_ids[index::shards] for index in range(shards)]
+
+
+def shard_reply_id(job_id):
+    """分片消息推送到该ID对应的channel group（见job_group_name），只有协调者订阅"""
+    return f"{job_id}-shards"
+
+
+def shard_execute_dir(execute_type, job_id, index):
+    """分片在执行节点上的会话日志目录，位于原任务报告目录下，共享存储时与报告放在一起"""
+    return os.path.join(settings.DIR_INFO['REPORT_DIR'], execute_type, job_id, 'shards', str(index))
+
+
+def tag_shard(emit, index):
+    """分片推送的消息附带分片序号"""
+    async def shard_emit(event):
+        event['shard'] = index
+        await emit(event)
+    return shard_emit
+
+
+class ShardResultStream:
+    """
+    分片的结果输出，接口与ResultSpool一致
+    结果不写入执行节点的文件，而是按批推送给协调者，由协调者写入原任务的结果文件
+    """
+    path = None
+
+    def __init__(self, emit, loop, batch=100, interval=0.5):
+        self.emit = emit
+        self.loop = loop
+        self.batch = batch
+        self.interval = interval
+        self._lock = Lock()
+        self._buffer = []
+        self._send_lock = asyncio.Lock()
+        self._task = loop.create_task(self._flush_loop())
+
+    def reset(self):
+        with self._lock:
+            self._buffer = []
+
+    def append(self, record):
+        """可在任意线程中调用"""
+        with self._lock:
+            self._buffer.append(record)
+            full = len(self._buffer) >= self.batch
+        if full:
+            asyncio.run_coroutine_threadsafe(self.flush(), self.loop)
+
+    async def flush(self):
+        async with self._send_lock:
+            with self._lock:
+                records, self._buffer = self._buffer, []
+            if records:
+                await self.emit({'type': 'shard.records', 'records': records})
+
+    def close(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.warning(f"推送分片结果失败: {str(e)}")
+
+
+class ShardCoordinator:
+    """
+    分片协调者，运行在发起任务的进程中
+    把可达设备拆分为多个分片：第一个分片在本进程内执行，其余分片投递到任务队列，由各节点的execute_worker执行；
+    分片的结果、进度及错误通过channel layer推送回协调者，合并写入原任务的结果文件、进度及报告，
+    前端只订阅原任务。本进程的分片执行完时仍未被任何worker取走的分片撤回本地执行。
+    worker异常退出时分片由任务队列重新投递，重复的结果按(设备, 命令)去重。
+    其它节点执行的设备不记录检查点（见checkpoint.JobCheckpoint），任务续跑时重新执行。
+    """
+
+    def __init__(self, job, shards, channel_layer, conf):
+        self.job = job
+        self.shard_count = shards
+        self.channel_layer = channel_layer
+        self.conf = conf
+        self.reply_id = shard_reply_id(job.current_report_id)
+        self.shards = {} # {序号: {'job_id', 'device_ids', 'worker', 'status', 'done'}}
+        self._snapshots = {} # {序号: 分片上一帧的计数}
+        self._reported = {} # {序号: 已推送结果或已结束的设备键}，分片超时时这些设备不再记为超时
+        self._seen = set() # 已写入的(设备, IP, 命令)
+        self._all_done = asyncio.Event()
+        self._device_types = {
+            (device['name'], device['ip']): device['device_type'] for device in job.devices.values()
+        }
+
+    @classmethod
+    def for_job(cls, job, device_ids):
+        """按配置判断是否拆分，不拆分时返回None"""
+        conf = sharding_config()
+        if not conf['ENABLED'] or job.shard or len(device_ids) < conf['MIN_DEVICES']:
+            return None
+        shards = min(conf['MAX_SHARDS'], -(-len(device_ids) // max(1, conf['SHARD_SIZE'])))
+        if shards < 2:
+            return None
+        from channels.layers import get_channel_layer
+        channel_layer = get_channel_layer()
+        if channel_layer is None:
+            logger.warning("未配置channel layer，任务不拆分")
+            return None
+        return cls(job, shards, channel_layer, conf)
+
+    async def run(self, device_ids, command_ids, server_commands, network_commands):
+        job = self.job
+        parts = split_shards(device_ids, self.shard_count)
+        channel = await self.channel_layer.new_channel(SHARD_CHANNEL_PREFIX)
+        group = job_group_name(self.reply_id)
+        await self.channel_layer.group_add(group, channel)
+        receiver = asyncio.create_task(self._receive_loop(channel))
+        try:
+            queue = get_job_queue()
+            # 分片与协调者在同一时刻超时，任务不限时时为None
+            deadline = None if job.job_deadline is None else time.time() + max(0, job.job_deadline - time.monotonic())
+            for index, part in enumerate(parts[1:], start=1):
+                spec = build_job_spec(
+                    f"{job.current_report_id}-{index}", job.execute_type, part, command_ids, server_commands, network_commands,
+                    job.engine, preflight=False, priority=job.priority
+                )
+                spec['shard'] = {
+                    'parent': job.current_report_id,
+                    'index': index,
+                    'reply_to': self.reply_id,
+                    'deadline': deadline,
+                }
+                self.shards[index] = {'job_id': spec['job_id'], 'device_ids': part, 'worker': '', 'status': 'queued', 'done': False}
+                await sync_to_async(queue.enqueue)(spec)
+            await sync_to_async(ensure_local_worker)()
+            logger.info(f"任务{job.current_report_id}拆分为{len(parts)}个分片，本地执行{len(parts[0])}台设备")
+            await job._run_devices(parts[0], command_ids, server_commands, network_commands)
+            # 仍在排队的分片撤回本地执行
+            reclaimed = []
+            for shard in self.shards.values():
+                if shard['status'] == 'queued' and await sync_to_async(queue.cancel)(shard['job_id']):
+                    logger.info(f"分片{shard['job_id']}未被worker取走，撤回本地执行")
+                    shard.update(status='local', done=True, worker='local')
+                    reclaimed.extend(shard['device_ids'])
+            if reclaimed:
+                await job._run_devices(reclaimed, command_ids, server_commands, network_commands)
+            self._check_done()
+            if job.job_deadline is None or not job.force_expire:
+                # 不强制结束的任务（配置下发）由分片自行停止开始新的设备，等待分片执行完
+                await self._all_done.wait()
+                return
+            remaining = job.job_deadline - time.monotonic() + job.time_budget['GRACE']
+            try:
+                await asyncio.wait_for(self._all_done.wait(), max(0, remaining))
+            except asyncio.TimeoutError:
+                self._expire_unfinished()
+        finally:
+            receiver.cancel()
+            await self.channel_layer.group_discard(group, channel)
+            job.reports[job.current_report_id]['shards'] = [
+                {key: value for key, value in dict(shard, index=index).items() if key != 'device_ids'}
+                for index, shard in sorted(self.shards.items())
+            ]
+
+    async def handle(self, event):
+        """处理一条分片消息"""
+        index = event.get('shard')
+        shard = self.shards.get(index)
+        if shard is None:
+            return
+        job = self.job
+        event_type = event.get('type')
+        if event_type == 'shard.started':
+            shard.update(status='running', worker=event.get('worker', ''))
+            # 分片重新投递后计数从0开始，先扣除上次投递已合并的计数
+            previous = self._snapshots.get(index)
+            if previous:
+                job.progress.merge({counter: -value for counter, value in previous.items()})
+            self._snapshots[index] = {}
+        elif event_type == 'progress.update':
+            previous = self._snapshots.setdefault(index, {})
+            deltas = {}
+            for counter in SHARD_COUNTERS:
+                value = event.get(counter, 0)
+                if value > previous.get(counter, 0):
+                    deltas[counter] = value - previous.get(counter, 0)
+                    previous[counter] = value
+            job.progress.merge(deltas, event.get('devices'))
+            self._reported.setdefault(index, set()).update(
+                device for device, status in (event.get('devices') or {}).items() if status != DEVICE_RUNNING
+            )
+        elif event_type == 'shard.records':
+            reported = self._reported.setdefault(index, set())
+            for record in event['records']:
+                reported.add(device_key({'name': record['device'], 'ip': record['device_ip']}))
+                await self._write_record(record)
+        elif event_type == 'error':
+            await job.emit({'type': 'error', 'message': event.get('message', '')})
+        elif event_type == 'shard.done':
+            report = job.reports[job.current_report_id]
+            for os_type, item in event.get('items', {}).items():
+                merged = report['items'].setdefault(os_type, {'commands': item['commands'], 'devices': []})
+                merged['devices'].extend(device for device in item['devices'] if device not in merged['devices'])
+            job.timings.merge(event.get('timings', []))
+            if event.get('timed_out'):
+                job.timed_out = True
+            shard.update(status=event.get('status', 'completed'), done=True, concurrency=event.get('concurrency', []))
+            self._check_done()
+
+    async def _write_record(self, record):
+        """写入原任务的结果文件，成功的结果同时推送给前端"""
+        key = (record['device'], record['device_ip'], record['command'])
+        if key in self._seen:
+            return
+        self._seen.add(key)
+        job = self.job
+        job.result_spool.append(record)
+        if record.get('status') != 'success':
+            return
+        await job.command_result({
+            "type": "command.result",
+            "device_name": record['device'],
+            "device_type": self._device_types.get((record['device'], record['device_ip']), ''),
+            "os_type": record['os_type'],
+            "device_ip": record['device_ip'],
+            "command": record['command'],
+            "result": record['result'],
+            'send_time': record.get('end_time'),
+        })
+
+    def _check_done(self):
+        if all(shard['done'] for shard in self.shards.values()):
+            self._all_done.set()
+
+    def _expire_unfinished(self):
+        """超过任务时限仍未结束的分片，未推送过结果且未结束的设备记为超时"""
+        job = self.job
+        job.timed_out = True
+        for index, shard in self.shards.items():
+            if shard['done']:
+                continue
+            reported = self._reported.get(index, set())
+            expired = [
+                device_info for device_info in (job.devices.get(int(device_id)) for device_id in shard['device_ids'])
+                if device_info and device_key(device_info) not in reported
+            ]
+            logger.warning(f"分片{shard['job_id']}超过任务时限未结束，{len(expired)}台设备记为超时")
+            shard['status'] = 'timeout'
+            for device_info in expired:
+                job._record_device_timeout(device_info)
+
+    async def _receive_loop(self, channel):
+        while True:
+            message = await self.channel_layer.receive(channel)
+            try:
+                await self.handle(message.get('event', {}))
+            except Exception as e:
+                logger.error(f"处理分片消息失败: {str(e)}")
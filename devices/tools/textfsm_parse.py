@@ -0,0 +1,327 @@
+import io
+import os
+import copy
+import time
+import hashlib
+import logging
+import multiprocessing
+from collections import deque, OrderedDict
+from datetime import datetime
+from threading import Lock
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import textfsm
+from django.conf import settings
+
+from devices.tools.runtime_stats import publish_stats
+
+logger = logging.getLogger('devices.textfsm')
+
+TEMPLATE_CACHE_SIZE = 300 # 默认缓存的模板数，devices/conf/textfsm下约有280个模板
+
+# 解析进程按spawn方式启动：daphne/worker进程中有多个线程，fork后子进程可能继承被占用的锁
+_pool = None
+_pool_workers = 0
+_pool_lock = Lock()
+
+
+def default_workers():
+    """默认解析进程数：留一个CPU给写入csv的线程，单核时串行解析"""
+    return max(0, min(4, (os.cpu_count() or 1) - 1))
+
+
+def textfsm_config():
+    conf = getattr(settings, 'EXECUTE_CONFIG', {}).get('TEXTFSM', {})
+    return {
+        'WORKERS': conf.get('WORKERS', default_workers()), # 解析进程数，0表示在当前线程中串行解析
+        'MIN_RESULTS': conf.get('MIN_RESULTS', 200), # 结果数少于该值时串行解析，避免进程间传输的开销
+        'CHUNK_SIZE': conf.get('CHUNK_SIZE', 100), # 每个解析任务包含的输出数（同一模板）
+        'TEMPLATE_CACHE_SIZE': conf.get('TEMPLATE_CACHE_SIZE', TEMPLATE_CACHE_SIZE), # 每个进程缓存的已编译模板数
+    }
+
+
+def textfsm_template(os_type, command):
+    """命令结果对应的textfsm模板，返回(模板使用的os_type, 模板文件路径)"""
+    if 'huawei' in os_type:
+        os_type = 'huawei_vrp'
+    return os_type, os.path.join(settings.DIR_INFO['CONF_DIR'], 'textfsm', f"{os_type}_{command.replace(' ', '_')}.textfsm")
+
+
+def clone_fsm(fsm):
+    """
+    复制已编译的模板用于一次解析：状态及规则（含编译后的正则）只读共用，
+    解析过程中变化的Value及其选项（Filldown、List等）各自独立，复制后Reset清空状态
+    """
+    clone = copy.copy(fsm)
+    clone.values = []
+    for value in fsm.values:
+        value_copy = copy.copy(value)
+        value_copy.fsm = clone
+        value_copy.options = []
+        for option in value.options:
+            option_copy = copy.copy(option)
+            option_copy.value = value_copy
+            value_copy.options.append(option_copy)
+        clone.values.append(value_copy)
+    clone.Reset()
+    return clone
+
+
+class TemplateCache:
+    """
+    已编译TextFSM模板的LRU缓存，可在多个线程中使用
+    模板文件按路径缓存，文件修改时间或大小变化后重新编译；在线测试的模板文本按内容摘要缓存。
+    每次获取返回独立的副本（见clone_fsm），模板只在首次使用或修改后编译一次。
+    """
+
+    def __init__(self, max_size=TEMPLATE_CACHE_SIZE):
+        self.max_size = max(1, max_size)
+        self._items = OrderedDict() # {键: (版本, 已编译的模板)}
+        self._lock = Lock()
+        self._counters = {'hits': 0, 'misses': 0, 'invalidations': 0, 'evictions': 0}
+
+    def get(self, template_path):
+        """
+        获取模板文件编译后的副本
+        :raises OSError: 模板文件不存在
+        :raises textfsm.TextFSMTemplateError: 模板语法错误
+        """
+        return self.fetch(template_path)[0]
+
+    def fetch(self, template_path):
+        """同get，返回(模板副本, 是否命中缓存)"""
+        stat = os.stat(template_path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        fsm = self._lookup(template_path, version)
+        hit = fsm is not None
+        if not hit:
+            with open(template_path, 'r', encoding='utf-8') as template_file:
+                fsm = textfsm.TextFSM(template_file)
+            self._store(template_path, version, fsm)
+        return clone_fsm(fsm), hit
+
+    def get_text(self, template_text):
+        """获取模板文本编译后的副本"""
+        key = 'text:' + hashlib.sha1(template_text.encode('utf-8')).hexdigest()
+        fsm = self._lookup(key, None)
+        if fsm is None:
+            fsm = textfsm.TextFSM(io.StringIO(template_text))
+            self._store(key, None, fsm)
+        return clone_fsm(fsm)
+
+    def invalidate(self, template_path=None):
+        """模板文件被修改或删除后移除缓存，不指定路径时清空"""
+        with self._lock:
+            if template_path is None:
+                self._items.clear()
+            elif self._items.pop(template_path, None) is not None:
+                self._counters['invalidations'] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters, size=len(self._items), max_size=self.max_size)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / lookups, 4) if lookups else 0
+        return stats
+
+    def _lookup(self, key, version):
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is not None and entry[0] == version:
+                self._items.move_to_end(key)
+                self._counters['hits'] += 1
+                return entry[1]
+            if entry is not None:
+                # 模板文件已修改
+                del self._items[key]
+                self._counters['invalidations'] += 1
+            self._counters['misses'] += 1
+            return None
+
+    def _store(self, key, version, fsm):
+        with self._lock:
+            self._items[key] = (version, fsm)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+                self._counters['evictions'] += 1
+
+
+_template_cache = None
+_template_cache_lock = Lock()
+
+
+def get_template_cache():
+    """进程内共用的模板缓存；解析进程中未加载Django配置，使用默认大小"""
+    global _template_cache
+    if _template_cache is None:
+        with _template_cache_lock:
+            if _template_cache is None:
+                size = textfsm_config()['TEMPLATE_CACHE_SIZE'] if settings.configured else TEMPLATE_CACHE_SIZE
+                _template_cache = TemplateCache(size)
+    return _template_cache
+
+
+def publish_template_cache_stats(force=False):
+    publish_stats('textfsm_cache', get_template_cache().stats(), force=force)
+
+
+def parse_outputs(template_path, outputs):
+    """
+    用同一模板解析多条输出，模板从进程内的模板缓存获取；在解析进程中执行，不依赖Django
+    :return: (表头, [各输出的解析结果], 模板是否命中缓存)，模板无法编译时表头为None、第二项为错误信息；
+             单条输出解析失败时其结果为None
+    """
+    try:
+        fsm, hit = get_template_cache().fetch(template_path)
+    except (OSError, textfsm.TextFSMTemplateError) as e:
+        return None, str(e), False
+    results = []
+    for output in outputs:
+        fsm.Reset()
+        try:
+            results.append(fsm.ParseText(output))
+        except textfsm.TextFSMError:
+            results.append(None)
+    return fsm.header, results, hit
+
+
+def get_parse_pool(workers):
+    """进程内共用的解析进程池，进程数变化时重建"""
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is None or _pool_workers != workers:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+            _pool_workers = workers
+        return _pool
+
+
+def reset_parse_pool():
+    """解析进程异常退出后丢弃进程池，下次使用时重建"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False)
+            _pool = None
+
+
+class TextFSMPipeline:
+    """
+    报告生成后的TextFSM解析阶段
+    结果逐条读取，按模板分组，每组CHUNK_SIZE条输出作为一个任务交给解析进程，解析结果按提交顺序交给on_rows写入，
+    同一模板的CSV行顺序与结果顺序一致；结果较少或WORKERS为0时在当前线程中串行解析
+    """
+
+    def __init__(self, on_rows, workers=None, chunk_size=None, min_results=None):
+        """
+        :param on_rows: on_rows(os_type, 命令, 解析结果, 表头, 附加字段)，在当前线程中调用
+        """
+        conf = textfsm_config()
+        self.on_rows = on_rows
+        self.workers = conf['WORKERS'] if workers is None else workers
+        self.chunk_size = max(1, conf['CHUNK_SIZE'] if chunk_size is None else chunk_size)
+        self.min_results = conf['MIN_RESULTS'] if min_results is None else min_results
+        self.pool = None
+        self._pending = deque() # 已提交的任务 [(分组, future)]
+        self._templates = {} # {模板路径: 模板是否存在}
+        self.stats = {'results': 0, 'parsed': 0, 'failed': 0, 'rows': 0, 'chunks': 0, 'template_hits': 0}
+
+    def run(self, results):
+        """
+        :param results: 命令结果，可以是ResultSpool或列表
+        :return: 解析统计
+        """
+        started = time.monotonic()
+        try:
+            total = len(results)
+        except TypeError:
+            total = None
+        if self.workers > 0 and (total is None or total >= self.min_results):
+            self.pool = get_parse_pool(self.workers)
+        groups = {}
+        for result in results:
+            # 超时的命令没有完整输出，不解析
+            if result.get('status', 'success') != 'success':
+                continue
+            self.stats['results'] += 1
+            command = result.get('command', '')
+            os_type, template_path = textfsm_template(result.get('os_type', ''), command)
+            if template_path not in self._templates:
+                self._templates[template_path] = os.path.exists(template_path)
+            if not self._templates[template_path]:
+                continue
+            # csv文件附加字段
+            extra_datas = {
+                'device_name': result.get('device', ''),
+                'device_ip': result.get('device_ip', ''),
+                'update_time': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            }
+            group = groups.setdefault(template_path, {'os_type': os_type, 'command': command, 'outputs': [], 'extras': []})
+            group['outputs'].append(result.get('result', ''))
+            group['extras'].append(extra_datas)
+            if len(group['outputs']) >= self.chunk_size:
+                self._submit(template_path, groups.pop(template_path))
+        for template_path, group in groups.items():
+            self._submit(template_path, group)
+        while self._pending:
+            self._write(*self._pending.popleft())
+        seconds = time.monotonic() - started
+        self.stats.update(
+            mode='process' if self.pool else 'serial',
+            workers=self.workers if self.pool else 0,
+            templates=sum(1 for exists in self._templates.values() if exists),
+            seconds=round(seconds, 3),
+            outputs_per_second=round(self.stats['parsed'] / seconds, 1) if seconds > 0 else 0,
+        )
+        logger.info(f"textfsm解析完成：{self.stats}")
+        publish_stats('textfsm_parse', self.stats, force=True)
+        publish_template_cache_stats(force=True)
+        return self.stats
+
+    def _submit(self, template_path, group):
+        self.stats['chunks'] += 1
+        group['template'] = template_path
+        if self.pool is not None:
+            try:
+                self._pending.append((group, self.pool.submit(parse_outputs, template_path, group['outputs'])))
+            except (BrokenProcessPool, RuntimeError) as e:
+                logger.warning(f"解析进程池不可用，改为串行解析: {str(e)}")
+                reset_parse_pool()
+                self.pool = None
+                self._pending.append((group, None))
+            # 限制已提交未写入的任务数，结果文件很大时不会堆积在内存中
+            while len(self._pending) > self.workers * 2:
+                self._write(*self._pending.popleft())
+        else:
+            while self._pending:
+                self._write(*self._pending.popleft())
+            self._write(group, None)
+
+    def _write(self, group, future):
+        if future is None:
+            header, parsed, hit = parse_outputs(group['template'], group['outputs'])
+        else:
+            try:
+                header, parsed, hit = future.result()
+            except BrokenProcessPool as e:
+                logger.warning(f"解析进程异常退出，改为串行解析: {str(e)}")
+                reset_parse_pool()
+                self.pool = None
+                header, parsed, hit = parse_outputs(group['template'], group['outputs'])
+        # 各解析进程的模板缓存相互独立，命中次数随解析结果返回
+        self.stats['template_hits'] += int(hit)
+        if header is None:
+            logger.warning(f"textfsm模板{group['template']}无法使用: {parsed}")
+            self.stats['failed'] += len(group['outputs'])
+            return
+        for rows, extra_datas in zip(parsed, group['extras']):
+            if rows is None:
+                self.stats['failed'] += 1
+                continue
+            self.stats['parsed'] += 1
+            if len(rows) > 0:
+                self.stats['rows'] += len(rows)
+                self.on_rows(group['os_type'], group['command'], rows, header, extra_datas)
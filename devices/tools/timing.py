@@ -0,0 +1,207 @@
+import os
+import json
+import time
+import socket
+import logging
+from threading import Lock
+from datetime import datetime
+from contextlib import contextmanager
+
+logger = logging.getLogger('devices.timing')
+
+TIMINGS_FILE = 'timings.json' # 报告目录中的耗时统计文件
+
+# 设备执行的各阶段
+PHASE_CONNECT = 'connect' # 建连整体耗时（TCP建连至获取提示符），无法拆分各阶段时使用，如netmiko
+PHASE_TCP_CONNECT = 'tcp_connect' # TCP建连
+PHASE_SSH_HANDSHAKE = 'ssh_handshake' # SSH版本协商、密钥交换及登录认证，paramiko的公开接口无法拆分握手与认证
+PHASE_PROMPT = 'prompt' # 打开交互式会话、获取提示符及关闭分页
+PHASE_EXEC = 'exec' # 命令执行（发出命令到开始返回输出）
+PHASE_TRANSFER = 'transfer' # 输出传输（开始返回输出到读取完毕）
+PHASE_TEARDOWN = 'teardown' # 归还或断开连接
+PHASES = [PHASE_CONNECT, PHASE_TCP_CONNECT, PHASE_SSH_HANDSHAKE, PHASE_PROMPT, PHASE_EXEC, PHASE_TRANSFER, PHASE_TEARDOWN]
+
+PERCENTILES = [50, 90, 95, 99]
+# 直方图各桶的上限（秒），最后一个桶收集超过最大上限的耗时
+HISTOGRAM_BOUNDS = [0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60, 120, 300]
+
+
+def percentile(values, point):
+    """最近秩法计算分位数，values需已排序"""
+    if not values:
+        return None
+    rank = max(1, -(-len(values) * point // 100))
+    return values[min(len(values), int(rank)) - 1]
+
+
+def histogram(values, bounds=HISTOGRAM_BOUNDS):
+    """按上限分桶计数，返回[[上限, 数量], ...]，上限为None的桶表示超过最大上限"""
+    counts = [0] * (len(bounds) + 1)
+    for value in values:
+        for index, bound in enumerate(bounds):
+            if value <= bound:
+                counts[index] += 1
+                break
+        else:
+            counts[-1] += 1
+    return [[bound, count] for bound, count in zip(bounds + [None], counts)]
+
+
+def summarize(values):
+    """一组耗时的数量、均值、最大值、分位数及直方图"""
+    values = sorted(values)
+    if not values:
+        return {'count': 0}
+    summary = {
+        'count': len(values),
+        'mean': round(sum(values) / len(values), 4),
+        'max': round(values[-1], 4),
+    }
+    for point in PERCENTILES:
+        summary[f"p{point}"] = round(percentile(values, point), 4)
+    summary['histogram'] = histogram(values)
+    return summary
+
+
+class DeviceTimer:
+    """
+    单台设备各阶段耗时（time.monotonic计时，不受系统时间调整影响）
+    同一阶段多次记录时累加，如多条命令的exec；复用会话池中的连接时不记录建连各阶段
+    """
+
+    def __init__(self, device_info):
+        self.name = device_info['name']
+        self.ip = device_info['ip']
+        self.os_type = device_info['os_type']
+        self.phases = {}
+        self.commands = [] # 各命令耗时 [{'command', 'exec', 'transfer'}]
+        self._lock = Lock()
+
+    def add(self, phase, seconds):
+        with self._lock:
+            self.phases[phase] = self.phases.get(phase, 0.0) + max(0.0, seconds)
+
+    def total(self, *phases):
+        with self._lock:
+            return sum(self.phases.get(phase, 0.0) for phase in phases)
+
+    @contextmanager
+    def phase(self, phase):
+        """记录代码块耗时，异常退出时同样记录"""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(phase, time.monotonic() - started)
+
+    def command(self, command, exec_seconds, transfer_seconds=0.0):
+        """记录一条命令的执行及输出传输耗时"""
+        with self._lock:
+            self.phases[PHASE_EXEC] = self.phases.get(PHASE_EXEC, 0.0) + exec_seconds
+            self.phases[PHASE_TRANSFER] = self.phases.get(PHASE_TRANSFER, 0.0) + transfer_seconds
+            self.commands.append({
+                'command': command,
+                'exec': round(exec_seconds, 4),
+                'transfer': round(transfer_seconds, 4),
+            })
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'device': self.name,
+                'device_ip': self.ip,
+                'os_type': self.os_type,
+                'phases': {phase: round(seconds, 4) for phase, seconds in self.phases.items()},
+                'commands': list(self.commands),
+            }
+
+
+class TimingCollector:
+    """任务级耗时收集：各设备的DeviceTimer，任务结束时按os_type汇总分位数并写入报告目录"""
+
+    def __init__(self):
+        self._devices = {}
+        self._lock = Lock()
+
+    def device(self, device_info):
+        """获取设备的计时器，设备首次使用时创建"""
+        key = (device_info['name'], device_info['ip'])
+        with self._lock:
+            timer = self._devices.get(key)
+            if timer is None:
+                timer = DeviceTimer(device_info)
+                self._devices[key] = timer
+            return timer
+
+    def merge(self, devices):
+        """合并其它进程（如任务分片）的设备耗时，devices为as_dict的列表"""
+        for device in devices:
+            timer = self.device({'name': device['device'], 'ip': device['device_ip'], 'os_type': device['os_type']})
+            with timer._lock:
+                for phase, seconds in device['phases'].items():
+                    timer.phases[phase] = timer.phases.get(phase, 0.0) + seconds
+                timer.commands.extend(device['commands'])
+
+    def summary(self):
+        """
+        :return: {
+            'os_types': {os_type: {'devices': 设备数, 'phases': {阶段: 统计}, 'command': 单条命令耗时统计}},
+            'devices': [各设备耗时],
+        }
+        """
+        with self._lock:
+            devices = [timer.as_dict() for timer in self._devices.values()]
+        os_types = {}
+        for device in devices:
+            group = os_types.setdefault(device['os_type'], {'devices': 0, 'phases': {}, 'command': []})
+            group['devices'] += 1
+            for phase, seconds in device['phases'].items():
+                group['phases'].setdefault(phase, []).append(seconds)
+            group['command'].extend(item['exec'] + item['transfer'] for item in device['commands'])
+        for group in os_types.values():
+            group['phases'] = {phase: summarize(group['phases'][phase]) for phase in PHASES if phase in group['phases']}
+            group['command'] = summarize(group['command'])
+        return {'os_types': os_types, 'devices': devices}
+
+    def save(self, execute_dir, report_id):
+        """写入报告目录的timings.json，失败不影响报告生成"""
+        data = self.summary()
+        data['report_id'] = report_id
+        data['generated_at'] = datetime.now().isoformat()
+        try:
+            with open(os.path.join(execute_dir, TIMINGS_FILE), 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False)
+        except OSError as e:
+            logger.warning(f"写入耗时统计失败: {str(e)}")
+        return data
+
+
+def load_timings(execute_dir):
+    """读取报告的耗时统计，不存在时返回None"""
+    path = os.path.join(execute_dir, TIMINGS_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def timed_socket(host, port, timeout, timer):
+    """建立TCP连接并记录耗时，连接交给paramiko/netmiko使用（sock参数）"""
+    with timer.phase(PHASE_TCP_CONNECT):
+        return socket.create_connection((host, int(port or 22)), timeout=timeout)
+
+
+def timed_exec(ssh, command, timeout, timer=None):
+    """
+    通过exec通道执行命令，读取超过timeout秒抛出socket.timeout
+    以输出的第一个字节为界拆分执行与传输耗时
+    """
+    started = time.monotonic()
+    stdin, stdout, stderr = ssh.exec_command(command, timeout=timeout)
+    first = stdout.read(1)
+    first_byte = time.monotonic()
+    output = (first + stdout.read()).decode() if first else ''
+    output = output or stderr.read().decode()
+    if timer is not None:
+        timer.command(command, first_byte - started, time.monotonic() - first_byte)
+    return output
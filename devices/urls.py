@@ -8,6 +8,10 @@ urlpatterns = [
     # 缓存管理
     path('devices/caches_list/', views.cache_manager, name='caches_list'),
     path('devices/caches/', views.CachesView.as_view(), name='caches_list_api'),
+    # SSH会话池统计
+    path('devices/session_pool/', views.SessionPoolView.as_view(), name='session_pool_api'),
+    # TextFSM模板缓存命中率及解析吞吐量
+    path('devices/textfsm_cache/', views.TextFSMCacheView.as_view(), name='textfsm_cache_api'),
 
     # csv文件管理
     path('csv/files/', views.list_csv_files, name='list_csv_files'),
@@ -44,12 +48,16 @@ urlpatterns = [
     path('devices/import/', views.import_devices, name='import_devices'),
     # 设备巡检下发页面
     path('devices/inspect/', views.devices_inspect, name='devices_inspect'),
+    # 巡检耗时预估
+    path('devices/inspect/plan/', views.InspectionPlanView.as_view(), name='inspection_plan_api'),
     # 设备巡检记录及管理API
     path('devices/inspections_list/', views.devices_inspections, name='devices_inspections'),
     path('devices/inspections/', views.DevicesInspectionsView.as_view(), name='devices_inspections_api'),
     path('devices/inspections/<str:history_id>/', views.DevicesInspectionsView.as_view(), name='devices_inspections_api_detail'),
     # 获取巡检报告
     path('devices/inspections/<uuid:report_id>/download/', views.devices_inspect_report, name='download_report'),
+    # 巡检报告各阶段耗时统计
+    path('devices/inspections/<uuid:report_id>/timings/', views.ReportTimingsView.as_view(), {'execute_type': 'inspect'}, name='inspection_timings_api'),
     # 设备列表页面点击连接进入终端交互页面
     path('device/terminal_simple/<int:device_id>/', views.TerminalSimpleView, name='terminal_simple'), # 终端
     # 独立终端连接交互页面
@@ -88,6 +96,8 @@ urlpatterns = [
     path('devices/configs/<str:history_id>/', views.DevicesConfigsView.as_view(), name='devices_configs_api_detail'),
     # 获取配置下发报告
     path('devices/configs/<uuid:report_id>/download/', views.devices_config_report, name='download_report'),
+    # 配置下发报告各阶段耗时统计
+    path('devices/configs/<uuid:report_id>/timings/', views.ReportTimingsView.as_view(), {'execute_type': 'config'}, name='config_timings_api'),
 
 ]
 
@@ -19,7 +19,6 @@ from django.views.decorators.csrf import csrf_exempt
 from django.views import View
 import subprocess
 import time
-import textfsm
 import io
 from concurrent.futures import ThreadPoolExecutor
 from django.contrib.auth.decorators import login_required
@@ -29,6 +28,12 @@ from authentication.permissions import IsAuthenticatedForWriteOnly
 from django.core.cache import cache
 import redis
 import logging  # 添加logging导入
+from devices.tools.runtime_stats import collect_stats
+from devices.tools.planner import plan_inspection
+from devices.tools.timing import load_timings
+from devices.tools.report import report_file_path
+from devices.tools.textfsm_parse import get_template_cache, publish_template_cache_stats
+import gzip
 
 # 定义日志器，名称与Django日志配置中的logger名称对应
 logger = logging.getLogger('devices')  # 'devices'对应settings.py中的日志器名称
@@ -449,6 +454,7 @@ class TextFSMView(APIView):
         file_path = os.path.join(self.textfsm_dir, f"{os_type}_{command_text}.textfsm")
         with open(file_path, 'w') as f:
             f.write(template_text)
+        get_template_cache().invalidate(file_path)
         cache.delete("commands")
         return Response({'message': '模板创建成功'}, status=status.HTTP_201_CREATED)
 
@@ -473,6 +479,8 @@ class TextFSMView(APIView):
         template_text = request.data.get('template_text')
         with open(file_path, 'w') as f:
             f.write(template_text)
+        # 本进程的缓存立即失效，其它进程按文件修改时间失效
+        get_template_cache().invalidate(file_path)
 
         return Response({'message': '模板更新成功'}, status=status.HTTP_200_OK)
 
@@ -490,9 +498,37 @@ class TextFSMView(APIView):
 
         if os.path.exists(file_path):
             os.remove(file_path)
+            get_template_cache().invalidate(file_path)
             return Response(status=status.HTTP_204_NO_CONTENT)
         return Response({'error': '模板文件不存在'}, status=status.HTTP_404_NOT_FOUND)
 
+# TextFSM模板缓存及解析统计API
+class TextFSMCacheView(APIView):
+    """
+    查询各进程已编译TextFSM模板缓存的命中率，及最近一次报告解析的吞吐量
+    """
+    permission_classes = [IsAuthenticatedForWriteOnly]
+    # 需要跨进程累加的计数项
+    counter_fields = ['hits', 'misses', 'invalidations', 'evictions', 'size']
+
+    def get(self, request):
+        processes = collect_stats('textfsm_cache')
+        total = {field: 0 for field in self.counter_fields}
+        for process in processes:
+            for field in self.counter_fields:
+                total[field] += process['stats'].get(field, 0)
+        lookups = total['hits'] + total['misses']
+        total['hit_rate'] = round(total['hits'] / lookups, 4) if lookups else 0
+        return JsonResponse({
+            'status': 'success',
+            'data': {
+                'total': total,
+                'processes': processes,
+                # 各进程最近一次报告解析的统计，解析进程中的模板命中次数见template_hits
+                'parse': collect_stats('textfsm_parse'),
+            }
+        })
+
 # 查看和删除textfsm解析结果
 class TextFSMCsvView(APIView):
     """
@@ -864,20 +900,32 @@ def download_csv_file(request, file_path):
     if os.path.exists(full_path):
         return FileResponse(open(full_path, 'rb'), as_attachment=True, filename=os.path.basename(full_path))
     raise Http404("文件不存在")
+def report_file_response(request, execute_types, report_id):
+    """
+    返回报告文件，压缩保存的报告（index.html.gz）在浏览器支持gzip时直接返回压缩内容，否则边读边解压
+    :param execute_types: 依次查找的报告类型目录
+    """
+    for execute_type in execute_types:
+        filepath = report_file_path(os.path.join(settings.DIR_INFO['REPORT_DIR'], execute_type, str(report_id)))
+        if filepath is None:
+            continue
+        logger.debug(f"查看报告:{filepath}")
+        filename = f"report_{report_id}.html"
+        if not filepath.endswith('.gz'):
+            return FileResponse(open(filepath, 'rb'), filename=filename)
+        if 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', ''):
+            response = FileResponse(open(filepath, 'rb'), filename=filename, content_type='text/html; charset=utf-8')
+            response['Content-Encoding'] = 'gzip'
+            return response
+        return FileResponse(gzip.open(filepath, 'rb'), filename=filename, content_type='text/html; charset=utf-8')
+    return HttpResponseNotFound("报告不存在")
+
 # 获取巡检报告
 def devices_inspect_report(request, report_id):
     """
     获取巡检报告
     """
-    filepath = os.path.join(settings.DIR_INFO['REPORT_DIR'],'inspect', f"{report_id}/index.html")
-    logger.debug(f"查看报告:{filepath}")
-    if os.path.exists(filepath): 
-        return FileResponse(open(filepath, 'rb'), filename=f"report_{report_id}.html")
-    else:
-        filepath = os.path.join(settings.DIR_INFO['REPORT_DIR'],'config' f"{report_id}/index.html")
-        if os.path.exists(filepath): 
-         return FileResponse(open(filepath, 'rb'), filename=f"report_{report_id}.html")
-    return HttpResponseNotFound("报告不存在")
+    return report_file_response(request, ['inspect', 'config'], report_id)
 
 # 在线测试TextFSM
 class TextFSMTestView(View):
@@ -892,8 +940,8 @@ class TextFSMTestView(View):
         template_text = request.POST.get('template_text')
 
         try:
-            template_file = io.StringIO(template_text)
-            fsm = textfsm.TextFSM(template_file)
+            fsm = get_template_cache().get_text(template_text)
+            publish_template_cache_stats()
             parsed_result = fsm.ParseText(raw_text)
             # 将解析结果转换为 JSON 格式
             json_result = json.dumps(parsed_result,indent=4)
@@ -907,7 +955,8 @@ def devices_inspect(request):
     """
     设备巡检下发页面
     """
-    return render(request, 'devices/inspect.html')
+    preflight = getattr(settings, 'EXECUTE_CONFIG', {}).get('PREFLIGHT', {})
+    return render(request, 'devices/inspect.html', {'preflight_enabled': preflight.get('ENABLED', False)})
 
 # 设备巡检列表
 @CustomLoginRequired
@@ -997,6 +1046,49 @@ class DevicesInspectionsView(APIView):
         cache.delete(self.cache_key)
         return Response({'status': 'success', 'message': '文件删除成功'}, status=status.HTTP_204_NO_CONTENT)
 
+class InspectionPlanView(APIView):
+    """
+    巡检预估API：按历史报告中的命令耗时预估任务耗时、标记慢设备，并给出下发顺序，不连接设备
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        try:
+            concurrency = request.data.get('concurrency')
+            plan = plan_inspection(
+                request.data.get('devices', []),
+                request.data.get('commands', []),
+                request.data.get('server_commands', []),
+                request.data.get('network_commands', []),
+                int(concurrency) if concurrency else None
+            )
+        except (TypeError, ValueError) as e:
+            return Response({'status': 'error', 'message': f"参数错误: {str(e)}"}, status=status.HTTP_400_BAD_REQUEST)
+        return JsonResponse({'status': 'success', 'data': plan})
+
+class ReportTimingsView(APIView):
+    """
+    报告耗时统计API：各os_type建连、握手、认证、获取提示符、命令执行、输出传输、断开各阶段的分位数及直方图
+    查询参数：os_type 只返回指定os_type；devices=1 同时返回各设备及各命令的耗时
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, report_id, execute_type='inspect'):
+        execute_dir = os.path.join(settings.DIR_INFO['REPORT_DIR'], execute_type, str(report_id))
+        try:
+            timings = load_timings(execute_dir)
+        except (OSError, ValueError) as e:
+            return Response({'status': 'error', 'message': f"读取耗时统计失败: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        if timings is None:
+            return Response({'status': 'error', 'message': '报告不存在或没有耗时统计'}, status=status.HTTP_404_NOT_FOUND)
+        os_type = request.query_params.get('os_type')
+        if os_type:
+            timings['os_types'] = {key: value for key, value in timings['os_types'].items() if key == os_type}
+            timings['devices'] = [device for device in timings['devices'] if device['os_type'] == os_type]
+        if request.query_params.get('devices') != '1':
+            timings.pop('devices', None)
+        return JsonResponse({'status': 'success', 'data': timings})
+
 # 独立终端连接交互页面
 class TerminalSingleView(APIView):
     def get(self, request, device_id=None):
@@ -1634,6 +1726,34 @@ class CachesView(APIView):
                 'status': 'error',
                 'message': f'获取缓存值时发生错误: {str(e)}'
             }, status=500)
+# SSH会话池统计API
+class SessionPoolView(APIView):
+    """
+    查询巡检/配置下发SSH会话池的命中统计及各os_type会话参数的执行统计
+    """
+    permission_classes = [IsAuthenticatedForWriteOnly]
+    # 需要跨进程累加的计数项
+    counter_fields = ['hits', 'misses', 'created', 'closed', 'evicted', 'expired', 'health_check_failed', 'waits', 'timeouts', 'idle', 'in_use']
+
+    def get(self, request):
+        """获取各进程会话池统计及汇总"""
+        processes = collect_stats('session_pool')
+        total = {field: 0 for field in self.counter_fields}
+        for process in processes:
+            for field in self.counter_fields:
+                total[field] += process['stats'].get(field, 0)
+        lookups = total['hits'] + total['misses']
+        total['hit_rate'] = round(total['hits'] / lookups, 4) if lookups else 0
+        return JsonResponse({
+            'status': 'success',
+            'data': {
+                'total': total,
+                'processes': processes,
+                # 各进程按os_type统计的命令耗时及提示符正则回退情况
+                'session_profiles': collect_stats('session_profile')
+            }
+        })
+
 @login_required
 def configs_list(request):
     """配置下发"""
@@ -1843,12 +1963,4 @@ def devices_config_report(request, report_id):
     获取巡检报告
     """
     logger.debug(f"调用api获取巡检报告: {report_id}")
-    filepath = os.path.join(settings.DIR_INFO['REPORT_DIR'],'config', f"{report_id}/index.html")
-    logger.debug(f"查看报告: {filepath}")
-    if os.path.exists(filepath): 
-        return FileResponse(open(filepath, 'rb'), filename=f"report_{report_id}.html")
-    else:
-        filepath = os.path.join(settings.DIR_INFO['REPORT_DIR'],'config',  f"{report_id}/index.html")
-        if os.path.exists(filepath): 
-         return FileResponse(open(filepath, 'rb'), filename=f"report_{report_id}.html")
-    return HttpResponseNotFound("报告不存在")
+    return report_file_response(request, ['config'], report_id)
@@ -76,10 +76,17 @@ else
     echo "未配置超级用户环境变量，跳过创建..."
 fi
 
-echo "启动应用：后台 gunicorn -> 前台 daphne"
+echo "启动应用：后台 gunicorn、execute_worker -> 前台 daphne"
+# 巡检、配置下发任务默认投递到任务队列，由独立的worker进程执行
+export EXECUTE_JOB_MODE=${EXECUTE_JOB_MODE:-queue}
 # 启动 gunicorn 后台（HTTP）
 gunicorn device_manager.wsgi:application -b 0.0.0.0:8000 --workers 3 &
 
+# 启动任务执行进程（数量可通过 EXECUTE_WORKERS 调整）
+for i in $(seq 1 ${EXECUTE_WORKERS:-1}); do
+    python manage.py execute_worker &
+done
+
 # 前台运行 daphne（ASGI，处理 websocket）
 exec daphne -b 0.0.0.0 -p 8001 device_manager.asgi:application
 